@@ -12,22 +12,36 @@ class Cell:
         if children is None:
             children = []
         if channel3_data is None:
-            channel3_avg = []
+            channel3_data = []
         if channel2_data is None:
-            channel2_ratio = []
+            channel2_data = []
         self.birthday = birthday
         self.coords = coords
         self.contours = contours
         self.parent = parent
         self.children = children
         self.problematic = problematic
-        self.channel3_data = channel3_avg
-        self.channel2_data = channel2_ratio
+        self.channel3_data = channel3_data
+        self.channel2_data = channel2_data
+        # motion state for motion-predictive linking: smoothed velocity,
+        # distance of the latest position from where it was predicted,
+        # the gate it was linked with and the smoothed prediction error
+        # (None before the first link)
+        self.velocity = None
+        self.prediction_error = None
+        self.motion_gate = None
+        self.motion_error = None
 
         if self.parent is not None:
-            history_length = len(parent.coords)
-            backfill = [(-1, -1) for _ in range(history_length)]
-            self.coords = backfill
+            self.backfill(len(parent.coords))
+
+    # fill the frames before the cell was born, so every cell
+    # has one entry per frame
+    def backfill(self, history_length):
+        self.coords = [(-1, -1) for _ in range(history_length)]
+        self.contours = [None for _ in range(history_length)]
+        self.channel3_data = [np.nan for _ in range(history_length)]
+        self.channel2_data = [np.nan for _ in range(history_length)]
 
     def add_coordinate(self, coord):
         self.coords.append(coord)
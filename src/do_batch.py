@@ -0,0 +1,288 @@
+"""Plate-level batch tracking of many ND2 files.
+
+Every (well, site) pair is tracked as an independent job in a process
+pool. Wells whose outputs are newer than their ND2 file are skipped, and
+a run manifest with the timing and status of every job is written to the
+output directory.
+
+    * find_nd2_files - find the ND2 files for a directory or glob
+    * is_up_to_date - checks if the outputs of a well are up to date
+    * estimate_job_memory - estimates the memory used by one job
+    * get_worker_count - number of workers that fit in a memory budget
+    * run_job - tracks one (well, site) job
+    * run_batch - schedules all jobs and writes outputs and manifest
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import do_tracking
+import frame_cache
+import read_nd2
+
+MANIFEST_FILE = 'run_manifest.json'
+
+
+def get_args():
+    """Collect input files and batch options
+
+    Returns
+    -------
+    args: arguments input by the user
+    """
+    parser = argparse.ArgumentParser(description='track every well '
+                                     'of a plate', prog='do_batch')
+    parser.add_argument('--input',
+                        type=str,
+                        help='Directory or glob of .nd2 files',
+                        required=True)
+    parser.add_argument('--output_path',
+                        type=str,
+                        help='Directory to write output files to',
+                        required=True)
+    parser.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Maximum number of worker processes',
+                        required=False)
+    parser.add_argument('--memory_gb',
+                        type=float,
+                        help='Memory budget for all workers in GB '
+                             '(limits the number of workers)',
+                        required=False)
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Re-track wells whose outputs are up to date',
+                        required=False)
+    parser.add_argument('--plane_cache_size',
+                        type=int,
+                        default=read_nd2.DEFAULT_PLANE_CACHE_SIZE,
+                        help='Number of decoded image planes to keep '
+                             'in memory per worker',
+                        required=False)
+    parser.add_argument('--prefetch_depth',
+                        type=int,
+                        default=1,
+                        help='Number of frames to decode ahead in each '
+                             'worker (0 disables prefetching)',
+                        required=False)
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        default=frame_cache.DEFAULT_CACHE_DIR,
+                        help='Directory of the on-disk frame cache',
+                        required=False)
+    parser.add_argument('--no_cache',
+                        action='store_true',
+                        help='Read the ND2 files directly, ignoring the '
+                             'frame cache',
+                        required=False)
+
+    args = parser.parse_args()
+    return args
+
+
+def find_nd2_files(input_path):
+    """
+    Finds the ND2 files to track.
+
+    Args:
+        input_path: a directory containing .nd2 files, or a glob
+            pattern (e.g. 'plate1/Well*.nd2')
+
+    Returns:
+        nd2_files: sorted list of ND2 file paths
+    """
+    if os.path.isdir(input_path):
+        input_path = os.path.join(input_path, '*.nd2')
+    return sorted(glob.glob(input_path))
+
+
+def is_up_to_date(nd2_filename, output_path):
+    """
+    Checks if the well-level tracks of an ND2 file are newer than
+    the ND2 file itself.
+    """
+    outfile_name = do_tracking.get_tracks_file_name(nd2_filename,
+                                                    output_path)
+    try:
+        return os.path.getmtime(outfile_name) >= \
+            os.path.getmtime(nd2_filename)
+    except FileNotFoundError:
+        return False
+
+
+def estimate_job_memory(movie, plane_cache_size, prefetch_depth):
+    """
+    Estimates the peak memory in bytes used by one (well, site) job:
+    the cached planes plus the prefetched frames, with room for the
+    segmentation work images.
+    """
+    plane_bytes = movie.height * movie.width * 2
+    n_planes = plane_cache_size + (prefetch_depth + 2) * movie.n_channels
+    # watershed and distance transform need a few full-frame buffers
+    work_bytes = 8 * movie.height * movie.width * 4
+    return n_planes * plane_bytes + work_bytes
+
+
+def get_worker_count(workers, job_memory, memory_budget=None):
+    """
+    Gets the number of workers that fit in a memory budget.
+
+    Args:
+        workers: maximum number of workers
+        job_memory: estimated memory of one job in bytes
+        memory_budget: memory budget in bytes (None for no limit)
+
+    Returns:
+        worker_count: number of workers to use (at least 1)
+    """
+    if memory_budget is not None and job_memory > 0:
+        workers = min(workers, int(memory_budget // job_memory))
+    return max(1, workers)
+
+
+def run_job(nd2_filename, site, cache_dir, plane_cache_size,
+            prefetch_depth):
+    """
+    Tracks one (well, site) job. Errors are caught so a single bad file
+    does not stop the rest of the plate.
+
+    Returns:
+        result: dictionary with the job's tracks (or None), status,
+            start time, duration and error message
+    """
+    start_time = time.time()
+    result = {'nd2': nd2_filename, 'site': site, 'start': start_time}
+    try:
+        result['tracks'] = do_tracking.track_site_file(
+                           nd2_filename, site, distance_threshold=30,
+                           cache_size=plane_cache_size, cache_dir=cache_dir,
+                           prefetch_depth=prefetch_depth)
+        result['status'] = 'done'
+        result['error'] = None
+    except Exception as e:
+        result['tracks'] = None
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['seconds'] = time.time() - start_time
+    return result
+
+
+def run_batch(nd2_files, output_path, workers=1, memory_budget=None,
+              force=False, cache_dir=None,
+              plane_cache_size=read_nd2.DEFAULT_PLANE_CACHE_SIZE,
+              prefetch_depth=1):
+    """
+    Tracks every site of every well in a worker pool and writes the
+    per-site and merged well-level CSVs, plus a run manifest.
+
+    Args:
+        nd2_files: list of ND2 file paths (one per well)
+        output_path: directory to write outputs to
+        workers: maximum number of worker processes
+        memory_budget: memory budget for all workers in bytes
+        force: re-track wells whose outputs are up to date
+        cache_dir: frame cache directory (None reads the ND2 directly)
+        plane_cache_size: number of planes kept in memory per worker
+        prefetch_depth: number of frames decoded ahead per worker
+
+    Returns:
+        manifest: list of dictionaries with the status and timing
+            of every job
+    """
+    os.makedirs(output_path, exist_ok=True)
+    manifest = []
+    jobs = []
+    job_memory = 0
+    for nd2_filename in nd2_files:
+        if not force and is_up_to_date(nd2_filename, output_path):
+            manifest.append({'nd2': nd2_filename, 'site': None,
+                             'status': 'skipped', 'start': None,
+                             'seconds': 0, 'error': None})
+            continue
+        try:
+            with frame_cache.open_movie(nd2_filename, cache_dir) as movie:
+                n_sites = len(movie)
+                job_memory = max(job_memory, estimate_job_memory(
+                                 movie, plane_cache_size, prefetch_depth))
+        except Exception as e:
+            manifest.append({'nd2': nd2_filename, 'site': None,
+                             'status': 'failed', 'start': None,
+                             'seconds': 0, 'error': repr(e)})
+            continue
+        for site in range(n_sites):
+            jobs.append((nd2_filename, site))
+
+    workers = get_worker_count(workers, job_memory, memory_budget)
+    well_tracks = {}
+    failed_wells = set()
+    if len(jobs) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_job, nd2_filename, site, cache_dir,
+                                   plane_cache_size, prefetch_depth)
+                       for nd2_filename, site in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                tracks = result.pop('tracks')
+                nd2_filename = result['nd2']
+                if result['status'] == 'done':
+                    outfile_name = do_tracking.get_tracks_file_name(
+                                   nd2_filename, output_path,
+                                   result['site'])
+                    tracks.to_csv(outfile_name, index=False)
+                    result['output'] = outfile_name
+                    well_tracks.setdefault(nd2_filename, {})[
+                        result['site']] = tracks
+                else:
+                    failed_wells.add(nd2_filename)
+                    print("Tracking failed: " + nd2_filename + " site "
+                          + str(result['site']) + ": " + result['error'])
+                manifest.append(result)
+
+    # merged well-level tables, only for wells where every site worked
+    for nd2_filename, site_tracks in well_tracks.items():
+        if nd2_filename in failed_wells:
+            continue
+        tracks = do_tracking.merge_site_tracks(site_tracks)
+        tracks.to_csv(do_tracking.get_tracks_file_name(nd2_filename,
+                                                       output_path),
+                      index=False)
+
+    with open(os.path.join(output_path, MANIFEST_FILE), 'w') as f:
+        json.dump({'workers': workers, 'job_memory_bytes': job_memory,
+                   'jobs': manifest}, f, indent=2)
+    return manifest
+
+
+def main():
+    start_time = time.time()
+    args = get_args()
+    nd2_files = find_nd2_files(args.input)
+    if len(nd2_files) == 0:
+        print("No ND2 files found: " + args.input)
+        raise FileNotFoundError
+
+    memory_budget = None
+    if args.memory_gb is not None:
+        memory_budget = args.memory_gb * 1024 ** 3
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    manifest = run_batch(nd2_files, args.output_path, workers=args.workers,
+                         memory_budget=memory_budget, force=args.force,
+                         cache_dir=cache_dir,
+                         plane_cache_size=args.plane_cache_size,
+                         prefetch_depth=args.prefetch_depth)
+
+    n_failed = sum(1 for job in manifest if job['status'] == 'failed')
+    end_time = time.time()
+    execution_time = end_time - start_time
+    print(f"Jobs: {len(manifest)}, failed: {n_failed}")
+    print(f"Execution time: {execution_time} seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,15 @@ import pandas as pd
 import argparse
 import time
 import plots
+import frame_cache
+import seg_cache
+import track_store
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# frames of the site being segmented by a segmentation worker process
+# (set once per process by init_segment_worker)
+segment_worker_state = {}
 
 
 def get_args():
@@ -43,18 +52,522 @@ def get_args():
                         help='Time at which drug was added (in hours)',
                         required=False)
 
+    parser.add_argument('--plane_cache_size',
+                        type=int,
+                        default=read_nd2.DEFAULT_PLANE_CACHE_SIZE,
+                        help='Number of decoded image planes to keep '
+                             'in memory',
+                        required=False)
+
+    parser.add_argument('--all_sites',
+                        action='store_true',
+                        help='Track every site of the well in parallel '
+                             '(one process per site)',
+                        required=False)
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Maximum number of worker processes '
+                             '(default: one per site)',
+                        required=False)
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        default=frame_cache.DEFAULT_CACHE_DIR,
+                        help='Directory of the on-disk frame cache',
+                        required=False)
+    parser.add_argument('--warm_cache',
+                        action='store_true',
+                        help='Convert the ND2 file into the frame cache '
+                             'before tracking',
+                        required=False)
+    parser.add_argument('--no_cache',
+                        action='store_true',
+                        help='Read the ND2 file directly, ignoring the '
+                             'frame cache',
+                        required=False)
+    parser.add_argument('--cache_max_gb',
+                        type=float,
+                        default=frame_cache.DEFAULT_MAX_CACHE_BYTES
+                        / 1024 ** 3,
+                        help='Size cap of the frame cache in GB',
+                        required=False)
+    parser.add_argument('--prefetch_depth',
+                        type=int,
+                        default=1,
+                        help='Number of frames to decode ahead on a '
+                             'background thread (0 disables prefetching)',
+                        required=False)
+    parser.add_argument('--seg_cache_dir',
+                        type=str,
+                        help='Directory of the segmentation cache '
+                             '(segmentations are not cached if not set)',
+                        required=False)
+    parser.add_argument('--seg_cache_max_gb',
+                        type=float,
+                        default=seg_cache.DEFAULT_MAX_CACHE_BYTES
+                        / 1024 ** 3,
+                        help='Size cap of the segmentation cache in GB',
+                        required=False)
+    parser.add_argument('--segment_workers',
+                        type=int,
+                        help='Segment frames in a pool of this many '
+                             'processes while linking runs in frame order',
+                        required=False)
+    parser.add_argument('--linking',
+                        type=str,
+                        choices=['greedy', 'assignment'],
+                        default='greedy',
+                        help='Linking strategy: closest cells (greedy) or '
+                             'a global assignment with birth, death and '
+                             'division costs (assignment)',
+                        required=False)
+    parser.add_argument('--motion',
+                        action='store_true',
+                        help='Link cells around the positions predicted '
+                             'from their velocities',
+                        required=False)
+    parser.add_argument('--divisions',
+                        action='store_true',
+                        help='With greedy linking, add the second '
+                             'closest cell of a cell as its daughter',
+                        required=False)
+    parser.add_argument('--max_gap',
+                        type=int,
+                        help='Reconnect tracks lost for up to this many '
+                             'frames to new cells (gap closing)',
+                        required=False)
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Seed the segmentation of each frame with '
+                             'the tracked positions of the previous frame',
+                        required=False)
+    parser.add_argument('--downsample',
+                        type=int,
+                        help='Segment frames reduced by this factor '
+                             '(e.g. 2 or 4) for fast previews',
+                        required=False)
+    parser.add_argument('--tile_size',
+                        type=int,
+                        help='Segment each frame in overlapping tiles of '
+                             'this size (in pixels) on all cores',
+                        required=False)
+
     args = parser.parse_args()
     return args
 
 
+def iter_frames(site_data):
+    """
+    Streams the frames of a site in order. Once the consumer asks for
+    the next frame, the pixels of the previous frame are released
+    (for LazyMovie frames), so only the frame being tracked is resident.
+
+    Args:
+        site_data: frames of one site (from read_nd2.get_site_data)
+
+    Yields:
+        (frame_num, frame) for every frame in the site
+    """
+    for frame_num in range(len(site_data)):
+        frame = site_data[frame_num]
+        yield frame_num, frame
+        release = getattr(frame, 'release', None)
+        if release is not None:
+            release()
+
+
+def link_frames(frame_cells, distance_threshold=30, linking_params=None):
+    """
+    Serial linking stage: links and corrects the cells of a stream of
+    already segmented frames. Segmenting a frame does not depend on the
+    other frames, so frame_cells can be produced ahead of time (e.g. by
+    segment_frames_parallel); only this stage has to run in frame order.
+
+    Args:
+        frame_cells: iterable of (frame_num, cells) in frame order
+        distance_threshold: how far cells can move across two frames
+            (see tracking_utils.correct_links)
+        linking_params: optional dictionary of
+            tracking_utils.link_frame_cells arguments
+            (e.g. {'strategy': 'assignment', 'motion': True}; motion
+            is also used by tracking_utils.correct_links), and
+            'max_gap': the
+            number of frames lost tracks are kept to be reconnected
+            to new cells (see tracking_utils.LostTracks)
+
+    Yields:
+        (frame_num, master_cells) after each frame has been linked;
+        the tracks are kept in a track_store.TrackStore, and the tracks
+        of earlier frames that are no longer in master_cells (or lost)
+        are freed
+    """
+    if linking_params is None:
+        linking_params = {}
+    linking_params = dict(linking_params)
+    max_gap = linking_params.pop('max_gap', None)
+    lost_tracks = None
+    if max_gap is not None and max_gap > 0:
+        lost_tracks = tracking_utils.LostTracks(max_gap, distance_threshold)
+    # cells marked problematic in the previous frame
+    problematic_cells = {}
+    store = track_store.TrackStore()
+    master_cells = None
+    for frame_num, curr_frame_cells in frame_cells:
+        if master_cells is None:
+            master_cells = store.add_cells(curr_frame_cells)
+        else:
+            master_cells = tracking_utils.link_frame_cells(
+                           master_cells, curr_frame_cells, frame_num,
+                           lost_tracks=lost_tracks, track_store=store,
+                           **linking_params)
+            master_cells = tracking_utils.correct_links(
+                           master_cells,
+                           distance_threshold=distance_threshold,
+                           lost_tracks=lost_tracks,
+                           motion=linking_params.get('motion', False),
+                           problematic_cells=problematic_cells)
+            # free the tracks that were dropped or are no longer lost
+            store.collect(master_cells, problematic_cells,
+                          lost_tracks.tracks if lost_tracks is not None
+                          else [])
+        yield frame_num, master_cells
+
+
+def track_frames(frames, distance_threshold=30, segmentation_cache=None,
+                 segmentation_params=None, incremental=False,
+                 linking_params=None):
+    """
+    Generator pipeline that segments, links and corrects a stream of
+    frames. Only the Cell objects are kept between frames, so memory
+    does not grow with the number of frames.
+
+    Args:
+        frames: iterable of (frame_num, frame) in frame order
+        distance_threshold: see link_frames
+        segmentation_cache: optional seg_cache.SegmentationCache
+        segmentation_params: optional dictionary of segment_frame
+            arguments (e.g. {'tile_size': 512})
+        incremental: seed the segmentation of every frame with the
+            positions of the cells tracked up to the previous frame
+            (see tracking_utils.IncrementalSegmenter)
+        linking_params: see link_frames
+
+    Yields:
+        (frame_num, master_cells) after each frame has been linked
+    """
+    if segmentation_params is None:
+        segmentation_params = {}
+    if not incremental:
+        frame_cells = ((frame_num, tracking_utils.get_frame_cells(
+                        frame, segmentation_cache, **segmentation_params))
+                       for frame_num, frame in frames)
+        yield from link_frames(frame_cells, distance_threshold,
+                               linking_params)
+        return
+
+    segmenter = tracking_utils.IncrementalSegmenter(segmentation_cache,
+                                                    **segmentation_params)
+    master_cells = None
+
+    def seeded_frame_cells():
+        # link_frames only asks for the next frame once the previous one
+        # is linked, so master_cells holds the latest tracks here
+        for frame_num, frame in frames:
+            seeds = None
+            if master_cells is not None:
+                seeds = [cell.get_most_recent_coord()
+                         for cell in master_cells]
+            segmentation = segmenter.segment(frame, seeds)
+            yield frame_num, tracking_utils.cells_from_segmentation(
+                             segmentation)
+
+    for frame_num, master_cells in link_frames(seeded_frame_cells(),
+                                               distance_threshold,
+                                               linking_params):
+        yield frame_num, master_cells
+
+
+def cull_remaining_problematics(master_cells, n_frames):
+    """
+    Culls the cells that are still problematic after the last frame.
+    """
+    if n_frames > 1:
+        remaining_problematics = tracking_utils.get_all_problematics(
+                                 master_cells)
+        if remaining_problematics is not None:
+            master_cells = tracking_utils.cull_duplicates(
+                           master_cells, remaining_problematics)
+    return master_cells
+
+
+def track_site(site_data, distance_threshold=30, prefetch_depth=0,
+               segmentation_cache=None, segmentation_params=None,
+               incremental=False, linking_params=None):
+    """
+    Tracks all cells in one site by streaming its frames
+    through track_frames.
+
+    Args:
+        site_data: frames of one site (from read_nd2.get_site_data)
+        distance_threshold: see track_frames
+        prefetch_depth: number of frames decoded ahead on a background
+            thread while the current frame is tracked (0 disables)
+        segmentation_cache: optional seg_cache.SegmentationCache
+        segmentation_params: see track_frames
+        incremental: see track_frames
+        linking_params: see link_frames
+
+    Returns:
+        master_cells: list of tracked cells
+    """
+    master_cells = []
+    frames = read_nd2.prefetch_frames(iter_frames(site_data),
+                                      depth=prefetch_depth)
+    for frame_num, master_cells in track_frames(frames, distance_threshold,
+                                                segmentation_cache,
+                                                segmentation_params,
+                                                incremental,
+                                                linking_params):
+        pass
+    return cull_remaining_problematics(master_cells, len(site_data))
+
+
+def init_segment_worker(nd2_filename, site, cache_dir, cache_size,
+                        seg_cache_dir, seg_cache_max_bytes):
+    """
+    Opens the movie once in each segmentation worker process
+    (initializer of the pool in segment_frames_parallel).
+    """
+    movie = frame_cache.open_movie(nd2_filename, cache_dir,
+                                   cache_size=cache_size)
+    segment_worker_state['site_data'] = read_nd2.get_site_data(movie, site)
+    segment_worker_state['segmentation_cache'] = None
+    if seg_cache_dir is not None:
+        segment_worker_state['segmentation_cache'] = \
+            seg_cache.SegmentationCache(seg_cache_dir, seg_cache_max_bytes)
+
+
+def segment_site_frame(frame_num, segmentation_params):
+    """
+    Segments one frame in a segmentation worker process.
+
+    Returns:
+        (frame_num, segmentation): the arrays from
+            tracking_utils.segment_frame without the label image,
+            so only a few small arrays are sent back to the linker
+    """
+    frame = segment_worker_state['site_data'][frame_num]
+    try:
+        segmentation = tracking_utils.get_frame_segmentation(
+                       frame, segment_worker_state['segmentation_cache'],
+                       **segmentation_params)
+    finally:
+        release = getattr(frame, 'release', None)
+        if release is not None:
+            release()
+    segmentation = {name: array for name, array in segmentation.items()
+                    if name != 'labels'}
+    return frame_num, segmentation
+
+
+def segment_frames_parallel(nd2_filename, site, n_frames, workers,
+                            cache_dir=None,
+                            cache_size=read_nd2.DEFAULT_PLANE_CACHE_SIZE,
+                            seg_cache_dir=None, seg_cache_max_bytes=None,
+                            segmentation_params=None):
+    """
+    Parallel segmentation stage: segments and measures the frames of a
+    site in a process pool. Every worker opens the file itself and
+    decodes only the frames it segments. At most two frames per worker
+    are in flight, so results never pile up ahead of the linker.
+
+    Args:
+        nd2_filename: path to the ND2 file
+        site: site number to segment
+        n_frames: number of frames in the site
+        workers: number of worker processes
+        cache_dir: frame cache directory (None reads the ND2 directly)
+        cache_size: number of decoded planes kept in memory per worker
+        seg_cache_dir: segmentation cache directory (None disables it)
+        seg_cache_max_bytes: size cap of the segmentation cache
+            (default seg_cache.DEFAULT_MAX_CACHE_BYTES)
+        segmentation_params: see track_frames
+
+    Yields:
+        (frame_num, segmentation) in frame order
+    """
+    if seg_cache_max_bytes is None:
+        seg_cache_max_bytes = seg_cache.DEFAULT_MAX_CACHE_BYTES
+    if segmentation_params is None:
+        segmentation_params = {}
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_segment_worker,
+                             initargs=(nd2_filename, site, cache_dir,
+                                       cache_size, seg_cache_dir,
+                                       seg_cache_max_bytes)) as pool:
+        pending = deque()
+        next_frame = 0
+        while next_frame < n_frames or len(pending) > 0:
+            while next_frame < n_frames and len(pending) < 2 * workers:
+                pending.append(pool.submit(segment_site_frame, next_frame,
+                                           segmentation_params))
+                next_frame += 1
+            yield pending.popleft().result()
+
+
+def track_site_file(nd2_filename, site, distance_threshold=30,
+                    cache_size=read_nd2.DEFAULT_PLANE_CACHE_SIZE,
+                    cache_dir=None, prefetch_depth=0, seg_cache_dir=None,
+                    seg_cache_max_bytes=seg_cache.DEFAULT_MAX_CACHE_BYTES,
+                    segmentation_params=None, segment_workers=None,
+                    incremental=False, linking_params=None):
+    """
+    Opens an ND2 file and tracks a single site. Only the planes of the
+    given site are decoded, so this can be run in its own process for
+    every site of a well.
+
+    Args:
+        nd2_filename: path to the ND2 file
+        site: site number to track
+        distance_threshold: see track_frames
+        cache_size: number of decoded planes kept in memory
+        cache_dir: frame cache directory (None reads the ND2 directly)
+        prefetch_depth: see track_site
+        seg_cache_dir: segmentation cache directory (None disables it)
+        seg_cache_max_bytes: size cap of the segmentation cache
+        segmentation_params: see track_frames
+        segment_workers: segment the frames in a pool of this many
+            processes (see segment_frames_parallel) while they are
+            linked in frame order; None segments them one by one
+        incremental: see track_frames (frames are then segmented one by
+            one, since each frame is seeded by the previous tracks)
+        linking_params: see link_frames
+
+    Returns:
+        tracks: dataframe with the tracks and fluorescent data
+            for the site (see plots.create_tracks_dataframe)
+    """
+    with frame_cache.open_movie(nd2_filename, cache_dir,
+                                cache_size=cache_size) as movie:
+        site_data = read_nd2.get_site_data(movie, site)
+        if segment_workers is not None and segment_workers > 1 and \
+                not incremental:
+            segmentations = segment_frames_parallel(
+                            nd2_filename, site, len(site_data),
+                            segment_workers, cache_dir, cache_size,
+                            seg_cache_dir, seg_cache_max_bytes,
+                            segmentation_params)
+            frame_cells = ((frame_num,
+                            tracking_utils.cells_from_segmentation(
+                                segmentation))
+                           for frame_num, segmentation in segmentations)
+            master_cells = []
+            for frame_num, master_cells in link_frames(frame_cells,
+                                                       distance_threshold,
+                                                       linking_params):
+                pass
+            master_cells = cull_remaining_problematics(master_cells,
+                                                       len(site_data))
+        else:
+            segmentation_cache = None
+            if seg_cache_dir is not None:
+                segmentation_cache = seg_cache.SegmentationCache(
+                                     seg_cache_dir, seg_cache_max_bytes)
+            master_cells = track_site(site_data, distance_threshold,
+                                      prefetch_depth, segmentation_cache,
+                                      segmentation_params, incremental,
+                                      linking_params)
+        tracks = plots.create_tracks_dataframe(master_cells,
+                                               site_data, 'channel2_data',
+                                               'channel3_data')
+    return tracks
+
+
+def track_all_sites(nd2_filename, workers=None, distance_threshold=30,
+                    cache_size=read_nd2.DEFAULT_PLANE_CACHE_SIZE,
+                    cache_dir=None, prefetch_depth=0, seg_cache_dir=None,
+                    seg_cache_max_bytes=seg_cache.DEFAULT_MAX_CACHE_BYTES,
+                    segmentation_params=None, segment_workers=None,
+                    incremental=False, linking_params=None):
+    """
+    Tracks every site of a well in a process pool (one worker per site).
+    Sites are independent, so each worker opens the file itself and
+    only reads the planes of its own site.
+
+    Args:
+        nd2_filename: path to the ND2 file
+        workers: maximum number of worker processes
+            (default: one per site)
+        distance_threshold: see track_frames
+        cache_size: number of decoded planes kept in memory per worker
+        cache_dir: frame cache directory (None reads the ND2 directly)
+        prefetch_depth: see track_site
+        seg_cache_dir: segmentation cache directory (None disables it)
+        seg_cache_max_bytes: size cap of the segmentation cache
+        segmentation_params: see track_frames
+        segment_workers: see track_site_file
+        incremental: see track_frames
+        linking_params: see link_frames
+
+    Returns:
+        site_tracks: dictionary of site number --> tracks dataframe
+    """
+    with frame_cache.open_movie(nd2_filename, cache_dir) as movie:
+        n_sites = len(movie)
+    if workers is None:
+        workers = n_sites
+
+    site_tracks = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {site: pool.submit(track_site_file, nd2_filename, site,
+                                     distance_threshold, cache_size,
+                                     cache_dir, prefetch_depth,
+                                     seg_cache_dir, seg_cache_max_bytes,
+                                     segmentation_params, segment_workers,
+                                     incremental, linking_params)
+                   for site in range(n_sites)}
+        for site, future in futures.items():
+            site_tracks[site] = future.result()
+    return site_tracks
+
+
+def merge_site_tracks(site_tracks):
+    """
+    Merges the tracks of all sites of a well into one table.
+
+    Args:
+        site_tracks: dictionary of site number --> tracks dataframe
+
+    Returns:
+        well_tracks: dataframe with a 'site' column, where cell IDs are
+            qualified by their site ('<site>_<cell>') so they are unique
+            across the well
+    """
+    merged = []
+    for site in sorted(site_tracks):
+        tracks = site_tracks[site].copy()
+        tracks.insert(0, 'site', site)
+        tracks['cell'] = str(site) + '_' + tracks['cell'].astype(str)
+        merged.append(tracks)
+    if len(merged) == 0:
+        return pd.DataFrame()
+    well_tracks = pd.concat(merged, ignore_index=True)
+    return well_tracks
+
+
+def get_tracks_file_name(nd2_filename, output_path, site=None):
+    """
+    Builds the name of the output CSV for a well (or one of its sites).
+    """
+    well_name = os.path.basename(nd2_filename).replace('.nd2', '')
+    if site is not None:
+        well_name += '_site' + str(site)
+    return output_path + '/' + well_name + "_tracks.csv"
+
+
 def main():
     start_time = time.time()
     args = get_args()
     nd2 = args.file_path
-    movie = read_nd2.read_nd2(nd2)
-    site0 = read_nd2.get_site_data(movie, 0)
-    frame0 = read_nd2.get_frame_data(movie, 0, 0)
-    master_cells = tracking_utils.do_watershed(frame0)
 
     if args.time_step is None:
         args.time_step = 1
@@ -65,38 +578,55 @@ def main():
     if args.make_channel2_plots is None:
         args.make_channel2_plots = True
 
-    # loop over remaining frames and do track linking
-    numcells = []
-    for i in range(1, len(site0)):
-        cur_frame = read_nd2.get_frame_data(movie, 0, i)
-        cur_frame_nuc = read_nd2.get_channel_rawData(movie, 0,
-                                                     i, 0)
-        curr_nuc_rbg = np.dstack((cur_frame_nuc, cur_frame_nuc,
-                                  cur_frame_nuc))
-
-        curr_nuc_rbg = cv2.normalize(curr_nuc_rbg, None, 0, 255,
-                                     cv2.NORM_MINMAX, dtype=cv2.CV_8U)
-
-        master_cells = tracking_utils.link_next_frame(master_cells,
-                                                      cur_frame, i)
-        master_cells = tracking_utils.correct_links(master_cells,
-                                                    distance_threshold=30)
-
-        if i == (len(site0)-1):
-            # cull remaining problematic cells from last frame
-            remaining_problematics = tracking_utils.get_all_problematics(
-                                     master_cells)
-            master_cells = tracking_utils.cull_duplicates(
-                           master_cells, remaining_problematics)
+    cache_dir = None if args.no_cache else args.cache_dir
+    if args.warm_cache and cache_dir is not None:
+        frame_cache.warm_cache(nd2, cache_dir,
+                               max_bytes=int(args.cache_max_gb * 1024 ** 3))
 
-        numcells.append(len(master_cells))
+    seg_cache_bytes = int(args.seg_cache_max_gb * 1024 ** 3)
+    segmentation_params = {}
+    if args.tile_size is not None:
+        segmentation_params['tile_size'] = args.tile_size
+    if args.downsample is not None and args.downsample > 1:
+        segmentation_params['downsample'] = args.downsample
+    linking_params = {'strategy': args.linking}
+    if args.max_gap is not None:
+        linking_params['max_gap'] = args.max_gap
+    if args.motion:
+        linking_params['motion'] = True
+    if args.divisions:
+        linking_params['divisions'] = True
 
-    remaining_death_row = tracking_utils.get_all_death_row(master_cells)
     os.makedirs(args.output_path, exist_ok=True)
-    # create a dataframe with the tracks and fluorescent data
-    tracks = plots.create_tracks_dataframe(master_cells,
-                                           site0, 'channel2_data',
-                                           'channel3_data')
+    if args.all_sites:
+        site_tracks = track_all_sites(nd2, workers=args.workers,
+                                      distance_threshold=30,
+                                      cache_size=args.plane_cache_size,
+                                      cache_dir=cache_dir,
+                                      prefetch_depth=args.prefetch_depth,
+                                      seg_cache_dir=args.seg_cache_dir,
+                                      seg_cache_max_bytes=seg_cache_bytes,
+                                      segmentation_params=segmentation_params,
+                                      segment_workers=args.segment_workers,
+                                      incremental=args.incremental,
+                                      linking_params=linking_params)
+        for site, site_df in site_tracks.items():
+            site_df.to_csv(get_tracks_file_name(nd2, args.output_path,
+                                                site),
+                           index=False)
+        tracks = merge_site_tracks(site_tracks)
+    else:
+        # create a dataframe with the tracks and fluorescent data
+        tracks = track_site_file(nd2, 0, distance_threshold=30,
+                                 cache_size=args.plane_cache_size,
+                                 cache_dir=cache_dir,
+                                 prefetch_depth=args.prefetch_depth,
+                                 seg_cache_dir=args.seg_cache_dir,
+                                 seg_cache_max_bytes=seg_cache_bytes,
+                                 segmentation_params=segmentation_params,
+                                 segment_workers=args.segment_workers,
+                                 incremental=args.incremental,
+                                 linking_params=linking_params)
 
     channel3_output = args.output_path + "/channel3_plots"
     if args.make_channel3_plots:
@@ -109,10 +639,7 @@ def main():
                                   args.time_step, channel2_output)
 
     # Save the DataFrame to a CSV file
-    well_name = os.path.basename(nd2)
-    outfile_name = args.output_path + '/' + well_name + "_tracks.csv"
-    outfile_name = outfile_name.replace('.nd2', '')
-
+    outfile_name = get_tracks_file_name(nd2, args.output_path)
     tracks.to_csv(outfile_name, index=False)
 
     end_time = time.time()
@@ -0,0 +1,232 @@
+"""On-disk frame cache for ND2 files.
+
+An ND2 file is converted once into a store with one .npy chunk per
+site/frame/channel plane. Later runs memory-map the chunks instead of
+decoding the ND2 again, so repeated runs on the same file (e.g. when
+tuning tracking thresholds) skip the nd2reader decode entirely.
+
+    * get_cache_key - key for an ND2 file based on its path, size
+                and modification time
+    * get_store_path - directory of the cached store for an ND2 file
+    * write_store - write every plane of a movie into a store
+    * open_store - open a cached store as a LazyMovie
+    * evict_cache - remove least recently used stores until the
+                cache is under a size cap
+    * warm_cache - convert an ND2 file into a cached store
+    * open_movie - open an ND2 file from the cache if possible,
+                otherwise directly from the ND2 file
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import read_nd2
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'cell_tracking')
+DEFAULT_MAX_CACHE_BYTES = 20 * 1024 ** 3
+META_FILE = 'meta.json'
+
+
+def get_cache_key(nd2_filename):
+    """
+    Gets the cache key for an ND2 file. The key changes whenever the file
+    is moved, resized or modified, so stale stores are never used.
+
+    Args:
+        nd2_filename: path to the ND2 file
+
+    Returns:
+        key: hex digest identifying the file
+    """
+    stat = os.stat(nd2_filename)
+    identity = '|'.join([os.path.abspath(nd2_filename),
+                         str(stat.st_size), str(stat.st_mtime_ns)])
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def get_store_path(nd2_filename, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Gets the directory of the cached store for an ND2 file.
+    """
+    return os.path.join(cache_dir, get_cache_key(nd2_filename))
+
+
+def get_chunk_path(store_path, site, frame, channel):
+    """
+    Gets the file name of the chunk for one site/frame/channel plane.
+    """
+    chunk_name = 's' + str(site) + '_t' + str(frame) + '_c' + str(channel)
+    return os.path.join(store_path, chunk_name + '.npy')
+
+
+def write_store(movie, store_path, source=None):
+    """
+    Writes every plane of a movie into a store, one chunk per
+    site/frame/channel. The metadata file is written last, so a store
+    is only used once it is complete.
+
+    Args:
+        movie: LazyMovie to convert
+        store_path: directory to write the store to
+        source: optional description of the source file
+    """
+    os.makedirs(store_path, exist_ok=True)
+    for site in range(movie.n_sites):
+        for frame in range(movie.n_frames):
+            for channel in range(movie.n_channels):
+                plane = movie.get_plane(site, frame, channel)
+                chunk_path = get_chunk_path(store_path, site, frame,
+                                            channel)
+                tmp_path = chunk_path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, plane)
+                os.replace(tmp_path, chunk_path)
+            movie.release(site, frame)
+
+    meta = {'sizes': {'v': movie.n_sites, 't': movie.n_frames,
+                      'c': movie.n_channels, 'y': movie.height,
+                      'x': movie.width},
+            'source': source}
+    tmp_path = os.path.join(store_path, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(store_path, META_FILE))
+
+
+def open_store(store_path, cache_size=read_nd2.DEFAULT_PLANE_CACHE_SIZE):
+    """
+    Opens a cached store as a LazyMovie. Chunks are memory-mapped,
+    so planes are read from disk without copying.
+
+    Args:
+        store_path: directory of the store
+        cache_size: number of planes kept in the LazyMovie cache
+
+    Returns:
+        movie: LazyMovie backed by the store, or None if the store
+            does not exist or is incomplete
+    """
+    meta_path = os.path.join(store_path, META_FILE)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    # mark the store as recently used for eviction
+    os.utime(meta_path)
+
+    def plane_reader(site, frame, channel):
+        return np.load(get_chunk_path(store_path, site, frame, channel),
+                       mmap_mode='r')
+
+    return read_nd2.LazyMovie(plane_reader, meta['sizes'],
+                              cache_size=cache_size)
+
+
+def get_store_size(store_path):
+    """
+    Gets the total size in bytes of all files in a store.
+    """
+    size = 0
+    for entry in os.scandir(store_path):
+        if entry.is_file():
+            size += entry.stat().st_size
+    return size
+
+
+def evict_cache(cache_dir=DEFAULT_CACHE_DIR,
+                max_bytes=DEFAULT_MAX_CACHE_BYTES, keep=None):
+    """
+    Removes the least recently used stores until the cache is no larger
+    than max_bytes. Incomplete stores are treated as least recently used.
+
+    Args:
+        cache_dir: directory of the cache
+        max_bytes: size cap for the cache in bytes
+        keep: optional store path that should never be removed
+
+    Returns:
+        removed: list of removed store paths
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+
+    stores = []
+    total_size = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir():
+            continue
+        meta_path = os.path.join(entry.path, META_FILE)
+        try:
+            last_used = os.stat(meta_path).st_mtime
+        except FileNotFoundError:
+            last_used = 0
+        size = get_store_size(entry.path)
+        total_size += size
+        stores.append((last_used, entry.path, size))
+
+    removed = []
+    for last_used, store_path, size in sorted(stores):
+        if total_size <= max_bytes:
+            break
+        if keep is not None and \
+                os.path.abspath(store_path) == os.path.abspath(keep):
+            continue
+        shutil.rmtree(store_path, ignore_errors=True)
+        total_size -= size
+        removed.append(store_path)
+    return removed
+
+
+def warm_cache(nd2_filename, cache_dir=DEFAULT_CACHE_DIR,
+               max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Converts an ND2 file into a cached store (if it is not cached yet)
+    and evicts old stores to stay under the size cap.
+
+    Args:
+        nd2_filename: path to the ND2 file
+        cache_dir: directory of the cache
+        max_bytes: size cap for the cache in bytes
+
+    Returns:
+        store_path: directory of the store for the ND2 file
+    """
+    store_path = get_store_path(nd2_filename, cache_dir)
+    if not os.path.exists(os.path.join(store_path, META_FILE)):
+        # decode plane by plane, nothing needs to be kept in memory
+        with read_nd2.open_nd2(nd2_filename, cache_size=0) as movie:
+            write_store(movie, store_path,
+                        source=os.path.abspath(nd2_filename))
+    evict_cache(cache_dir, max_bytes, keep=store_path)
+    return store_path
+
+
+def open_movie(nd2_filename, cache_dir=None,
+               cache_size=read_nd2.DEFAULT_PLANE_CACHE_SIZE):
+    """
+    Opens an ND2 file, reading from the frame cache if the file has
+    already been converted.
+
+    Args:
+        nd2_filename: path to the ND2 file
+        cache_dir: directory of the cache (None bypasses the cache)
+        cache_size: number of planes kept in the LazyMovie cache
+
+    Returns:
+        movie: LazyMovie for the ND2 file
+    """
+    if cache_dir is not None:
+        try:
+            store_path = get_store_path(nd2_filename, cache_dir)
+        except FileNotFoundError:
+            print("File not found: " + nd2_filename)
+            raise FileNotFoundError
+        movie = open_store(store_path, cache_size=cache_size)
+        if movie is not None:
+            return movie
+    return read_nd2.open_nd2(nd2_filename, cache_size=cache_size)
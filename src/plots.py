@@ -3,6 +3,7 @@ import numpy as np
 import os
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
+from track_store import TrackCell
 
 
 def create_tracks_dataframe(master_cells, site, channel2, channel3):
@@ -22,6 +23,20 @@ def create_tracks_dataframe(master_cells, site, channel2, channel3):
     # Create an empty array with the specified dtype
     tracks = np.empty((len(master_cells) * len(site) + 1,), dtype=dtype)
 
+    # tracks of one TrackStore are read from its columns at once
+    stores = {getattr(cell, 'store', None) for cell in master_cells}
+    if (len(master_cells) > 0 and len(stores) == 1 and
+            all(isinstance(cell, TrackCell) for cell in master_cells)):
+        histories = stores.pop().get_histories(master_cells, len(site))
+        tracks['cell'][1:] = np.repeat(
+            np.arange(len(master_cells)).astype(str), len(site))
+        tracks['x'][1:] = histories['x'].ravel().astype(int)
+        tracks['y'][1:] = histories['y'].ravel().astype(int)
+        tracks['t'][1:] = np.tile(np.arange(len(site)), len(master_cells))
+        tracks[channel2][1:] = histories['channel2_data'].ravel()
+        tracks[channel3][1:] = histories['channel3_data'].ravel()
+        return pd.DataFrame(tracks[1:])
+
     # Populate the 'tracks' array
     tracks['cell'][1:] = [str(i)
                           for i in range(len(master_cells))
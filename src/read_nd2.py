@@ -1,21 +1,38 @@
 """Functions to read in an ND2 file with multiple channels and sites
 
     * read_nd2 - read in an ND2 file with multiple channels and sites
-                and output a dictionary with pixel values for each
-                site/frame/channel
+                (or a subset of the channels) and output a dictionary
+                with pixel values for each site/frame/channel
     * get_channel_rawData - return pixel values for a given
                 site/frame/channel in a 2022 x 2044 array
     * get_frame_data - return a dictionary of pixels for all channels
                 for a given site/frame
     * get_site_data - return a dictionary of pixels for all frames and
             channels for a given site
+    * open_nd2 - open an ND2 file as a LazyMovie that decodes each
+            site/frame/channel plane only when it is accessed
+    * PlaneStack - the channels of one site/frame as separate planes
+    * load_frame - decode the channels of a frame into a PlaneStack
+    * prefetch_frames - decode upcoming frames on a background thread
+            while the current frame is being processed
+    * LazyMovie - movie object with the same site/frame/channel access
+            pattern as the read_nd2 dictionary, backed by a bounded
+            LRU cache of decoded planes
 """
 
+from collections import OrderedDict
+import queue
+import threading
+
 import nd2reader
 import numpy as np
 
+# number of decoded 2D planes kept in memory by a LazyMovie
+# (one frame of a three channel movie is three planes)
+DEFAULT_PLANE_CACHE_SIZE = 12
+
 
-def read_nd2(nd2_filename):
+def read_nd2(nd2_filename, channels=None):
     """Read in an ND2 file with multiple channels and sites and output a
             dictionary with pixel values for each site/frame/channel.
 
@@ -26,35 +43,33 @@ def read_nd2(nd2_filename):
                     The main repo directory for this file will be specified
                     using a separate function, so this parameter should only
                     include the file path from the main repo.
+    channels: optional list of channel numbers to read. Channels that are
+                    not listed are never decoded (default: all channels).
 
     Returns
     -------
     well_data: a dictionary with the format:
                 well --> site --> frame[channels]
-                frame contains one 2048 x 2044 2D array for each channel,
-                    with values for each of the pixels
+                frame is a PlaneStack with one 2048 x 2044 2D array for
+                    each channel that was read, with values for each of
+                    the pixels
                 the components of this dictionary can be accessed using:
-                    well_data[site][frame][channel]
+                    well_data[site][frame][:, :, channel]
     """
     try:
         with nd2reader.ND2Reader(nd2_filename) as nd2_movie:
-            nd2_movie.iter_axes = 'v'
+            n_channels = nd2_movie.sizes.get('c', 1)
+            if channels is None:
+                channels = range(n_channels)
             well_data = {}
-            for fov in range(nd2_movie.sizes['v']):
+            for fov in range(nd2_movie.sizes.get('v', 1)):
                 frame_data = {}
-                nd2_movie.iter_axes = 't'
-                for f in range(nd2_movie.sizes['t']):
-                    nd2_movie.iter_axes = 'c'
-                    channel_data = []
-                    for c in range(nd2_movie.sizes['c']):
-                        nd2_movie.default_coords['v'] = fov
-                        nd2_movie.default_coords['t'] = f
-                        nd2_movie.default_coords['c'] = c
-                        channel_data.append(nd2_movie[c])
-
-                    channel_data = np.array(channel_data)
-                    channel_data = channel_data.transpose((1, 2, 0))
-                    frame_data[f] = channel_data
+                for f in range(nd2_movie.sizes.get('t', 1)):
+                    planes = {}
+                    for c in channels:
+                        planes[c] = np.asarray(
+                                    nd2_movie.get_frame_2D(c=c, t=f, v=fov))
+                    frame_data[f] = PlaneStack(planes, n_channels)
                 well_data[fov] = frame_data
     except nd2reader.exceptions.InvalidFileType:
         print("Invalid file type: " + nd2_filename)
@@ -153,3 +168,319 @@ def get_site_data(well_data, site):
     except KeyError:
         print("Invalid site: " + str(site))
         raise
+
+
+class PlaneStack:
+    """The channels of a single site/frame, kept as separate 2D planes.
+
+    Supports the same indexing as an H x W x C array for single channels
+    (stack[:, :, channel] or stack[y0:y1, x0:x1, channel]), without
+    interleaving the channels into one array.
+
+    Parameters
+    ----------
+    planes: dictionary of channel number --> 2D array
+    n_channels: total number of channels in the movie
+    """
+
+    def __init__(self, planes, n_channels):
+        self.planes = planes
+        self.n_channels = n_channels
+
+    def get_channel(self, channel):
+        """Return the 2D plane for a channel."""
+        try:
+            return self.planes[channel]
+        except KeyError:
+            raise IndexError("channel " + str(channel) + " not loaded")
+
+    @property
+    def shape(self):
+        # every plane has the same size, and any channel may be missing
+        height, width = next(iter(self.planes.values())).shape
+        return (height, width, self.n_channels)
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 3 and \
+                isinstance(key[2], (int, np.integer)):
+            plane = self.get_channel(key[2])
+            return plane[key[0], key[1]]
+        # any other indexing needs every channel
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        planes = [self.get_channel(c) for c in range(self.n_channels)]
+        stacked = np.dstack(planes)
+        if dtype is not None:
+            stacked = stacked.astype(dtype)
+        return stacked
+
+
+class LazyFrame(PlaneStack):
+    """A single site/frame of a LazyMovie.
+
+    Supports the same indexing as the frames returned by read_nd2
+    (frame[:, :, channel]), but only decodes the requested channel.
+    """
+
+    def __init__(self, movie, site, frame):
+        self.movie = movie
+        self.site = site
+        self.frame = frame
+        self.n_channels = movie.n_channels
+
+    def get_channel(self, channel):
+        return self.movie.get_plane(self.site, self.frame, channel)
+
+    @property
+    def shape(self):
+        return (self.movie.height, self.movie.width, self.movie.n_channels)
+
+    def release(self):
+        """Drop the decoded planes of this frame from the cache."""
+        self.movie.release(self.site, self.frame)
+
+
+class LazySite:
+    """All frames of a single site of a LazyMovie.
+
+    Behaves like the site --> frame dictionary returned by read_nd2:
+    len() is the number of frames and site[frame] returns a LazyFrame.
+    """
+
+    def __init__(self, movie, site):
+        self.movie = movie
+        self.site = site
+
+    def __len__(self):
+        return self.movie.n_frames
+
+    def __iter__(self):
+        return iter(range(self.movie.n_frames))
+
+    def __contains__(self, frame):
+        return 0 <= frame < self.movie.n_frames
+
+    def __getitem__(self, frame):
+        if frame not in self:
+            raise KeyError(frame)
+        return LazyFrame(self.movie, self.site, frame)
+
+    def keys(self):
+        return range(self.movie.n_frames)
+
+
+class LazyMovie:
+    """Movie whose planes are decoded on first access.
+
+    A LazyMovie can be used anywhere the well_data dictionary returned
+    by read_nd2 is used (movie[site][frame][:, :, channel] and the
+    get_site_data / get_frame_data / get_channel_rawData helpers), but
+    only the planes that are touched are decoded. The most recently used
+    planes are kept in a bounded LRU cache so memory does not grow with
+    movie length.
+
+    Parameters
+    ----------
+    plane_reader: function with the signature
+                    plane_reader(site, frame, channel)
+                    that returns a 2D array with the pixel values
+                    for the given site/frame/channel
+    sizes: dictionary with the number of sites ('v'), frames ('t'),
+            channels ('c') and the plane height ('y') and width ('x')
+    cache_size: maximum number of decoded planes kept in memory
+    close: optional function called when the movie is closed
+    """
+
+    def __init__(self, plane_reader, sizes,
+                 cache_size=DEFAULT_PLANE_CACHE_SIZE, close=None):
+        self.plane_reader = plane_reader
+        self.n_sites = sizes.get('v', 1)
+        self.n_frames = sizes.get('t', 1)
+        self.n_channels = sizes.get('c', 1)
+        self.height = sizes['y']
+        self.width = sizes['x']
+        self.cache_size = cache_size
+        self._close = close
+        self._planes = OrderedDict()
+        # planes may be decoded from a prefetch thread
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.n_sites
+
+    def __iter__(self):
+        return iter(range(self.n_sites))
+
+    def __contains__(self, site):
+        return 0 <= site < self.n_sites
+
+    def __getitem__(self, site):
+        if site not in self:
+            raise KeyError(site)
+        return LazySite(self, site)
+
+    def keys(self):
+        return range(self.n_sites)
+
+    def get_plane(self, site, frame, channel):
+        """Return the 2D plane for a site/frame/channel, decoding it
+        if it is not already in the cache.
+        """
+        if site not in self:
+            raise KeyError(site)
+        if not 0 <= frame < self.n_frames:
+            raise KeyError(frame)
+        if not 0 <= channel < self.n_channels:
+            raise IndexError("channel " + str(channel) + " out of range")
+
+        key = (site, frame, channel)
+        with self._lock:
+            if key in self._planes:
+                self._planes.move_to_end(key)
+                return self._planes[key]
+
+            plane = np.asarray(self.plane_reader(site, frame, channel))
+            if self.cache_size > 0:
+                self._planes[key] = plane
+                while len(self._planes) > self.cache_size:
+                    self._planes.popitem(last=False)
+        return plane
+
+    def release(self, site, frame):
+        """Drop all cached planes for a site/frame."""
+        with self._lock:
+            for channel in range(self.n_channels):
+                self._planes.pop((site, frame, channel), None)
+
+    def close(self):
+        with self._lock:
+            self._planes.clear()
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_nd2(nd2_filename, cache_size=DEFAULT_PLANE_CACHE_SIZE):
+    """Open an ND2 file as a LazyMovie. Planes are decoded from the file
+            only when they are accessed.
+
+    Parameters
+    ----------
+    nd2_filename: File name for nd2 file (see read_nd2)
+    cache_size: maximum number of decoded planes kept in memory
+
+    Returns
+    -------
+    movie: a LazyMovie that can be accessed in the same way as the
+            dictionary returned by read_nd2:
+                movie[site][frame][:, :, channel]
+            The movie keeps the file open until movie.close() is called.
+    """
+    try:
+        nd2_movie = nd2reader.ND2Reader(nd2_filename)
+    except nd2reader.exceptions.InvalidFileType:
+        print("Invalid file type: " + nd2_filename)
+        raise nd2reader.exceptions.InvalidFileType
+    except FileNotFoundError:
+        print("File not found: " + nd2_filename)
+        raise FileNotFoundError
+
+    def plane_reader(site, frame, channel):
+        return nd2_movie.get_frame_2D(c=channel, t=frame, v=site)
+
+    sizes = dict(nd2_movie.sizes)
+    return LazyMovie(plane_reader, sizes, cache_size=cache_size,
+                     close=nd2_movie.close)
+
+
+def load_frame(frame, channels=None):
+    """Decode the channels of a frame into a PlaneStack.
+
+    Parameters
+    ----------
+    frame: a frame (H x W x C array, PlaneStack or LazyFrame)
+    channels: optional list of channels to load (default: all channels)
+
+    Returns
+    -------
+    stack: a PlaneStack holding the decoded planes
+    """
+    n_channels = frame.shape[2]
+    if channels is None:
+        channels = range(n_channels)
+    planes = {c: frame[:, :, c] for c in channels}
+    return PlaneStack(planes, n_channels)
+
+
+def prefetch_frames(frames, depth=1, channels=None):
+    """Decode upcoming frames on a background thread while the
+            consumer is working on the current frame.
+
+    Parameters
+    ----------
+    frames: iterable of (frame_num, frame) pairs, e.g.
+                do_tracking.iter_frames(site_data)
+    depth: number of decoded frames that can wait in the read-ahead
+                queue. Memory use is bounded by depth + 2 frames.
+                A depth of 0 disables prefetching.
+    channels: optional list of channels to decode (default: all channels)
+
+    Returns
+    -------
+    generator of (frame_num, frame) pairs in the same order as frames,
+        where each frame is a PlaneStack with its planes already decoded
+    """
+    if depth <= 0:
+        yield from frames
+        return
+
+    read_ahead = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        # give up if the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                read_ahead.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for frame_num, frame in frames:
+                if not put((frame_num, load_frame(frame, channels))):
+                    return
+            put(finished)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = read_ahead.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
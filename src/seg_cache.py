@@ -0,0 +1,144 @@
+"""Content-addressed cache of frame segmentations.
+
+Segmentations are keyed by a hash of the frame's pixels and the
+segmentation parameters, so re-running the tracking with different
+linking parameters (e.g. distance thresholds) skips the watershed for
+every frame that has been segmented before, whatever file it came from.
+Each entry stores the label image, nucleus centers, bounding rectangles
+and channel measurements from tracking_utils.segment_frame in a
+compressed .npz file (see tracking_utils.get_frame_cells).
+
+    * get_segmentation_key - key for a frame and segmentation parameters
+    * SegmentationCache - on-disk cache with size-based eviction
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+DEFAULT_MAX_CACHE_BYTES = 5 * 1024 ** 3
+# version of the segmentation code, part of every key so changes to
+# the segmentation invalidate old entries
+SEGMENTATION_VERSION = 2
+# channels whose pixels are used by segment_frame
+SEGMENTATION_CHANNELS = (0, 1, 2)
+
+
+def get_segmentation_key(frame, **params):
+    """
+    Gets the cache key for a frame: a hash of the pixels of the channels
+    used by the segmentation plus the segmentation parameters.
+
+    Args:
+        frame: frame to segment
+        params: segmentation parameters (e.g. area_threshold)
+
+    Returns:
+        key: hex digest identifying the frame and parameters
+    """
+    frame_hash = hashlib.blake2b(digest_size=20)
+    frame_hash.update(repr((SEGMENTATION_VERSION,
+                            sorted(params.items()))).encode())
+    for channel in SEGMENTATION_CHANNELS:
+        plane = np.ascontiguousarray(frame[:, :, channel])
+        frame_hash.update(repr((plane.shape, plane.dtype.str)).encode())
+        frame_hash.update(plane.data)
+    return frame_hash.hexdigest()
+
+
+class SegmentationCache:
+    """On-disk cache of segment_frame results with size-based eviction.
+
+    Args:
+        cache_dir: directory to store the entries in
+        max_bytes: size cap in bytes; the least recently used entries
+            are removed when the cache grows beyond it
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, _, size in self.get_entries())
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get_entries(self):
+        """
+        Lists the cached entries.
+
+        Returns:
+            entries: list of (last used time, path, size in bytes)
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def get(self, key):
+        """
+        Gets a cached segmentation.
+
+        Returns:
+            segmentation: dictionary of arrays (see segment_frame),
+                or None if the key is not cached
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as entry:
+                segmentation = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # mark the entry as recently used for eviction; another process
+        # may have evicted it since it was read
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return segmentation
+
+    def put(self, key, segmentation):
+        """
+        Stores a segmentation and evicts old entries if the cache
+        is over its size cap.
+        """
+        path = self.get_path(key)
+        # one temporary file per process, as the cache directory can be
+        # shared by several processes writing the same entry
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **segmentation)
+        os.replace(tmp_path, path)
+        try:
+            self.size += os.path.getsize(path)
+        except FileNotFoundError:
+            # already evicted by another process
+            pass
+        if self.size > self.max_bytes:
+            self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is no
+        larger than its size cap.
+        """
+        entries = self.get_entries()
+        self.size = sum(size for _, _, size in entries)
+        for last_used, path, size in sorted(entries):
+            if self.size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,120 @@
+"""Accuracy of downsampled (multi-resolution) segmentation.
+
+Segments images at full resolution and with segment_frame's downsample
+factors, and reports how many of the full resolution nuclei are found
+by each reduced segmentation (see tracking_utils.compare_segmentations).
+
+    * load_image - read an image file as a 3-channel frame
+    * report_accuracy - compare downsampled with full resolution
+                segmentations of a list of images
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+import tracking_utils
+
+
+def get_args():
+    """Collect images and downsampling factors
+
+    Returns
+    -------
+    args: arguments input by the user
+    """
+    parser = argparse.ArgumentParser(description='report the accuracy of '
+                                     'downsampled segmentation',
+                                     prog='segmentation_accuracy')
+    parser.add_argument('--images',
+                        type=str,
+                        nargs='+',
+                        default=['test/data/*.png', 'test/data/*.tif'],
+                        help='Image files or globs to segment',
+                        required=False)
+    parser.add_argument('--downsample',
+                        type=int,
+                        nargs='+',
+                        default=[2, 4],
+                        help='Downsampling factors to compare',
+                        required=False)
+
+    args = parser.parse_args()
+    return args
+
+
+def load_image(image_path):
+    """
+    Reads an image file as a frame with (at least) three channels.
+    Single channel images are used for every channel.
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        print("Could not read image: " + image_path)
+        raise FileNotFoundError
+    if image.ndim == 2:
+        image = np.dstack((image, image, image))
+    return image
+
+
+def report_accuracy(image_paths, factors=(2, 4)):
+    """
+    Segments every image at full resolution and with every downsampling
+    factor. Nuclei are matched within 2 * factor + 1 pixels, since
+    centers found on the reduced image are only known to within
+    a factor x factor block.
+
+    Args:
+        image_paths: list of image files
+        factors: downsampling factors to compare
+
+    Returns:
+        rows: list of dictionaries with the image, factor, accuracy
+            (see tracking_utils.compare_segmentations) and the time
+            of the full resolution and downsampled segmentations
+    """
+    rows = []
+    for image_path in image_paths:
+        frame = load_image(image_path)
+        start_time = time.time()
+        reference = tracking_utils.segment_frame(frame)
+        full_seconds = time.time() - start_time
+        for factor in factors:
+            start_time = time.time()
+            segmentation = tracking_utils.segment_frame(frame,
+                                                        downsample=factor)
+            seconds = time.time() - start_time
+            row = {'image': os.path.basename(image_path), 'factor': factor}
+            row.update(tracking_utils.compare_segmentations(
+                       reference, segmentation,
+                       max_distance=2 * factor + 1))
+            row['full_seconds'] = full_seconds
+            row['seconds'] = seconds
+            rows.append(row)
+    return rows
+
+
+def main():
+    args = get_args()
+    image_paths = []
+    for pattern in args.images:
+        image_paths.extend(sorted(glob.glob(pattern)))
+    if len(image_paths) == 0:
+        print("No images found: " + ' '.join(args.images))
+        raise FileNotFoundError
+
+    rows = report_accuracy(image_paths, args.downsample)
+    print(f"{'image':45} {'factor':>6} {'full':>5} {'found':>5} "
+          f"{'recall':>6} {'precision':>9} {'error':>5}")
+    for row in rows:
+        print(f"{row['image']:45} {row['factor']:6d} "
+              f"{row['n_reference']:5d} {row['n_segmented']:5d} "
+              f"{row['recall']:6.2f} {row['precision']:9.2f} "
+              f"{row['mean_distance']:5.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,574 @@
+"""Columnar storage of cell tracks.
+
+Every entry of a track's history (one per frame from its first frame,
+see Cell.backfill) is a row of preallocated numpy columns that grow by
+doubling: track id, frame, x, y, bounding box and the two channel
+measurements. Entries that only hold the values of frames before a cell
+was born or while its track was lost ((-1, -1), no contour, NaN) have
+no row. Tracks have their own columns (parent track, birthday).
+TrackCell is a Cell-compatible view of one track, so the tracking
+functions work on stored tracks unchanged, while the linking and the
+exports read and write the columns of many tracks at once
+(see TrackStore.get_coords, add_frames and get_histories).
+
+    * TrackStore - growable columns of track histories
+    * TrackCell - Cell view of one track of a TrackStore
+    * TrackColumn - list view of one column of a track's history
+"""
+
+import numpy as np
+from cell import Cell
+
+# history columns of a track and the TrackCell attributes they back
+HISTORY_COLUMNS = ('coords', 'contours', 'channel3_data', 'channel2_data')
+# value of every history column in entries without a row
+DEFAULT_VALUES = ((-1, -1), None, np.nan, np.nan)
+# columns with one value per row
+ROW_COLUMNS = ('track', 'frame', 'x', 'y', 'bbox', 'channel3', 'channel2')
+
+
+def is_default(column, value):
+    """
+    Checks if a value of a history column is the value of entries
+    without a row.
+    """
+    if column == 0:
+        return value[0] == -1 and value[1] == -1
+    elif column == 1:
+        return value is None
+    else:
+        return value != value
+
+
+class TrackStore:
+    """Growable numpy columns holding the histories of many tracks.
+
+    Args:
+        capacity: number of history rows allocated at first
+        track_capacity: number of tracks allocated at first
+        history_capacity: number of frames per track allocated at first
+    """
+
+    def __init__(self, capacity=4096, track_capacity=256,
+                 history_capacity=16):
+        self.n_rows = 0
+        self.track = np.empty(capacity, dtype=np.int32)
+        self.frame = np.empty(capacity, dtype=np.int32)
+        self.x = np.empty(capacity, dtype=np.float64)
+        self.y = np.empty(capacity, dtype=np.float64)
+        self.bbox = np.empty((capacity, 4), dtype=np.int32)
+        self.channel3 = np.empty(capacity, dtype=np.float64)
+        self.channel2 = np.empty(capacity, dtype=np.float64)
+
+        self.n_tracks = 0
+        self.parent = np.empty(track_capacity, dtype=np.int32)
+        self.birthday = np.empty(track_capacity, dtype=np.int32)
+        # row of every history entry of every track (-1 if none)
+        self.rows = np.full((track_capacity, history_capacity), -1,
+                            dtype=np.int32)
+        # one view per track, so a track is always the same object
+        self.cells = []
+        # number of tracks at which collect next looks for tracks to free
+        self.min_collect = track_capacity
+        self.collect_at = track_capacity
+
+    def __len__(self):
+        return self.n_tracks
+
+    def nbytes(self):
+        """
+        Gets the memory used by the columns in bytes.
+        """
+        return sum(column.nbytes for column in
+                   (self.track, self.frame, self.x, self.y, self.bbox,
+                    self.channel3, self.channel2, self.parent,
+                    self.birthday, self.rows))
+
+    def new_cell(self, parent=None, birthday=0, problematic=0):
+        """
+        Adds a track, with the same arguments as Cell.
+
+        Returns:
+            cell: TrackCell view of the new track
+        """
+        return TrackCell(self, parent=parent, birthday=birthday,
+                         problematic=problematic)
+
+    def add_cells(self, cells):
+        """
+        Copies cells (e.g. the cells of the first frame) into tracks.
+
+        Returns:
+            track_cells: list of TrackCell views, in the same order
+        """
+        track_cells = []
+        for cell in cells:
+            track_cell = self.new_cell(birthday=cell.birthday,
+                                       problematic=cell.problematic)
+            for name in HISTORY_COLUMNS:
+                setattr(track_cell, name, list(getattr(cell, name)))
+            track_cells.append(track_cell)
+        return track_cells
+
+    def add_track(self):
+        """
+        Allocates the columns of a new track.
+
+        Returns:
+            track_id: index of the new track
+        """
+        if self.n_tracks == len(self.parent):
+            capacity = 2 * len(self.parent)
+            self.parent = np.resize(self.parent, capacity)
+            self.birthday = np.resize(self.birthday, capacity)
+            rows = np.full((capacity, self.rows.shape[1]), -1,
+                           dtype=np.int32)
+            rows[:self.n_tracks] = self.rows[:self.n_tracks]
+            self.rows = rows
+        track_id = self.n_tracks
+        self.parent[track_id] = -1
+        self.birthday[track_id] = 0
+        self.rows[track_id] = -1
+        self.n_tracks += 1
+        return track_id
+
+    def reserve_history(self, length):
+        """
+        Makes room for histories of up to length entries.
+        """
+        if length > self.rows.shape[1]:
+            rows = np.full((self.rows.shape[0],
+                            max(2 * self.rows.shape[1], length)), -1,
+                           dtype=np.int32)
+            rows[:, :self.rows.shape[1]] = self.rows
+            self.rows = rows
+
+    def new_rows(self, track_ids, indexes):
+        """
+        Allocates the rows of history entries of tracks, with the
+        values of entries without a row.
+
+        Returns:
+            rows: array of the new rows
+        """
+        n_rows = self.n_rows + len(track_ids)
+        if n_rows > len(self.track):
+            capacity = max(2 * len(self.track), n_rows)
+            for name in ROW_COLUMNS:
+                column = getattr(self, name)
+                setattr(self, name, np.resize(
+                        column, (capacity,) + column.shape[1:]))
+        rows = np.arange(self.n_rows, n_rows)
+        self.track[rows] = track_ids
+        self.frame[rows] = indexes
+        self.x[rows] = -1
+        self.y[rows] = -1
+        self.bbox[rows] = -1
+        self.channel3[rows] = np.nan
+        self.channel2[rows] = np.nan
+        self.rows[track_ids, indexes] = rows
+        self.n_rows = n_rows
+        return rows
+
+    def get_row(self, track_id, index):
+        """
+        Gets the row of a history entry of a track, allocating it
+        if the entry has none.
+        """
+        self.reserve_history(index + 1)
+        row = self.rows[track_id, index]
+        if row == -1:
+            row = self.new_rows([track_id], [index])[0]
+        return row
+
+    def get_value(self, column, row):
+        """
+        Gets the value of a history column in a row, as the tracking
+        functions expect it in a Cell.
+        """
+        if row == -1:
+            return DEFAULT_VALUES[column]
+        elif column == 0:
+            return (float(self.x[row]), float(self.y[row]))
+        elif column == 1:
+            bbox = self.bbox[row]
+            if bbox[2] < 0:
+                return None
+            return tuple(bbox.tolist())
+        elif column == 2:
+            return float(self.channel3[row])
+        else:
+            return float(self.channel2[row])
+
+    def set_value(self, column, row, value):
+        """
+        Sets the value of a history column in a row.
+        """
+        if column == 0:
+            self.x[row], self.y[row] = value
+        elif column == 1:
+            self.bbox[row] = -1 if value is None else value
+        elif column == 2:
+            self.channel3[row] = value
+        else:
+            self.channel2[row] = value
+
+    def get_track_ids(self, cells):
+        track_ids = np.fromiter((cell.track_id for cell in cells),
+                                dtype=np.int64, count=len(cells))
+        return track_ids
+
+    def get_history_columns(self, cells):
+        """
+        Gets the history columns (TrackCell.history) of many tracks.
+
+        Returns:
+            histories: list of history columns, or None if not all the
+                cells are views of this store
+        """
+        try:
+            histories = [cell.history for cell in cells
+                         if cell.store is self]
+        except AttributeError:
+            return None
+        if len(histories) != len(cells):
+            return None
+        return histories
+
+    def get_coords(self, cells, n_coords=1):
+        """
+        Gets the most recent coordinates of many tracks at once
+        (cell.coords[-1], cell.coords[-2], ...).
+
+        Args:
+            cells: list of TrackCell views of this store
+            n_coords: number of coordinates per track
+
+        Returns:
+            coords: n_coords x len(cells) x 2 array, most recent first,
+                or None if not all the cells are views of this store
+        """
+        histories = self.get_history_columns(cells)
+        if histories is None:
+            return None
+        track_ids = np.fromiter((history[0].track_id
+                                 for history in histories),
+                                dtype=np.int64, count=len(cells))
+        lengths = np.fromiter((history[0].length for history in histories),
+                              dtype=np.int64, count=len(cells))
+        coords = np.full((n_coords, len(cells), 2), -1.0)
+        for age in range(n_coords):
+            indexes = lengths - 1 - age
+            # like negative list indexes
+            indexes[indexes < 0] += lengths[indexes < 0]
+            if np.any(indexes < 0):
+                print("Track histories are shorter than " + str(age + 1))
+                raise IndexError
+            rows = self.rows[track_ids, indexes]
+            has_row = rows != -1
+            coords[age, has_row, 0] = self.x[rows[has_row]]
+            coords[age, has_row, 1] = self.y[rows[has_row]]
+        return coords
+
+    def add_frames(self, cells, frame_cells):
+        """
+        Adds the position, contour and channel data of cells of the
+        current frame (from cells_from_segmentation) to many tracks at
+        once (see tracking_utils.add_frame_cell).
+
+        Args:
+            cells: list of distinct TrackCell views of this store
+            frame_cells: list of cells of the current frame, one per
+                track
+
+        Returns:
+            added: False if not all the cells are views of this store
+                (and nothing was added)
+        """
+        histories = self.get_history_columns(cells)
+        if histories is None:
+            return False
+        if len(histories) == 0:
+            return True
+        lengths = np.array([(history[0].length, history[1].length,
+                             history[2].length, history[3].length)
+                            for history in histories], dtype=np.int64)
+        if np.any(lengths != lengths[:, :1]):
+            # history columns of different lengths: one at a time
+            for history, frame_cell in zip(histories, frame_cells):
+                for column, name in zip(history, HISTORY_COLUMNS):
+                    column.append(getattr(frame_cell, name)[0])
+            return True
+        track_ids = np.fromiter((history[0].track_id
+                                 for history in histories),
+                                dtype=np.int64, count=len(cells))
+        indexes = lengths[:, 0]
+        self.reserve_history(int(indexes.max()) + 1)
+        rows = self.rows[track_ids, indexes]
+        no_row = rows == -1
+        rows[no_row] = self.new_rows(track_ids[no_row], indexes[no_row])
+
+        values = np.array([frame_cell.coords[0] +
+                           (frame_cell.channel3_data[0],
+                            frame_cell.channel2_data[0])
+                           for frame_cell in frame_cells], dtype=np.float64)
+        self.x[rows] = values[:, 0]
+        self.y[rows] = values[:, 1]
+        self.channel3[rows] = values[:, 2]
+        self.channel2[rows] = values[:, 3]
+        self.bbox[rows] = [(-1, -1, -1, -1) if frame_cell.contours[0] is None
+                           else frame_cell.contours[0]
+                           for frame_cell in frame_cells]
+        for history in histories:
+            history[0].length += 1
+            history[1].length += 1
+            history[2].length += 1
+            history[3].length += 1
+        return True
+
+    def get_histories(self, cells, n_frames):
+        """
+        Gets the first n_frames history entries of many tracks at once.
+
+        Args:
+            cells: list of TrackCell views of this store
+            n_frames: number of entries per track
+
+        Returns:
+            histories: dictionary of len(cells) x n_frames arrays
+                ('x', 'y', 'channel3_data' and 'channel2_data')
+        """
+        if any(min(cell.history[0].length, cell.history[2].length,
+                   cell.history[3].length) < n_frames for cell in cells):
+            print("Track histories are shorter than " + str(n_frames))
+            raise IndexError
+        self.reserve_history(n_frames)
+        rows = self.rows[self.get_track_ids(cells), :n_frames]
+        no_row = rows == -1
+        histories = {}
+        for name, column, default in [('x', self.x, -1),
+                                      ('y', self.y, -1),
+                                      ('channel3_data', self.channel3,
+                                       np.nan),
+                                      ('channel2_data', self.channel2,
+                                       np.nan)]:
+            values = column[rows]
+            values[no_row] = default
+            histories[name] = values
+        return histories
+
+    def collect(self, *cell_lists):
+        """
+        Frees the tracks that can not be reached from the given cells
+        (through their parents and children), like the garbage
+        collection of Cell objects, and compacts the columns of the
+        others. This only looks for tracks to free once the store has
+        twice as many tracks as it kept the last time, so that the work
+        is proportional to the number of tracks added. Views of freed
+        tracks can no longer be used.
+
+        Args:
+            cell_lists: lists of the TrackCell views still in use
+                (e.g. the master cell list and the lost tracks)
+        """
+        if self.n_tracks < self.collect_at:
+            return
+        is_live = [False] * self.n_tracks
+        stack = [cell for cells in cell_lists for cell in cells]
+        while len(stack) > 0:
+            cell = stack.pop()
+            if cell.store is not self:
+                print("Track is not in this track store")
+                raise ValueError
+            if is_live[cell.track_id]:
+                continue
+            is_live[cell.track_id] = True
+            parent_id = self.parent[cell.track_id]
+            if parent_id != -1:
+                stack.append(self.cells[parent_id])
+            stack.extend(cell.children)
+        live_ids = np.flatnonzero(is_live)
+        n_live = len(live_ids)
+        self.collect_at = max(2 * n_live, self.min_collect)
+        if n_live == self.n_tracks:
+            return
+
+        # rows of the live tracks, in their current order
+        live_rows = self.rows[live_ids]
+        keep = np.zeros(self.n_rows, dtype=bool)
+        keep[live_rows[live_rows != -1]] = True
+        n_rows = int(keep.sum())
+        new_rows = np.full(self.n_rows, -1, dtype=np.int32)
+        new_rows[keep] = np.arange(n_rows)
+        new_ids = np.full(self.n_tracks, -1, dtype=np.int32)
+        new_ids[live_ids] = np.arange(n_live)
+        for name in ROW_COLUMNS:
+            column = getattr(self, name)
+            column[:n_rows] = column[:self.n_rows][keep]
+        self.track[:n_rows] = new_ids[self.track[:n_rows]]
+        self.rows[:n_live] = np.where(live_rows == -1, -1,
+                                      new_rows[live_rows])
+        self.rows[n_live:self.n_tracks] = -1
+        parents = self.parent[live_ids]
+        self.parent[:n_live] = np.where(parents == -1, -1,
+                                        new_ids[parents])
+        self.birthday[:n_live] = self.birthday[live_ids]
+
+        # free the views of the other tracks
+        for track_id in np.flatnonzero(new_ids == -1):
+            cell = self.cells[track_id]
+            cell.store = None
+            for column in cell.history:
+                column.store = None
+        cells = []
+        for new_id, track_id in enumerate(live_ids.tolist()):
+            cell = self.cells[track_id]
+            cell.track_id = new_id
+            for column in cell.history:
+                column.track_id = new_id
+            cells.append(cell)
+        self.cells = cells
+        self.n_tracks = n_live
+        self.n_rows = n_rows
+
+
+class TrackColumn:
+    """List view of one history column of a track.
+
+    Supports the list operations the tracking functions use: len,
+    indexing and slicing (slices are lists), item assignment, append,
+    iteration, concatenation with lists and comparison with lists.
+    """
+
+    __slots__ = ('store', 'track_id', 'column', 'length')
+
+    def __init__(self, store, track_id, column):
+        self.store = store
+        self.track_id = track_id
+        self.column = column
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def get_index(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("list index out of range")
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        row = self.store.rows[self.track_id, self.get_index(index)]
+        return self.store.get_value(self.column, row)
+
+    def __setitem__(self, index, value):
+        index = self.get_index(index)
+        row = self.store.rows[self.track_id, index]
+        if row == -1:
+            if is_default(self.column, value):
+                return
+            row = self.store.get_row(self.track_id, index)
+        self.store.set_value(self.column, row, value)
+
+    def append(self, value):
+        self.store.reserve_history(self.length + 1)
+        row = self.store.rows[self.track_id, self.length]
+        if row == -1:
+            if is_default(self.column, value):
+                self.length += 1
+                return
+            row = self.store.get_row(self.track_id, self.length)
+        self.store.set_value(self.column, row, value)
+        self.length += 1
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __add__(self, other):
+        return self[:] + list(other)
+
+    def __eq__(self, other):
+        if isinstance(other, TrackColumn):
+            other = other[:]
+        return self[:] == other
+
+    def __repr__(self):
+        return repr(self[:])
+
+
+def get_history_property(column):
+    # a history attribute of a TrackCell: reads give the track's
+    # TrackColumn, assigning a list replaces the whole history column
+    def get_column(self):
+        return self.history[column]
+
+    def set_column(self, values):
+        values = list(values)
+        history = self.history[column]
+        history.length = 0
+        for value in values:
+            history.append(value)
+
+    return property(get_column, set_column)
+
+
+class TrackCell(Cell):
+    """Cell view of one track of a TrackStore.
+
+    The history (coords, contours, channel3_data, channel2_data), parent
+    and birthday live in the store's columns; the other attributes
+    (children, problematic, motion state) are kept on the view.
+
+    Args:
+        store: TrackStore the track is added to
+        parent, birthday, problematic: see Cell
+    """
+
+    coords = get_history_property(0)
+    contours = get_history_property(1)
+    channel3_data = get_history_property(2)
+    channel2_data = get_history_property(3)
+
+    def __init__(self, store, parent=None, birthday=0, problematic=0):
+        self.store = store
+        self.track_id = store.add_track()
+        self.history = tuple(TrackColumn(store, self.track_id, column)
+                             for column in range(len(HISTORY_COLUMNS)))
+        store.cells.append(self)
+        super().__init__(parent=parent, birthday=birthday,
+                         problematic=problematic)
+
+    def backfill(self, history_length):
+        # entries before a cell was born have no rows
+        self.store.reserve_history(history_length)
+        self.store.rows[self.track_id] = -1
+        for column in self.history:
+            column.length = history_length
+
+    @property
+    def parent(self):
+        parent_id = self.store.parent[self.track_id]
+        if parent_id == -1:
+            return None
+        return self.store.cells[parent_id]
+
+    @parent.setter
+    def parent(self, parent):
+        if parent is None:
+            self.store.parent[self.track_id] = -1
+        elif getattr(parent, 'store', None) is not self.store:
+            print("Parent track is not in the same track store")
+            raise ValueError
+        else:
+            self.store.parent[self.track_id] = parent.track_id
+
+    @property
+    def birthday(self):
+        return int(self.store.birthday[self.track_id])
+
+    @birthday.setter
+    def birthday(self, birthday):
+        self.store.birthday[self.track_id] = birthday
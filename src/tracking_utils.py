@@ -3,23 +3,86 @@
     * is_pixel_inside_contour - checks if a pixel is inside a contour
     * get_center - gets center of a contour
     * do_watershed - segments an image with watershedding
+    * get_work_buffer - gets a preallocated, reusable work image
+    * watershed_labels - builds the watershed label image of a frame
+    * get_otsu_threshold - Otsu threshold of a grayscale histogram
+    * get_tiles - splits an image into overlapping tiles
+    * watershed_labels_tiled - builds the watershed label image tile by
+                               tile in a thread pool
+    * get_nuclei - gets nucleus centers and rectangles from a label image
+    * segment_frame - segments and measures a frame as compact arrays
+    * downsample_image - reduces an image by an integer factor
+    * upsample_nuclei - maps nuclei of a reduced image to full resolution
+    * compare_segmentations - accuracy of a segmentation against a
+                              reference segmentation
+    * measure_nuclei - measures the nuclei of a segmented frame
+    * cells_from_segmentation - creates cells from segment_frame output
+    * get_frame_segmentation - segments a frame, using a segmentation
+                               cache
+    * get_frame_cells - segments a frame into cells, using a
+                        segmentation cache
+    * get_foreground - gets the Otsu foreground of the nuclear channel
+    * watershed_labels_seeded - builds the watershed label image from
+                                known nucleus positions
+    * get_coverage - fraction of the foreground covered by nuclei
+    * get_label_areas - foreground area of every label of a watershed
+                        label image
+    * IncrementalSegmenter - segments frames in order, seeded by the
+                             previous frame's tracks
+    * get_label_regions - gets the bounding box of every label in
+                          a watershed label image
+    * measure_rects - measures a channel inside the bounding rectangles
+                      of all cells in a frame at once
+    * measure_labels - measures a channel inside every label of a
+                       watershed label image at once
+    * get_channel2_nuc_cyto_ratios - nuclear to cytoplasm ratio for
+                                     all cells in a frame at once
     * dist_between_points - calculates the distance between two points
-    * link_cell -
+    * predict_position - predicted position of a cell in the next frame
+    * update_motion - updates the motion state of a cell after linking
+    * get_motion_gate - adaptive link distance of a cell
+    * link_cell - finds the two cells of the current frame closest
+                  to a cell
+    * get_closest_points - finds the two closest points of the current
+                           frame for every point of the previous frame
+    * get_candidates - finds the two closest cells for every cell of
+                       the master cell list with a KD-tree
+    * assign_links - links two frames as a sparse linear assignment
+                     problem with birth, death and division costs
     * resolve_child_conflicts -
+    * resolve_children - array version of resolve_child_conflicts
+    * link_points - links two frames from their positions alone
     * link_next_frame - links all of the cells in a new frame to
                         the cell lineages in the master cell list
                         (and all previous frames)
+    * link_frame_cells - links the cells of an already segmented frame
+                         to the master cell list
+    * add_frame_cell - adds a cell of the current frame to a track
+    * get_recent_coords - gets the most recent coordinates of many cells
+    * add_frame_cells - adds cells of the current frame to many tracks
+    * LostTracks - pool of recently lost tracks that are reconnected
+                   to cells of later frames (gap closing)
 """
 
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2
+from scipy import ndimage, sparse, spatial
+from scipy.sparse import csgraph
+from concurrent.futures import ThreadPoolExecutor
 import os
 import math
+import threading
 import read_nd2
+import seg_cache
 from cell import Cell
 import pandas as pd
 
+# padding around each tile of the tiled watershed, larger than a nucleus
+DEFAULT_TILE_OVERLAP = 64
+# per-thread work images reused across frames (see get_work_buffer)
+work_buffers = threading.local()
+
 
 def is_pixel_inside_contour(pixel, contour):
     """
@@ -74,26 +137,65 @@ def do_watershed(frame):
     Returns:
         cells: list of cells (1 for each cell)
     """
-    channel0_data = frame[:, :, 0]
-    rgb_nuc = np.dstack((channel0_data,
-                         channel0_data, channel0_data))
-    try:
-        rgb_nuc = cv2.normalize(rgb_nuc, None, 0, 255,
-                                cv2.NORM_MINMAX, dtype=cv2.CV_8U)
-    except cv2.error:
-        print("cv2.error: Could not normalize image")
-        raise cv2.error
+    return cells_from_segmentation(segment_frame(frame))
 
-    # convert to grayscale
-    try:
-        grayscale = cv2.cvtColor(rgb_nuc, cv2.COLOR_BGR2GRAY)
-    except cv2.error:
-        print("Image not compatible with watershedding")
-        raise cv2.error
 
-    # threshold image
-    thresh = cv2.threshold(grayscale, 0, 255,
-                           cv2.THRESH_BINARY+cv2.THRESH_OTSU)[1]
+def get_work_buffer(name, shape, dtype):
+    """
+    Gets a preallocated work image that is reused across frames of the
+    same size (one set of buffers per thread, so tiles segmented in a
+    thread pool never share a buffer).
+
+    Args:
+        name: name of the buffer
+        shape: shape of the buffer
+        dtype: data type of the buffer
+
+    Returns:
+        buffer: uninitialized array of the given shape and type
+    """
+    buffers = getattr(work_buffers, 'buffers', None)
+    if buffers is None:
+        buffers = work_buffers.buffers = {}
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != tuple(shape) or \
+            buffer.dtype != dtype:
+        buffer = buffers[name] = np.empty(shape, dtype=dtype)
+    return buffer
+
+
+def watershed_labels(channel0_data, foreground=None):
+    """
+    Builds the watershed label image of the nuclear channel.
+    The single channel is normalized straight to 8-bit grayscale
+    and only cv2.watershed is given a 3-channel copy of it.
+
+    Args:
+        channel0_data: 2D array with the pixel values of the
+            nuclear channel
+        foreground: optional (grayscale, thresh) of channel0_data
+            from get_foreground, so they are not computed again
+
+    Returns:
+        markers: label image from cv2.watershed (-1 for boundaries,
+            1 for background, 2 and up for nuclei)
+    """
+    if foreground is not None:
+        grayscale, thresh = foreground
+    else:
+        channel0_data = np.asarray(channel0_data)
+        grayscale = get_work_buffer('grayscale', channel0_data.shape[:2],
+                                    np.uint8)
+        try:
+            grayscale = cv2.normalize(channel0_data, grayscale, 0, 255,
+                                      cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        except cv2.error:
+            print("cv2.error: Could not normalize image")
+            raise cv2.error
+
+        # threshold image
+        thresh = cv2.threshold(grayscale, 0, 255,
+                               cv2.THRESH_BINARY+cv2.THRESH_OTSU)[1]
 
     # get sure background area
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
@@ -118,22 +220,204 @@ def do_watershed(frame):
     # mark the region of unknown with zero
     markers[unknown == 255] = 0
 
-    # apply watershed algorithm
-    markers = cv2.watershed(rgb_nuc, markers)
+    # apply watershed algorithm (the only step that needs 3 channels)
+    bgr_nuc = get_work_buffer('bgr', grayscale.shape + (3,), np.uint8)
+    bgr_nuc = cv2.cvtColor(grayscale, cv2.COLOR_GRAY2BGR, bgr_nuc)
+    markers = cv2.watershed(bgr_nuc, markers)
 
-    labels = np.unique(markers)
+    return markers
 
-    cells = []
-    for label in labels[2:]:
-        # Create a binary image in which only the
-        # area of the label is in the foreground
-        # and the rest of the image is in the background
-        target = np.where(markers == label,
-                          255, 0).astype(np.uint8)
-
-        # Perform contour extraction on the created binary image
+
+def get_otsu_threshold(hist):
+    """
+    Gets the Otsu threshold of a 256-bin grayscale histogram (the same
+    threshold cv2.THRESH_OTSU picks for the image the histogram was
+    built from, so it can be computed from per-tile histograms).
+
+    Args:
+        hist: 256 pixel counts, one for each gray level
+
+    Returns:
+        threshold: gray level; pixels above it are foreground
+    """
+    hist = np.asarray(hist, dtype=np.float64).ravel()
+    levels = np.arange(len(hist), dtype=np.float64)
+    total = hist.sum()
+    if total == 0:
+        return 0
+    weight_bg = np.cumsum(hist) / total
+    mean_bg = np.cumsum(hist * levels) / total
+    mean_all = mean_bg[-1]
+    weight_fg = 1 - weight_bg
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between_var = (mean_all * weight_bg - mean_bg) ** 2 / \
+            (weight_bg * weight_fg)
+    between_var[~np.isfinite(between_var)] = 0
+    return int(np.argmax(between_var))
+
+
+def get_tiles(shape, tile_size, overlap):
+    """
+    Splits an image into tiles. Every tile has a core (the tiles' cores
+    cover the image without overlapping) and a padded region that
+    extends the core by the overlap on each side.
+
+    Args:
+        shape: (rows, columns) of the image
+        tile_size: size of the tile cores in pixels
+        overlap: padding around each core in pixels
+
+    Returns:
+        tiles: list of (core, padded) tuples of (rows, cols) slices
+    """
+    height, width = shape[:2]
+    tiles = []
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            core = (slice(row, min(row + tile_size, height)),
+                    slice(col, min(col + tile_size, width)))
+            padded = (slice(max(row - overlap, 0),
+                            min(row + tile_size + overlap, height)),
+                      slice(max(col - overlap, 0),
+                            min(col + tile_size + overlap, width)))
+            tiles.append((core, padded))
+    return tiles
+
+
+def watershed_labels_tiled(channel0_data, tile_size=512,
+                           overlap=DEFAULT_TILE_OVERLAP, workers=None):
+    """
+    Builds the watershed label image of the nuclear channel tile by
+    tile, segmenting the tiles concurrently in a thread pool (OpenCV
+    releases the GIL). The normalization, Otsu threshold and foreground
+    threshold are computed over the whole frame, so every tile uses the
+    same thresholds as watershed_labels. Each nucleus is kept only by
+    the tile whose core contains the center of its bounding box, so
+    nuclei on tile seams are neither duplicated nor split as long as
+    the overlap is larger than a nucleus.
+
+    Args:
+        channel0_data: 2D array with the pixel values of the
+            nuclear channel
+        tile_size: size of the tile cores in pixels
+        overlap: padding around each tile in pixels
+        workers: number of threads (default: ThreadPoolExecutor default)
+
+    Returns:
+        markers: label image (-1 for the frame border, 1 for background,
+            2 and up for nuclei)
+    """
+    if tile_size <= 0:
+        print("tile_size must be positive")
+        raise ValueError
+    channel0_data = np.asarray(channel0_data)
+    tiles = get_tiles(channel0_data.shape, tile_size, overlap)
+
+    # normalize with the range of the whole frame
+    min_val = float(channel0_data.min())
+    max_val = float(channel0_data.max())
+    scale = 255.0 / (max_val - min_val) if max_val > min_val else 0.0
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+    def get_gray(region):
+        return cv2.convertScaleAbs(channel0_data[region], alpha=scale,
+                                   beta=-min_val * scale)
+
+    def get_hist(tile):
+        core, padded = tile
+        return cv2.calcHist([get_gray(core)], [0], None, [256], [0, 256])
+
+    def get_dist(padded, thresh_val):
+        thresh = cv2.threshold(get_gray(padded), thresh_val, 255,
+                               cv2.THRESH_BINARY)[1]
+        return thresh, cv2.distanceTransform(thresh, cv2.DIST_L2, 5)
+
+    def get_core_max(tile):
+        core, padded = tile
+        thresh, dist = get_dist(padded, thresh_val)
+        return dist[core[0].start - padded[0].start:
+                    core[0].stop - padded[0].start,
+                    core[1].start - padded[1].start:
+                    core[1].stop - padded[1].start].max()
+
+    def segment_tile(tile):
+        core, padded = tile
+        thresh, dist = get_dist(padded, thresh_val)
+        sure_bg = cv2.dilate(thresh, kernel, iterations=3)
+        sure_fg = cv2.threshold(dist, 0.2 * dist_max, 255,
+                                cv2.THRESH_BINARY)[1].astype(np.uint8)
+        unknown = cv2.subtract(sure_bg, sure_fg)
+        ret, tile_markers = cv2.connectedComponents(sure_fg)
+        tile_markers = tile_markers.astype(np.int32) + 1
+        tile_markers[unknown == 255] = 0
+        tile_markers = cv2.watershed(cv2.cvtColor(get_gray(padded),
+                                                  cv2.COLOR_GRAY2BGR),
+                                     tile_markers)
+        # keep the nuclei whose bounding box center is in the core
+        owned = []
+        for label, (rows, cols) in get_label_regions(tile_markers):
+            center_row = padded[0].start + (rows.start + rows.stop) // 2
+            center_col = padded[1].start + (cols.start + cols.stop) // 2
+            if core[0].start <= center_row < core[0].stop and \
+                    core[1].start <= center_col < core[1].stop:
+                owned.append((rows, cols,
+                              tile_markers[rows, cols] == label))
+        return padded, owned
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hist = sum(pool.map(get_hist, tiles))
+        thresh_val = get_otsu_threshold(hist)
+        dist_max = max(pool.map(get_core_max, tiles))
+        tile_results = list(pool.map(segment_tile, tiles))
+
+    # stitch the nuclei of all tiles into one label image
+    markers = np.ones(channel0_data.shape, dtype=np.int32)
+    label = 2
+    for padded, owned in tile_results:
+        for rows, cols, mask in owned:
+            rows = slice(rows.start + padded[0].start,
+                         rows.stop + padded[0].start)
+            cols = slice(cols.start + padded[1].start,
+                         cols.stop + padded[1].start)
+            markers[rows, cols][mask] = label
+            label += 1
+    markers[[0, -1], :] = -1
+    markers[:, [0, -1]] = -1
+    return markers
+
+
+def get_nuclei(markers, area_threshold=1000, return_labels=False):
+    """
+    Gets the center and bounding rectangle of every nucleus in a
+    watershed label image, skipping regions that are too large
+    to be a single nucleus.
+
+    Args:
+        markers: label image from watershed_labels
+        area_threshold: maximum contour area of a nucleus
+        return_labels: also return the label of every nucleus
+
+    Returns:
+        centers: list of contour centers (x, y)
+        cont_rects: list of bounding rectangles (x, y, w, h)
+        labels: list of nucleus labels in markers
+            (only if return_labels is True)
+    """
+    centers = []
+    cont_rects = []
+    labels = []
+    for label, (rows, cols) in get_label_regions(markers):
+        # Create a binary image of the label's bounding box (padded by
+        # one pixel) in which only the area of the label is in the
+        # foreground and the rest is in the background
+        target = cv2.compare(markers[rows, cols], label, cv2.CMP_EQ)
+
+        # Perform contour extraction on the local crop, shifting the
+        # contour points back to full-frame coordinates
         contours, hierarchy = cv2.findContours(target, cv2.RETR_EXTERNAL,
-                                               cv2.CHAIN_APPROX_SIMPLE)
+                                               cv2.CHAIN_APPROX_SIMPLE,
+                                               offset=(cols.start,
+                                                       rows.start))
 
         # check if contour area is over a threshold
         try:
@@ -142,26 +426,523 @@ def do_watershed(frame):
             print("No contours found")
             raise IndexError
 
-        area_threshold = 1000
-        if cont_area > area_threshold:
-            continue
-        else:
-            center = get_center(contours[0])
-            cont_rect = cv2.boundingRect(contours[0])
-            mVenus_avg = get_channel_data_within_nuc_contour(
-                         frame, cont_rect, channel=2, invert=True)
-            cdk2_cyto_nuc_ratio = get_channel2_nuc_cyto_ratio(
-                                  frame, cont_rect, channel=1)
-            curr_cell = Cell()
-            curr_cell.add_coordinate(center)
-            curr_cell.add_contour(cont_rect)
-            curr_cell.add_channel3_data(mVenus_avg)
-            curr_cell.add_channel2_data(cdk2_cyto_nuc_ratio)
-            cells.append(curr_cell)
+        if cont_area <= area_threshold:
+            centers.append(get_center(contours[0]))
+            cont_rects.append(cv2.boundingRect(contours[0]))
+            labels.append(label)
+
+    if return_labels:
+        return centers, cont_rects, labels
+    return centers, cont_rects
+
+
+def segment_frame(frame, area_threshold=1000, tile_size=None,
+                  tile_overlap=DEFAULT_TILE_OVERLAP, downsample=1,
+                  foreground=None):
+    """
+    Segments a frame and measures every nucleus, returning the result
+    as compact arrays (see cells_from_segmentation).
+
+    Args:
+        frame: frame to segment
+        area_threshold: maximum contour area of a nucleus
+        tile_size: segment the frame in tiles of this size in parallel
+            (see watershed_labels_tiled); None segments the whole frame
+        tile_overlap: padding around each tile in pixels
+        downsample: segment a copy of the nuclear channel reduced by
+            this factor (e.g. 2 or 4) for fast previews; nuclei are
+            mapped back to full resolution for measurement
+            (see compare_segmentations for the accuracy)
+        foreground: optional (grayscale, thresh) of the nuclear channel
+            from get_foreground, reused when the whole frame is
+            segmented at full resolution
+
+    Returns:
+        segmentation: dictionary with the arrays
+            'labels': watershed label image
+            'centers': N x 2 contour centers (x, y)
+            'rects': N x 4 bounding rectangles (x, y, w, h)
+            'nucleus_labels': N labels of the nuclei in 'labels'
+            'channel3_data': N inverse channel 3 averages
+            'channel2_data': N channel 2 nuclear to cytoplasm ratios
+    """
+    channel0_data = frame[:, :, 0]
+    if downsample > 1:
+        channel0_data = downsample_image(channel0_data, downsample)
+        # the foreground is of the full resolution channel
+        foreground = None
+    if tile_size is None:
+        markers = watershed_labels(channel0_data, foreground)
+    else:
+        markers = watershed_labels_tiled(channel0_data, tile_size,
+                                         tile_overlap)
+    if downsample > 1:
+        # nuclei are found on the reduced labels and scaled back up
+        centers, cont_rects, labels = get_nuclei(
+            markers, area_threshold / downsample ** 2, return_labels=True)
+        centers, cont_rects = upsample_nuclei(centers, cont_rects,
+                                              downsample, frame.shape[:2])
+        markers = cv2.resize(markers, (frame.shape[1], frame.shape[0]),
+                             interpolation=cv2.INTER_NEAREST)
+        return measure_nuclei(frame, markers, centers, cont_rects, labels)
+    centers, cont_rects, labels = get_nuclei(markers, area_threshold,
+                                             return_labels=True)
+    return measure_nuclei(frame, markers, centers, cont_rects, labels)
+
+
+def downsample_image(image, factor):
+    """
+    Reduces an image by an integer factor, averaging the pixels of
+    every factor x factor block.
+    """
+    image = np.asarray(image)
+    size = (max(1, image.shape[1] // factor),
+            max(1, image.shape[0] // factor))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def upsample_nuclei(centers, cont_rects, factor, shape):
+    """
+    Maps nucleus centers and bounding rectangles found on an image
+    reduced by downsample_image back to full resolution.
+
+    Args:
+        centers: list of (x, y) centers on the reduced image
+        cont_rects: list of (x, y, w, h) rectangles on the reduced image
+        factor: downsampling factor
+        shape: (rows, columns) of the full resolution image
+
+    Returns:
+        centers: list of (x, y) centers at full resolution
+        cont_rects: list of (x, y, w, h) rectangles at full resolution,
+            clipped to the image
+    """
+    height, width = shape
+    full_centers = [(min(x * factor + factor // 2, width - 1),
+                     min(y * factor + factor // 2, height - 1))
+                    for x, y in centers]
+    full_rects = [(x * factor, y * factor,
+                   min(w * factor, width - x * factor),
+                   min(h * factor, height - y * factor))
+                  for x, y, w, h in cont_rects]
+    return full_centers, full_rects
+
+
+def compare_segmentations(reference, segmentation, max_distance=5):
+    """
+    Compares the nuclei of a segmentation with a reference segmentation
+    of the same frame (e.g. a downsampled segmentation against the full
+    resolution one). Nuclei are matched one to one to their nearest
+    nucleus within max_distance.
+
+    Args:
+        reference: dictionary of arrays from segment_frame
+        segmentation: dictionary of arrays from segment_frame
+        max_distance: maximum distance between matched centers (pixels)
+
+    Returns:
+        accuracy: dictionary with the number of reference, segmented
+            and matched nuclei, the recall (matched / reference), the
+            precision (matched / segmented) and the mean distance
+            between matched centers
+    """
+    ref_centers = np.asarray(reference['centers'], dtype=np.float64)
+    seg_centers = np.asarray(segmentation['centers'], dtype=np.float64)
+    n_matched = 0
+    distances = []
+    if len(ref_centers) > 0 and len(seg_centers) > 0:
+        # closest pairs first, each nucleus is matched at most once
+        dists = np.hypot(*(ref_centers[:, None, :]
+                           - seg_centers[None, :, :]).transpose(2, 0, 1))
+        pairs = np.argwhere(dists <= max_distance)
+        order = np.argsort(dists[pairs[:, 0], pairs[:, 1]], kind='stable')
+        ref_used = np.zeros(len(ref_centers), dtype=bool)
+        seg_used = np.zeros(len(seg_centers), dtype=bool)
+        for i, j in pairs[order]:
+            if not ref_used[i] and not seg_used[j]:
+                ref_used[i] = seg_used[j] = True
+                distances.append(dists[i, j])
+        n_matched = len(distances)
+    accuracy = {
+        'n_reference': len(ref_centers),
+        'n_segmented': len(seg_centers),
+        'n_matched': n_matched,
+        'recall': n_matched / len(ref_centers) if len(ref_centers) else 1.0,
+        'precision': n_matched / len(seg_centers) if len(seg_centers)
+        else 1.0,
+        'mean_distance': float(np.mean(distances)) if distances else 0.0
+    }
+    return accuracy
+
+
+def measure_nuclei(frame, markers, centers, cont_rects, labels):
+    """
+    Measures the reporter channels of the nuclei of a frame and packs
+    the result into the segmentation arrays of segment_frame.
+
+    Args:
+        frame: segmented frame
+        markers: label image of the frame
+        centers: nucleus centers from get_nuclei
+        cont_rects: nucleus bounding rectangles from get_nuclei
+        labels: nucleus labels from get_nuclei
+
+    Returns:
+        segmentation: dictionary of arrays (see segment_frame)
+    """
+    # measure all nuclei of the frame at once
+    # (reporter channels are only read if there are nuclei)
+    mVenus_avgs = []
+    if len(cont_rects) > 0:
+        mVenus_avgs = measure_rects(frame[:, :, 2], cont_rects)['mean']
+        with np.errstate(divide='ignore'):
+            mVenus_avgs = np.where(mVenus_avgs != 0, 1 / mVenus_avgs, 0)
+
+    cdk2_cyto_nuc_ratios = []
+    if len(cont_rects) > 0:
+        cdk2_cyto_nuc_ratios = get_channel2_nuc_cyto_ratios(frame[:, :, 1],
+                                                            cont_rects)
+
+    segmentation = {
+        'labels': markers,
+        'centers': np.array(centers, dtype=np.int64).reshape(-1, 2),
+        'rects': np.array(cont_rects, dtype=np.int64).reshape(-1, 4),
+        'nucleus_labels': np.array(labels, dtype=np.int32),
+        'channel3_data': np.asarray(mVenus_avgs, dtype=np.float64),
+        'channel2_data': np.asarray(cdk2_cyto_nuc_ratios, dtype=np.float64)
+    }
+    return segmentation
+
+
+def cells_from_segmentation(segmentation):
+    """
+    Creates one Cell per nucleus of a segmentation from segment_frame.
+
+    Args:
+        segmentation: dictionary of arrays from segment_frame
+
+    Returns:
+        cells: list of cells (1 for each nucleus)
+    """
+    cells = []
+    for center, cont_rect, mVenus_avg, cdk2_cyto_nuc_ratio in zip(
+            segmentation['centers'], segmentation['rects'],
+            segmentation['channel3_data'], segmentation['channel2_data']):
+        curr_cell = Cell()
+        curr_cell.add_coordinate((int(center[0]), int(center[1])))
+        curr_cell.add_contour(tuple(int(v) for v in cont_rect))
+        curr_cell.add_channel3_data(mVenus_avg)
+        curr_cell.add_channel2_data(cdk2_cyto_nuc_ratio)
+        cells.append(curr_cell)
 
     return cells
 
 
+def get_frame_segmentation(frame, segmentation_cache=None,
+                           area_threshold=1000, foreground=None,
+                           **segmentation_params):
+    """
+    Segments a frame (see segment_frame), reading the segmentation from
+    the cache when the same pixels have been segmented before.
+
+    Args:
+        frame: frame to segment
+        segmentation_cache: seg_cache.SegmentationCache
+            (None always segments)
+        area_threshold: maximum contour area of a nucleus
+        foreground: optional (grayscale, thresh) of the nuclear channel
+            (see segment_frame; not part of the cache key)
+        segmentation_params: other arguments of segment_frame
+            (e.g. tile_size)
+
+    Returns:
+        segmentation: dictionary of arrays from segment_frame
+    """
+    if segmentation_cache is None:
+        return segment_frame(frame, area_threshold, foreground=foreground,
+                             **segmentation_params)
+    key = seg_cache.get_segmentation_key(frame,
+                                         area_threshold=area_threshold,
+                                         **segmentation_params)
+    segmentation = segmentation_cache.get(key)
+    if segmentation is None:
+        segmentation = segment_frame(frame, area_threshold,
+                                     foreground=foreground,
+                                     **segmentation_params)
+        segmentation_cache.put(key, segmentation)
+    return segmentation
+
+
+def get_frame_cells(frame, segmentation_cache=None, area_threshold=1000,
+                    **segmentation_params):
+    """
+    Segments a frame into cells, reading the segmentation from the
+    cache when the same pixels have been segmented before.
+
+    Args:
+        frame: frame to segment
+        segmentation_cache: seg_cache.SegmentationCache
+            (None always segments)
+        area_threshold: maximum contour area of a nucleus
+        segmentation_params: other arguments of segment_frame
+            (e.g. tile_size)
+
+    Returns:
+        cells: list of cells (1 for each nucleus)
+    """
+    return cells_from_segmentation(get_frame_segmentation(
+           frame, segmentation_cache, area_threshold, **segmentation_params))
+
+
+def get_foreground(channel0_data):
+    """
+    Gets the Otsu foreground of the nuclear channel and the 8-bit
+    grayscale image it was thresholded from (as in watershed_labels).
+
+    Returns:
+        grayscale: normalized 8-bit image
+        thresh: binary foreground image (255 for nuclei)
+    """
+    try:
+        grayscale = cv2.normalize(np.asarray(channel0_data), None, 0, 255,
+                                  cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    except cv2.error:
+        print("cv2.error: Could not normalize image")
+        raise cv2.error
+    thresh = cv2.threshold(grayscale, 0, 255,
+                           cv2.THRESH_BINARY+cv2.THRESH_OTSU)[1]
+    return grayscale, thresh
+
+
+def watershed_labels_seeded(grayscale, thresh, seeds, seed_radius=3):
+    """
+    Builds the watershed label image of the nuclear channel from known
+    nucleus positions (e.g. the previous frame's tracks) instead of
+    the distance transform. Seed i becomes label i + 2, so labels stay
+    in the same order as the seeds. Seeds that fall on background are
+    dropped, and nuclei without a seed are flooded as background.
+
+    Args:
+        grayscale: normalized 8-bit image (from get_foreground)
+        thresh: binary foreground image (from get_foreground)
+        seeds: list of (x, y) nucleus positions
+        seed_radius: radius of the marker drawn at every seed
+
+    Returns:
+        markers: label image (-1 for boundaries, 1 for background,
+            2 and up for nuclei)
+    """
+    markers = np.zeros(thresh.shape, dtype=np.int32)
+    for i, (x, y) in enumerate(seeds):
+        cv2.circle(markers, (int(round(x)), int(round(y))), seed_radius,
+                   i + 2, -1)
+    # seeds only mark nuclear pixels
+    markers[thresh == 0] = 0
+
+    # get sure background area
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    sure_bg = cv2.dilate(thresh, kernel, iterations=3)
+    markers[sure_bg == 0] = 1
+
+    bgr_nuc = get_work_buffer('bgr', grayscale.shape + (3,), np.uint8)
+    bgr_nuc = cv2.cvtColor(grayscale, cv2.COLOR_GRAY2BGR, bgr_nuc)
+    return cv2.watershed(bgr_nuc, markers)
+
+
+def get_coverage(markers, labels, thresh):
+    """
+    Gets the fraction of foreground pixels that belong to the given
+    nucleus labels.
+    """
+    n_foreground = cv2.countNonZero(thresh)
+    if n_foreground == 0 or len(labels) == 0:
+        return 0.0
+    # lookup table from label (shifted past the -1 boundaries) to
+    # whether the label is a nucleus
+    is_nucleus = np.zeros(int(markers.max()) + 2, dtype=bool)
+    is_nucleus[np.asarray(labels) + 1] = True
+    covered = is_nucleus[markers + 1] & (thresh != 0)
+    return np.count_nonzero(covered) / n_foreground
+
+
+def get_label_areas(markers, thresh, n_labels=0):
+    """
+    Gets the number of foreground pixels of every label of a watershed
+    label image in a single pass over the image.
+
+    Args:
+        markers: label image from cv2.watershed
+        thresh: binary foreground image
+        n_labels: minimum number of labels to return areas for
+
+    Returns:
+        areas: foreground pixels of label i at index i + 1 (so the -1
+            boundaries are at index 0)
+    """
+    return np.bincount(markers[thresh != 0] + 1, minlength=n_labels + 1)
+
+
+class IncrementalSegmenter:
+    """Segments the frames of a movie in order, seeding the watershed
+    of each frame with the nucleus positions of the previous frame's
+    tracks (see watershed_labels_seeded). Nuclei only move a few pixels
+    between frames, so this skips the distance transform and keeps the
+    labels in track order. A frame is segmented from scratch when the
+    seeded result drifts from the last full segmentation: when the
+    number of nuclei changes, or the fraction of foreground covered by
+    nuclei drops (new or divided nuclei are not seeded), by more than
+    the tolerances. An unseeded nucleus that touches a seeded one is
+    flooded into its label instead, so a frame is also segmented from
+    scratch when a nucleus grows over its area in the previous frame
+    by more than area_tolerance and by more than half the median
+    nucleus area (so a few pixels more on a small nucleus do not count).
+
+    Args:
+        segmentation_cache: optional seg_cache.SegmentationCache used
+            for the full segmentations
+        area_threshold: maximum contour area of a nucleus
+        count_tolerance: allowed relative change in the number of nuclei
+        coverage_tolerance: allowed drop in foreground coverage
+        area_tolerance: allowed relative growth of a nucleus over its
+            foreground area in the previous frame
+        seed_radius: radius of the marker drawn at every seed
+        segmentation_params: other arguments of segment_frame for the
+            full segmentations (e.g. tile_size)
+    """
+
+    def __init__(self, segmentation_cache=None, area_threshold=1000,
+                 count_tolerance=0.05, coverage_tolerance=0.05,
+                 area_tolerance=0.5, seed_radius=3, **segmentation_params):
+        self.segmentation_cache = segmentation_cache
+        self.area_threshold = area_threshold
+        self.count_tolerance = count_tolerance
+        self.coverage_tolerance = coverage_tolerance
+        self.area_tolerance = area_tolerance
+        self.seed_radius = seed_radius
+        self.segmentation_params = segmentation_params
+        # number of nuclei and foreground coverage of the last full
+        # segmentation, which seeded segmentations are compared against
+        self.n_nuclei = None
+        self.coverage = None
+        # center -> foreground area of the nuclei of the previous frame
+        self.areas = {}
+        self.n_full = 0
+        self.n_seeded = 0
+
+    def segment(self, frame, seeds=None):
+        """
+        Segments a frame.
+
+        Args:
+            frame: frame to segment
+            seeds: list of (x, y) positions of the tracked nuclei in the
+                previous frame (None segments the frame from scratch)
+
+        Returns:
+            segmentation: dictionary of arrays (see segment_frame)
+        """
+        grayscale, thresh = get_foreground(frame[:, :, 0])
+        if seeds is not None and len(seeds) > 0 and \
+                self.n_nuclei is not None and self.n_nuclei > 0:
+            markers = watershed_labels_seeded(grayscale, thresh, seeds,
+                                              self.seed_radius)
+            # check the seeded labels before finding and measuring the
+            # nuclei, which are only needed if they are kept
+            areas = get_label_areas(markers, thresh, len(seeds) + 1)
+            if self.is_consistent(areas, seeds, thresh):
+                centers, cont_rects, labels = get_nuclei(
+                    markers, self.area_threshold, return_labels=True)
+                self.set_areas(centers, labels, areas)
+                self.n_seeded += 1
+                return measure_nuclei(frame, markers, centers, cont_rects,
+                                      labels)
+
+        segmentation = get_frame_segmentation(frame,
+                                              self.segmentation_cache,
+                                              self.area_threshold,
+                                              foreground=(grayscale, thresh),
+                                              **self.segmentation_params)
+        self.n_nuclei = len(segmentation['centers'])
+        self.coverage = get_coverage(segmentation['labels'],
+                                     segmentation['nucleus_labels'], thresh)
+        self.set_areas(segmentation['centers'],
+                       segmentation['nucleus_labels'],
+                       get_label_areas(segmentation['labels'], thresh))
+        self.n_full += 1
+        return segmentation
+
+    def is_consistent(self, areas, seeds, thresh):
+        """
+        Checks a seeded label image against the last full segmentation
+        and the nuclei of the previous frame (see IncrementalSegmenter).
+
+        Args:
+            areas: foreground areas of the labels of the seeded label
+                image (get_label_areas)
+            seeds: the seeds of the label image
+            thresh: binary foreground image
+
+        Returns:
+            consistent: False if the frame should be segmented from
+                scratch
+        """
+        # seed i is label i + 2, at index i + 3 of areas
+        seed_areas = areas[3:len(seeds) + 3]
+        n_nuclei = np.count_nonzero(seed_areas)
+        count_change = abs(n_nuclei - self.n_nuclei) / self.n_nuclei
+        if count_change > self.count_tolerance:
+            return False
+        # fraction of the foreground in the seeded labels
+        # (as get_coverage, from the areas)
+        n_foreground = cv2.countNonZero(thresh)
+        coverage = seed_areas.sum() / n_foreground if n_foreground else 0.0
+        if coverage < self.coverage - self.coverage_tolerance:
+            return False
+        if len(self.areas) == 0:
+            return True
+        prev_areas = np.array([self.areas.get(tuple(seed), np.inf)
+                               for seed in seeds], dtype=np.float64)
+        min_growth = 0.5 * np.median(list(self.areas.values()))
+        growth = seed_areas - prev_areas
+        return not np.any((growth > self.area_tolerance * prev_areas) &
+                          (growth > min_growth))
+
+    def set_areas(self, centers, labels, areas):
+        """
+        Keeps the foreground area of every nucleus of a frame, by
+        center, for the area check of the next frame.
+        """
+        self.areas = {(int(x), int(y)): int(areas[label + 1])
+                      for (x, y), label in zip(centers, labels)}
+
+
+def get_label_regions(markers):
+    """
+    Gets the bounding box of every nucleus label in a watershed label
+    image in a single pass over the image.
+
+    Args:
+        markers: label image from cv2.watershed (-1 for boundaries,
+            1 for background, 2 and up for nuclei)
+
+    Returns:
+        regions: list of (label, (rows, cols)) in label order, where
+            rows and cols are slices of the label's bounding box padded
+            by one pixel (clipped to the image)
+    """
+    height, width = markers.shape
+    regions = []
+    for i, bbox in enumerate(ndimage.find_objects(markers)):
+        label = i + 1
+        # skip background and labels removed by the watershed
+        if label < 2 or bbox is None:
+            continue
+        rows = slice(max(bbox[0].start - 1, 0), min(bbox[0].stop + 1, height))
+        cols = slice(max(bbox[1].start - 1, 0), min(bbox[1].stop + 1, width))
+        regions.append((label, (rows, cols)))
+    return regions
+
+
 def get_channel_data_within_nuc_contour(frame, contour, channel, invert=False):
     """
     Gets the average pixel value for a given channel within a contour.
@@ -172,12 +953,12 @@ def get_channel_data_within_nuc_contour(frame, contour, channel, invert=False):
         channel: channel to get data from
         invert: whether to invert the data
     """
-    frame_channel_data = frame[:, :, channel]
     # get bounding rectangle
     x, y, w, h = contour
 
-    # get channel data from rectangle
-    roi = frame_channel_data[y:y+h, x:x+w]
+    # get channel data from rectangle (only the ROI is read, so lazily
+    # loaded or memory-mapped frames do not touch the rest of the plane)
+    roi = frame[y:y+h, x:x+w, channel]
 
     # compute average pixel value within contour
     average_pixel_val = roi.mean()
@@ -187,54 +968,163 @@ def get_channel_data_within_nuc_contour(frame, contour, channel, invert=False):
         else:
             inv_average_pixel_val = average_pixel_val
     else:
-        0
+        inv_average_pixel_val = 0
 
     return inv_average_pixel_val
 
 
+def get_grouped_median(values, groups, n_groups):
+    """
+    Gets the median of the values in each group with one sort
+    (instead of one np.median call per group).
+
+    Args:
+        values: 1D array of pixel values
+        groups: 1D array (same length) of group indices in [0, n_groups)
+        n_groups: number of groups
+
+    Returns:
+        medians: array of length n_groups (nan for empty groups)
+    """
+    order = np.lexsort((values, groups))
+    sorted_values = values[order].astype(np.float64)
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    medians = np.full(n_groups, np.nan)
+    has_values = counts > 0
+    lower = starts[has_values] + (counts[has_values] - 1) // 2
+    upper = starts[has_values] + counts[has_values] // 2
+    medians[has_values] = (sorted_values[lower] + sorted_values[upper]) / 2
+    return medians
+
+
+def measure_rects(channel_data, rects, median=False):
+    """
+    Measures a channel inside the bounding rectangle of every cell
+    in a frame at once. Sums are read from an integral image, so the
+    cost per cell is constant regardless of its size.
+
+    Args:
+        channel_data: 2D array with the pixel values of one channel
+        rects: array-like of bounding rectangles (x, y, w, h), one per cell
+        median: also compute the median of each rectangle
+
+    Returns:
+        measurements: dictionary of arrays with one entry per cell:
+            'sum', 'area', 'mean' and (if median=True) 'median'
+    """
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    height, width = channel_data.shape
+    x0 = np.clip(rects[:, 0], 0, width)
+    y0 = np.clip(rects[:, 1], 0, height)
+    x1 = np.clip(rects[:, 0] + rects[:, 2], 0, width)
+    y1 = np.clip(rects[:, 1] + rects[:, 3], 0, height)
+
+    integral = cv2.integral(np.ascontiguousarray(channel_data),
+                            sdepth=cv2.CV_64F)
+    sums = (integral[y1, x1] - integral[y0, x1]
+            - integral[y1, x0] + integral[y0, x0])
+    areas = (x1 - x0) * (y1 - y0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(areas > 0, sums / areas, 0)
+
+    measurements = {'sum': sums, 'area': areas, 'mean': means}
+    if median:
+        rois = [channel_data[y0[i]:y1[i], x0[i]:x1[i]].ravel()
+                for i in range(len(rects))]
+        if len(rois) > 0:
+            values = np.concatenate(rois)
+        else:
+            values = np.empty(0, dtype=channel_data.dtype)
+        groups = np.repeat(np.arange(len(rects)), areas)
+        measurements['median'] = get_grouped_median(values, groups,
+                                                    len(rects))
+    return measurements
+
+
+def measure_labels(channel_data, markers, labels, median=False):
+    """
+    Measures a channel inside the pixels of every label of a watershed
+    label image at once, using bincount reductions over the image.
+
+    Args:
+        channel_data: 2D array with the pixel values of one channel
+        markers: label image from cv2.watershed (same shape)
+        labels: array-like of the labels to measure
+        median: also compute the median of each label
+
+    Returns:
+        measurements: dictionary of arrays with one entry per label:
+            'sum', 'area', 'mean' and (if median=True) 'median'
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    # shift labels so the -1 watershed boundaries become 0
+    flat_markers = markers.ravel().astype(np.int64) + 1
+    flat_values = channel_data.ravel()
+    n_bins = max(int(flat_markers.max()) + 1, int(labels.max(initial=0)) + 2)
+    areas = np.bincount(flat_markers, minlength=n_bins)[labels + 1]
+    sums = np.bincount(flat_markers, weights=flat_values,
+                       minlength=n_bins)[labels + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(areas > 0, sums / areas, 0)
+
+    measurements = {'sum': sums, 'area': areas, 'mean': means}
+    if median:
+        # map every pixel to the position of its label in labels
+        # (-1 for pixels whose label is not measured)
+        lookup = np.full(n_bins, -1, dtype=np.int64)
+        lookup[labels + 1] = np.arange(len(labels))
+        groups = lookup[flat_markers]
+        measured = groups >= 0
+        measurements['median'] = get_grouped_median(flat_values[measured],
+                                                    groups[measured],
+                                                    len(labels))
+    return measurements
+
+
+def get_nuc_cyto_rois(rect, shape, padding=5):
+    """
+    Gets the nuclear and extended (nucleus plus surrounding cytoplasm)
+    regions around a bounding rectangle as slices into a plane.
+
+    Args:
+        rect: bounding rectangle (x, y, w, h) of the nucleus
+        shape: shape (height, width) of the plane
+        padding: number of pixels the extended region reaches out
+
+    Returns:
+        (nuc_rows, nuc_cols), (ext_rows, ext_cols): slices of the
+            rectangles (corners included) clipped to the plane
+    """
+    x, y, w, h = rect
+    x_ext, y_ext = x - padding, y - padding
+    w_ext, h_ext = w + 2 * padding, h + 2 * padding
+    # Handle boundary conditions
+    x_ext, y_ext = max(0, x_ext), max(0, y_ext)
+    w_ext, h_ext = min(shape[1] - x_ext, w_ext), min(shape[0] - y_ext, h_ext)
+
+    nuc_roi = (slice(y, y + h + 1), slice(x, x + w + 1))
+    ext_roi = (slice(y_ext, y_ext + h_ext + 1),
+               slice(x_ext, x_ext + w_ext + 1))
+    return nuc_roi, ext_roi
+
+
 def get_channel2_nuc_cyto_ratio(frame, contour, channel):
     """
     Get the channel2 fluorescence ratio of the nucleus to the cytoplasm.
+    Only the padded region around the nucleus is read.
 
     Args:
         frame: frame to segment
         contour: contour to get channel data from
         channel: channel to get data from
     """
-    frame_channel_data = frame[:, :, channel]
+    (nuc_rows, nuc_cols), (ext_rows, ext_cols) = get_nuc_cyto_rois(
+                                                 contour, frame.shape[:2])
 
-    # Assuming 'frame' is your image and 'rect' is your bounding rectangle
-    x, y, w, h = contour
-    padding = 5
-    x_ext, y_ext = x - padding, y - padding
-    w_ext, h_ext = w + 2 * padding, h + 2 * padding
-    # Handle boundary conditions
-    x_ext, y_ext = max(0, x_ext), max(0, y_ext)
-    w_ext, h_ext = min(frame_channel_data.shape[1] - x_ext, w_ext), min(
-                   frame_channel_data.shape[0] - y_ext, h_ext)
-
-    # Create masks for original and extended rectangles
-    mask_orig = np.zeros(frame_channel_data.shape, dtype="uint8")
-    mask_ext = np.zeros(frame_channel_data.shape, dtype="uint8")
-    cv2.rectangle(mask_orig, (x, y), (x + w, y + h), 255, -1)
-    cv2.rectangle(mask_ext, (x_ext, y_ext),
-                  (x_ext + w_ext, y_ext + h_ext),
-                  255, -1)
-
-    # Apply masks to channel 1 and calculate average pixel values
-    roi_orig = cv2.bitwise_and(frame_channel_data,
-                               frame_channel_data,
-                               mask=mask_orig)
-    roi_ext = cv2.bitwise_and(frame_channel_data,
-                              frame_channel_data,
-                              mask=mask_ext)
-
-    # Convert the ROI to a one-dimensional array
-    flat_roi_orig = roi_orig[mask_orig == 255].flatten()
-    flat_roi_ext = roi_ext[mask_ext == 255].flatten()
     # Calculate the median
-    median_pixel_value_orig = np.median(flat_roi_orig)
-    median_pixel_value_ext = np.median(flat_roi_ext)
+    median_pixel_value_orig = np.median(frame[nuc_rows, nuc_cols, channel])
+    median_pixel_value_ext = np.median(frame[ext_rows, ext_cols, channel])
 
     # Calculate the ratio of the average pixel values
     if median_pixel_value_orig != 0:
@@ -245,6 +1135,44 @@ def get_channel2_nuc_cyto_ratio(frame, contour, channel):
     return ratio
 
 
+def get_channel2_nuc_cyto_ratios(channel_data, rects):
+    """
+    Gets the channel2 nuclear to cytoplasm ratio for all cells of a
+    frame at once. Only the padded region around each nucleus is read,
+    and all medians are computed in one sorted-label reduction.
+
+    Args:
+        channel_data: 2D array with the pixel values of channel 2
+        rects: list of bounding rectangles (x, y, w, h), one per cell
+
+    Returns:
+        ratios: array with the ratio for each cell
+            (0 where the nuclear median is 0)
+    """
+    n_cells = len(rects)
+    if n_cells == 0:
+        return np.empty(0)
+
+    # group i is the nucleus of cell i,
+    # group n_cells + i is the extended region of cell i
+    nuc_pixels = []
+    ext_pixels = []
+    for rect in rects:
+        nuc_roi, ext_roi = get_nuc_cyto_rois(rect, channel_data.shape)
+        nuc_pixels.append(channel_data[nuc_roi].ravel())
+        ext_pixels.append(channel_data[ext_roi].ravel())
+    rois = nuc_pixels + ext_pixels
+    sizes = [len(roi) for roi in rois]
+    groups = np.repeat(np.arange(2 * n_cells), sizes)
+    medians = get_grouped_median(np.concatenate(rois), groups, 2 * n_cells)
+
+    nuc_medians = medians[:n_cells]
+    ext_medians = medians[n_cells:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(nuc_medians != 0, ext_medians / nuc_medians, 0)
+    return ratios
+
+
 def dist_between_points(coord_a, coord_b):
     """
     Calculates the distance between two points.
@@ -267,6 +1195,80 @@ def dist_between_points(coord_a, coord_b):
     return distance
 
 
+def predict_position(cell):
+    """
+    Predicts the position of a cell in the next frame from its most
+    recent position and its (smoothed) velocity.
+
+    Args:
+        cell: cell object
+
+    Returns:
+        predicted: predicted (x, y) position (the most recent position
+            for cells without a velocity yet)
+    """
+    x, y = cell.get_most_recent_coord()
+    if cell.velocity is None:
+        return (x, y)
+    return (x + cell.velocity[0], y + cell.velocity[1])
+
+
+def update_motion(cell, predicted, gate, velocity_gain=0.5, error_gain=0.5):
+    """
+    Updates the motion state of a cell once its new position has been
+    added (an alpha-beta filter with a constant velocity model): the
+    velocity moves towards the velocity that would have predicted the
+    new position, and the prediction error is smoothed for the next
+    gate (see get_motion_gate). The first velocity of a cell is its
+    first displacement.
+
+    Args:
+        cell: cell object, with its new position added
+        predicted: position predicted for it (from predict_position)
+        gate: maximum link distance it was linked with
+        velocity_gain: weight of the latest residual in the velocity
+        error_gain: weight of the latest prediction error
+            in the smoothed error
+    """
+    x, y = cell.get_most_recent_coord()
+    residual_x = x - predicted[0]
+    residual_y = y - predicted[1]
+    if cell.velocity is None:
+        cell.velocity = (residual_x, residual_y)
+    else:
+        cell.velocity = (cell.velocity[0] + velocity_gain * residual_x,
+                         cell.velocity[1] + velocity_gain * residual_y)
+    cell.prediction_error = math.sqrt(residual_x ** 2 + residual_y ** 2)
+    cell.motion_gate = gate
+    if cell.motion_error is None:
+        cell.motion_error = cell.prediction_error
+    else:
+        cell.motion_error = (1 - error_gain) * cell.motion_error + \
+            error_gain * cell.prediction_error
+
+
+def get_motion_gate(cell, max_distance=30, min_distance=10, n_errors=3):
+    """
+    Gets the maximum link distance of a cell around its predicted
+    position: a few times its smoothed prediction error, so cells that
+    move predictably are only linked to cells close to where they are
+    expected, and cells without a motion history keep the full gate.
+
+    Args:
+        cell: cell object
+        max_distance: largest gate (used for cells without history)
+        min_distance: smallest gate
+        n_errors: gate in multiples of the smoothed prediction error
+
+    Returns:
+        gate: maximum link distance
+    """
+    if cell.motion_error is None:
+        return max_distance
+    return min(max_distance, max(min_distance,
+                                 n_errors * cell.motion_error))
+
+
 def link_cell(parent_cell, curr_frame_cells):
     """
     Links a parent cell (cell from the previous frame) to two
@@ -282,37 +1284,297 @@ def link_cell(parent_cell, curr_frame_cells):
         closest to the parent cell and their corresponding
         distances from the parent cell.
     """
-    # get most recent coordinate of cell from dictionary
-    prev_point = parent_cell.get_most_recent_coord()
-    # initialize list of distances
-    dists = {}
-    for curr_cell in curr_frame_cells:
-        try:
-            curr_point = curr_cell.coords[0]
-        except IndexError:
-            # not gonna kill process bc it can continue to next cells
-            print("No coordinates found")
-        # get distance from every other point
-        dists[curr_cell] = dist_between_points(prev_point, curr_point)
-
-    # add coord with smallest distance
-    curr_smallest_dists = [float('inf'), float('inf')]
-    closest_cells = [None, None]
-    for dist_cell in dists:
-        if dists[dist_cell] < curr_smallest_dists[0]:
-            curr_smallest_dists[0] = dists[dist_cell]
-            closest_cells[0] = dist_cell
-        elif dists[dist_cell] < curr_smallest_dists[1]:
-            curr_smallest_dists[1] = dists[dist_cell]
-            closest_cells[1] = dist_cell
-
-    output = {}
-    output[closest_cells[0]] = curr_smallest_dists[0]
-    output[closest_cells[1]] = curr_smallest_dists[1]
-    return output
-
-
-def get_cells_to_cull(cell_list, dist_threshold):
+    return get_candidates([parent_cell], curr_frame_cells)[0]
+
+
+def get_closest_points(prev_points, curr_points):
+    """
+    Finds the two points of the current frame closest to every point
+    of the previous frame. A KD-tree is built over the current points
+    once and queried for all previous points in one call, so this is
+    O((N + M) log M) instead of O(N x M).
+
+    Args:
+        prev_points: N x 2 array of positions to search around
+        curr_points: M x 2 array of positions in the current frame
+
+    Returns:
+        idxs: N x 2 indices into curr_points (closest first; equally
+            distant points are taken in index order, -1 if missing)
+        dists: N x 2 distances (inf if missing)
+    """
+    prev_points = np.asarray(prev_points, dtype=np.float64).reshape(-1, 2)
+    curr_points = np.asarray(curr_points, dtype=np.float64).reshape(-1, 2)
+    closest_idxs = np.full((len(prev_points), 2), -1, dtype=np.int64)
+    closest_dists = np.full((len(prev_points), 2), np.inf)
+    n_neighbours = min(3, len(curr_points))
+    if n_neighbours == 0 or len(prev_points) == 0:
+        return closest_idxs, closest_dists
+
+    tree = spatial.cKDTree(curr_points)
+    dists, idxs = tree.query(prev_points, k=n_neighbours)
+    dists = dists.reshape(len(prev_points), n_neighbours)
+    idxs = idxs.reshape(len(prev_points), n_neighbours)
+    # a third neighbour breaks ties for second place in index order
+    # (rows where even the third neighbour is tied are resolved
+    # with an exact radius query)
+    if n_neighbours == 3:
+        for i in np.flatnonzero(dists[:, 2] == dists[:, 1]):
+            radius = dists[i, 1] * (1 + 1e-9) + 1e-9
+            tied = np.array(sorted(tree.query_ball_point(
+                            prev_points[i], radius)))
+            tied_dists = np.hypot(*(curr_points[tied]
+                                    - prev_points[i]).T)
+            best = np.lexsort((tied, tied_dists))[:3]
+            dists[i] = tied_dists[best]
+            idxs[i] = tied[best]
+    order = np.lexsort((idxs, dists))[:, :2]
+    n_closest = order.shape[1]
+    closest_dists[:, :n_closest] = np.take_along_axis(dists, order, axis=1)
+    closest_idxs[:, :n_closest] = np.take_along_axis(idxs, order, axis=1)
+    return closest_idxs, closest_dists
+
+
+def get_candidates(master_cell_list, curr_frame_cells, prev_points=None):
+    """
+    Finds the two cells in the current frame closest to every cell in
+    the master cell list (see link_cell and get_closest_points).
+
+    Args:
+        master_cell_list: list of cells (from the previous frame)
+        curr_frame_cells: list of all cells in the current frame
+        prev_points: optional positions to search around, one per
+            master cell (default: their most recent coordinates)
+
+    Returns:
+        candidates: array with one dictionary per master cell, with the
+            two closest cells as keys and their distances as values
+            (closest first; equally distant cells are taken in list
+            order, and missing cells are None with distance inf)
+    """
+    candidates = np.empty(len(master_cell_list), dtype=object)
+    if len(master_cell_list) == 0:
+        return candidates
+    try:
+        curr_points = [curr_cell.coords[0] for curr_cell in curr_frame_cells]
+    except IndexError:
+        print("No coordinates found")
+        raise IndexError
+    if prev_points is None:
+        prev_points = [cell.get_most_recent_coord()
+                       for cell in master_cell_list]
+    idxs, dists = get_closest_points(prev_points, curr_points)
+
+    for i in range(len(master_cell_list)):
+        output = {}
+        for j in range(2):
+            closest_cell = None
+            if idxs[i, j] != -1:
+                closest_cell = curr_frame_cells[idxs[i, j]]
+            output[closest_cell] = float(dists[i, j])
+        candidates[i] = output
+    return candidates
+
+
+def resolve_children(matches, child_candidates, child_dists, n_curr,
+                     child_distance=50, divisions=False):
+    """
+    Array version of resolve_child_conflicts: decides which cells of
+    the previous frame divided. A cell's second closest cell becomes its
+    child if it is within child_distance, is not the match of any
+    cell, and no cell has it as second closest cell at the same or a
+    smaller distance (the cell itself included, as in
+    resolve_child_conflicts, unless divisions is set).
+
+    Args:
+        matches: N indices of the matched cells (-1 for none)
+        child_candidates: N indices of the second closest cells
+            (-1 for none)
+        child_dists: N distances of the second closest cells
+        n_curr: number of cells in the current frame
+        child_distance: maximum distance of a child
+        divisions: only compare a cell's claim on its child with the
+            claims of the other cells (see resolve_child_conflicts)
+
+    Returns:
+        children: N indices of the children (-1 if the cell did not
+            divide)
+    """
+    matches = np.asarray(matches, dtype=np.int64)
+    child_candidates = np.asarray(child_candidates, dtype=np.int64)
+    child_dists = np.asarray(child_dists, dtype=np.float64)
+    children = np.full(len(matches), -1, dtype=np.int64)
+    has_candidate = child_candidates != -1
+    candidates = child_candidates[has_candidate]
+    dists = child_dists[has_candidate]
+
+    # reverse indexes over the cells of the current frame
+    is_match = np.zeros(n_curr, dtype=bool)
+    is_match[matches[matches != -1]] = True
+    closest_claim = np.full(n_curr, np.inf)
+    np.minimum.at(closest_claim, candidates, dists)
+    if divisions:
+        at_closest = dists == closest_claim[candidates]
+        n_closest_claims = np.bincount(candidates[at_closest],
+                                       minlength=n_curr)
+        is_closest = at_closest & (n_closest_claims[candidates] == 1)
+    else:
+        is_closest = dists < closest_claim[candidates]
+
+    owns_child = (dists <= child_distance) & ~is_match[candidates] & \
+        is_closest
+    children[np.flatnonzero(has_candidate)[owns_child]] = \
+        candidates[owns_child]
+    return children
+
+
+def link_points(prev_points, curr_points, strategy='greedy',
+                max_distance=30, gates=None, child_distance=50,
+                divisions=False):
+    """
+    Batch linker: links the tracks of the previous frame to the cells of
+    the current frame using only their positions.
+
+    Args:
+        prev_points: N x 2 array of track positions (most recent or
+            predicted)
+        curr_points: M x 2 array of cell positions in the current frame
+        strategy: 'greedy' matches every track to its closest cell and
+            decides which tracks divided with resolve_children;
+            'assignment' solves a global
+            assignment with birth, death and division costs
+            (assign_links)
+        max_distance: maximum link distance for 'assignment'
+        gates: optional per-track link distances for 'assignment'
+        child_distance: maximum distance of a child for 'greedy'
+        divisions: find divisions with 'greedy' (see resolve_children;
+            'assignment' always does, with its division cost)
+
+    Returns:
+        matches: N indices into curr_points (-1 for lost tracks)
+        children: N indices into curr_points of second daughters
+            (-1 if the track did not divide)
+        dists: N link distances (inf for lost tracks)
+    """
+    if strategy == 'greedy':
+        idxs, dists = get_closest_points(prev_points, curr_points)
+        children = resolve_children(idxs[:, 0], idxs[:, 1], dists[:, 1],
+                                    len(curr_points), child_distance,
+                                    divisions)
+        return idxs[:, 0], children, dists[:, 0]
+    elif strategy == 'assignment':
+        return assign_links(prev_points, curr_points, max_distance,
+                            gates=gates)
+    else:
+        print("Unknown linking strategy: " + str(strategy))
+        raise ValueError
+
+
+def assign_links(prev_points, curr_points, max_distance=30,
+                 birth_cost=None, death_cost=None, division_cost=None,
+                 gates=None):
+    """
+    Links the cells of two frames as a global linear assignment problem
+    instead of matching every cell to its nearest neighbours on its own.
+    Only pairs closer than max_distance are candidate links, so the
+    cost matrix is sparse. Every cell of the previous frame is either
+    linked (cost: distance) or disappears (cost: death_cost), and every
+    cell of the current frame is either linked or born (cost:
+    birth_cost). The assignment with the lowest total cost is found
+    with scipy's sparse minimum weight full bipartite matching, with
+    dummy nodes for the births and deaths. Cells of the current frame
+    left unlinked then become the second daughter of a linked cell if
+    that costs less than a birth (cost: distance + division_cost).
+
+    Args:
+        prev_points: N x 2 array of positions in the previous frame
+        curr_points: M x 2 array of positions in the current frame
+        max_distance: maximum distance of a link (gate)
+        birth_cost: cost of a new cell (default: max_distance)
+        death_cost: cost of a lost cell (default: max_distance)
+        division_cost: extra cost of a division
+            (default: max_distance / 2)
+        gates: optional N maximum link distances, one per cell of the
+            previous frame (at most max_distance)
+
+    Returns:
+        matches: N indices into curr_points (-1 for lost cells)
+        children: N indices into curr_points of second daughters
+            (-1 if the cell did not divide)
+        dists: N link distances (inf for lost cells)
+    """
+    if birth_cost is None:
+        birth_cost = max_distance
+    if death_cost is None:
+        death_cost = max_distance
+    if division_cost is None:
+        division_cost = max_distance / 2
+    prev_points = np.asarray(prev_points, dtype=np.float64).reshape(-1, 2)
+    curr_points = np.asarray(curr_points, dtype=np.float64).reshape(-1, 2)
+    n_prev = len(prev_points)
+    n_curr = len(curr_points)
+    matches = np.full(n_prev, -1, dtype=np.int64)
+    children = np.full(n_prev, -1, dtype=np.int64)
+    dists = np.full(n_prev, np.inf)
+    if n_prev == 0 or n_curr == 0:
+        return matches, children, dists
+
+    search_distance = max_distance
+    if gates is not None:
+        gates = np.minimum(np.asarray(gates, dtype=np.float64),
+                           max_distance)
+        search_distance = gates.max()
+    pairs = spatial.cKDTree(prev_points).sparse_distance_matrix(
+            spatial.cKDTree(curr_points), search_distance,
+            output_type='ndarray')
+    if gates is not None:
+        pairs = pairs[pairs['v'] <= gates[pairs['i']]]
+    link_i = pairs['i'].astype(np.int64)
+    link_j = pairs['j'].astype(np.int64)
+    link_d = pairs['v']
+
+    # rows: previous cells, then one birth node per current cell
+    # columns: current cells, then one death node per previous cell
+    # the birth -> death block lets unused links pair up their dummies
+    prev_idx = np.arange(n_prev)
+    curr_idx = np.arange(n_curr)
+    rows = np.concatenate((link_i, prev_idx, n_prev + curr_idx,
+                           n_prev + link_j))
+    cols = np.concatenate((link_j, n_curr + prev_idx, curr_idx,
+                           n_curr + link_i))
+    costs = np.concatenate((link_d, np.full(n_prev, death_cost),
+                            np.full(n_curr, birth_cost),
+                            np.zeros(len(link_i))))
+    # shift all costs by one so no edge has a zero weight (every full
+    # matching has the same number of edges, so the optimum is the same)
+    costs = costs + 1
+    size = n_prev + n_curr
+    graph = sparse.csr_matrix((costs, (rows, cols)), shape=(size, size))
+    row_ind, col_ind = csgraph.min_weight_full_bipartite_matching(graph)
+    assignment = np.empty(size, dtype=np.int64)
+    assignment[row_ind] = col_ind
+    assignment = assignment[:n_prev]
+
+    linked = assignment < n_curr
+    matches[linked] = assignment[linked]
+    curr_used = np.zeros(n_curr, dtype=bool)
+    curr_used[matches[linked]] = True
+    dists[linked] = np.hypot(*(curr_points[matches[linked]]
+                               - prev_points[linked]).T)
+
+    # divisions: closest unlinked cell / linked parent pairs first
+    division = linked[link_i] & ~curr_used[link_j] & \
+        (link_d + division_cost < birth_cost)
+    order = np.lexsort((link_j[division], link_i[division],
+                        link_d[division]))
+    for i, j in zip(link_i[division][order], link_j[division][order]):
+        if children[i] == -1 and not curr_used[j]:
+            children[i] = j
+            curr_used[j] = True
+    return matches, children, dists
+
+
+def get_cells_to_cull(cell_list, dist_threshold, motion=False):
     """
     Checks if any cells share a position in the most recent frame,
     and decides which cells should be culled based on distance between
@@ -320,55 +1582,75 @@ def get_cells_to_cull(cell_list, dist_threshold):
 
     Args:
         cell_list (list): A list of cell objects.
+        dist_threshold: maximum distance a cell can move in one frame
+        motion: use the distance of every cell from its predicted
+            position instead, and its gate (see update_motion)
+            as its threshold
 
     Returns:
-        cells_to_cull (set): A set containing the cells that should be culled.
+        cells_to_cull (list): A list of the cells that should be
+            culled, each once, in the order they were found.
     """
 
     cells_to_cull = []
+    if len(cell_list) == 0:
+        return cells_to_cull
+    # two most recent coordinates of every cell
+    try:
+        curr_positions, prev_positions = get_recent_coords(cell_list, 2)
+    except IndexError:
+        print("No coordinates found for linking")
+        raise IndexError
+    # get distance between two most recent coords
+    # (cells born in this frame have no previous position: they
+    # lose position conflicts but are not checked for jumps)
+    is_newborn = np.all(prev_positions == -1, axis=1)
+    dists = np.sqrt(((curr_positions - prev_positions) ** 2).sum(axis=1))
+    thresholds = np.full(len(cell_list), float(dist_threshold))
+    if motion:
+        for i, curr_cell in enumerate(cell_list):
+            if curr_cell.prediction_error is not None:
+                dists[i] = curr_cell.prediction_error
+                thresholds[i] = curr_cell.motion_gate
+    dists[is_newborn] = float('inf')
+    is_jump = ~is_newborn & (dists > thresholds)
+
+    # only cells that share their position or jump can be culled
+    # (adding 0.0 makes -0.0 and 0.0 the same position)
+    _, position_ids, position_counts = np.unique(
+        curr_positions + 0.0, axis=0, return_inverse=True,
+        return_counts=True)
+    position_ids = position_ids.reshape(-1)
+    is_shared = position_counts[position_ids] > 1
+
+    # cells seen so far at each position, in list order
     positions_dict = {}
-    for curr_cell in cell_list:
-        # get most recent position
-        curr_position = curr_cell.get_most_recent_coord()
-        # get distance between two most recent coords
-        curr_dist = dist_between_points(curr_cell.coords[
-                                        len(curr_cell.coords)-2],
-                                        curr_position)
+    for i in np.flatnonzero(is_shared | is_jump):
+        curr_cell = cell_list[i]
+        curr_dist = dists[i]
 
         is_duplicate = False
         # if position is already in list,
         # figure out which cell should be culled
-        for comparison_cell in positions_dict:
+        comparison_indexes = positions_dict.setdefault(position_ids[i], [])
+        for j in comparison_indexes:
             # FIRST, get cells to cull based on duplicates
-            comparison_position = positions_dict[comparison_cell]
-            if curr_position == comparison_position:
-                # check which cell was closer to new position
-
-                try:
-                    comparison_dist = dist_between_points(
-                                      comparison_cell.coords[
-                                            len(comparison_cell.coords)-2],
-                                      comparison_position)
-                except IndexError:
-                    print("No coordinates found for linking")
-                    raise IndexError
-
-                if comparison_dist < curr_dist:
-                    cells_to_cull.append(curr_cell)
-                    is_duplicate = True
-                else:
-                    cells_to_cull.append(comparison_cell)
-        # SECOND, get cells to cull based on big jumps
-        if not is_duplicate:
-            # check if current position is over a
-            # threshold from previous position
-            if curr_dist > dist_threshold:
+            # check which cell was closer to new position
+            if dists[j] < curr_dist:
                 cells_to_cull.append(curr_cell)
+                is_duplicate = True
+            else:
+                cells_to_cull.append(cell_list[j])
+        # SECOND, get cells to cull based on big jumps
+        if not is_duplicate and is_jump[i]:
+            cells_to_cull.append(curr_cell)
 
         # add to positions list
-        positions_dict[curr_cell] = curr_position
+        comparison_indexes.append(i)
 
-    cells_to_cull = set(cells_to_cull)
+    # drop repeats, keeping the order the cells were found in,
+    # so culling does not depend on set iteration order
+    cells_to_cull = list(dict.fromkeys(cells_to_cull))
     return cells_to_cull
 
 
@@ -387,13 +1669,15 @@ def cull_duplicates(cell_list, problematic_cells):
             list that are not in problematic_cells.
     """
 
-    culled_set = set(cell_list).difference(set(problematic_cells))
+    culled_set = set(problematic_cells)
 
-    resolved_tracks = list(culled_set)
+    # keep the order of the cell list
+    resolved_tracks = [cell for cell in dict.fromkeys(cell_list)
+                       if cell not in culled_set]
     return resolved_tracks
 
 
-def resolve_child_conflicts(candidates, child_dist_thresh):
+def resolve_child_conflicts(candidates, child_dist_thresh, divisions=False):
     """
     Ensures that each child only has one parent.
     Checks if new cell and possible child tracks
@@ -409,6 +1693,10 @@ def resolve_child_conflicts(candidates, child_dist_thresh):
         child_dist_thresh (int): The maximum distance between the parent cell
             and possible child cell such that the child cell can be assigned to
             that parent.
+        divisions (bool): Only compare a master cell's claim on its
+            potential child with the claims of the other master cells.
+            By default it is also compared with itself, which ties, so
+            no child is kept.
 
     Returns:
         resolved_tracks: A list with same length as candidates list,
@@ -423,58 +1711,64 @@ def resolve_child_conflicts(candidates, child_dist_thresh):
         added to the master cell list with its parent being matched
         to the cell with corresponding index in the master cell list.
     """
-    # loop over candidates
-    # print(candidates.shape)
-    resolved_tracks = np.empty(len(candidates), dtype=object)
-    for i in range(0, len(candidates)):
-
+    # unpack the two closest cells of every master cell once
+    most_likely_cells = []
+    pot_child_cells = []
+    pot_child_dists = []
+    for curr_candidates in candidates:
         # dictionary with 2 entries, key is cell, value is distance
-        curr_candidates = candidates[i]
         keys = list(curr_candidates.keys())
-
         try:
-            most_likely_cell = keys[0]
-            most_likely_dist = curr_candidates[most_likely_cell]
-            pot_child_cell = keys[1]
-            pot_child_dist = curr_candidates[pot_child_cell]
+            most_likely_cells.append(keys[0])
+            pot_child_cells.append(keys[1])
+            pot_child_dists.append(curr_candidates[keys[1]])
         except IndexError:
             print("Candidates missing")
             raise IndexError
 
+    # reverse indexes: cells that are the most likely cell of any master
+    # cell, and the closest and second closest distances of each
+    # potential child from the master cells that claim it
+    claimed_cells = set(most_likely_cells)
+    child_claims = {}
+    for pot_child_cell, pot_child_dist in zip(pot_child_cells,
+                                              pot_child_dists):
+        closest = child_claims.get(pot_child_cell, [float('inf'),
+                                                    float('inf')])
+        if pot_child_dist < closest[0]:
+            closest = [pot_child_dist, closest[0]]
+        elif pot_child_dist < closest[1]:
+            closest = [closest[0], pot_child_dist]
+        child_claims[pot_child_cell] = closest
+
+    resolved_tracks = np.empty(len(candidates), dtype=object)
+    for i in range(0, len(candidates)):
+        most_likely_cell = most_likely_cells[i]
+        pot_child_cell = pot_child_cells[i]
+        pot_child_dist = pot_child_dists[i]
+
         # check that any potential child is within threshold
         # if not, because original most likely distance is within threshold,
         # add most likely cell -- NOT pot_child
         if pot_child_dist > child_dist_thresh:
             resolved_tracks[i] = [most_likely_cell]
-        # check if potential child is most likely of any other cell
-        # if not, check if it's a potential child of any others
+        # a potential child that is the most likely cell of any master
+        # cell is never a child
+        elif pot_child_cell in claimed_cells:
+            resolved_tracks[i] = [most_likely_cell]
+        # otherwise the child goes to a master cell only if it is closer
+        # than every claim on it; the master cell's own claim is one of
+        # them (as in the original pairwise comparison), so it ties,
+        # unless divisions is set: then the child goes to the closest
+        # master cell claiming it, and to none if two are equally close
         else:
-            owns_child = True
-
-            for comparison_candidates in candidates:
-                try:
-                    comparison_keys = list(comparison_candidates.keys())
-                    comp_most_likely_cell = comparison_keys[0]
-                    comp_pot_child_cell = comparison_keys[1]
-                    comp_pot_child_dist = comparison_candidates[
-                                          comp_pot_child_cell]
-                except IndexError:
-                    print("Candidates missing")
-                    raise IndexError
-
-                if pot_child_cell == comp_most_likely_cell:
-                    owns_child = False
-                    # resolved_tracks[i] = [most_likely_cell]
-                    break
-                elif pot_child_cell == comp_pot_child_cell:
-                    # check distances between child and two master cells
-
-                    if pot_child_dist >= comp_pot_child_dist:
-                        # if child is closer to current cell,
-                        # add it to resolved track
-                        owns_child = False
-
-            if owns_child is True:
+            closest_dist, second_dist = child_claims[pot_child_cell]
+            if divisions:
+                owns_child = pot_child_dist == closest_dist and \
+                    pot_child_dist < second_dist
+            else:
+                owns_child = pot_child_dist < closest_dist
+            if owns_child:
                 resolved_tracks[i] = [most_likely_cell, pot_child_cell]
             else:
                 resolved_tracks[i] = [most_likely_cell]
@@ -482,7 +1776,9 @@ def resolve_child_conflicts(candidates, child_dist_thresh):
     return resolved_tracks
 
 
-def link_next_frame(master_cell_list, frame, frame_num):
+def link_next_frame(master_cell_list, frame, frame_num,
+                    segmentation_cache=None, segmentation_params=None,
+                    **linking_params):
     """
     Links all of the cells in a new frame to the cell
     lineages in the master cell list (and all previous frames).
@@ -494,71 +1790,285 @@ def link_next_frame(master_cell_list, frame, frame_num):
         master_cell_list: list of cells
         curr_frame: image from current frame to segment
         frame_num: frame number (used to note cell "birthdays")
+        segmentation_cache: optional seg_cache.SegmentationCache used to
+            skip segmenting frames that have been segmented before
+        segmentation_params: optional dictionary of segment_frame
+            arguments (e.g. {'tile_size': 512})
+        linking_params: arguments of link_frame_cells
+            (e.g. strategy='assignment')
 
     Returns:
         new_cells: updated list of cells based on new data
     """
     # get all the cells in the current frame
+    if segmentation_params is None:
+        segmentation_params = {}
+    curr_frame_cells = get_frame_cells(frame, segmentation_cache,
+                                       **segmentation_params)
+    return link_frame_cells(master_cell_list, curr_frame_cells, frame_num,
+                            **linking_params)
 
-    curr_frame_cells = do_watershed(frame)
 
-    # check cells against previous frame
-    candidates = np.empty(len(master_cell_list), dtype=object)
-    for i in range(0, len(master_cell_list)):
-        # get closest two cells
-        cell = master_cell_list[i]
-        closest_cells = link_cell(cell, curr_frame_cells)
-        candidates[i] = closest_cells
+def link_frame_cells(master_cell_list, curr_frame_cells, frame_num,
+                     strategy='greedy', max_distance=30, lost_tracks=None,
+                     motion=False, track_store=None, divisions=False):
+    """
+    Links the cells of an already segmented frame to the cell lineages
+    in the master cell list (see link_next_frame). Linking only needs
+    the cells of each frame, so frames can be segmented ahead of time
+    (e.g. in parallel) and linked here in frame order. The links are
+    found from the positions alone by link_points; this only gathers
+    the positions and adds the linked cells to the tracks.
+
+    Args:
+        master_cell_list: list of cells
+        curr_frame_cells: cells of the current frame
+            (from cells_from_segmentation)
+        frame_num: frame number (used to note cell "birthdays")
+        strategy: linking strategy of link_points ('greedy' or
+            'assignment'); with 'assignment', cells of the current frame
+            that are not linked to any track are added as new cells
+        max_distance: maximum link distance for 'assignment'
+        lost_tracks: optional LostTracks pool; cells of the current
+            frame that are not linked are first used to reconnect lost
+            tracks, and cells of the master cell list that are not
+            linked are added to it
+        motion: search around the position predicted from the velocity
+            of every cell instead of its most recent position, and
+            for 'assignment' gate every link by how well the cell's
+            motion has been predicted so far (get_motion_gate)
+        track_store: optional track_store.TrackStore new cells
+            (children and new cells) are created in
+        divisions: find divisions with 'greedy' (see link_points)
 
-    # now we have list of possible candidates
-    # want to make sure that each cell has
-    # one & only one candidate child (or 2 in the case it divided)
-    resolved_tracks = resolve_child_conflicts(candidates, 50)
+    Returns:
+        new_cells: updated list of cells based on new data
+    """
+    make_cell = Cell if track_store is None else track_store.new_cell
+    if motion:
+        prev_points = [predict_position(cell) for cell in master_cell_list]
+        gates = [get_motion_gate(cell, max_distance)
+                 for cell in master_cell_list]
+    else:
+        prev_points = get_recent_coords(master_cell_list)[0]
+        gates = None
+    curr_points = [cell.coords[0] for cell in curr_frame_cells]
+    matches, children, dists = link_points(prev_points, curr_points,
+                                           strategy, max_distance, gates,
+                                           divisions=divisions)
+
+    # cells of the current frame that are not linked to any track
+    is_linked = np.zeros(len(curr_frame_cells), dtype=bool)
+    is_linked[matches[matches != -1]] = True
+    is_linked[children[children != -1]] = True
+    unlinked_cells = [curr_frame_cells[j]
+                      for j in np.flatnonzero(~is_linked)]
+    # reconnect lost tracks to the cells that were not linked
+    reconnected_cells = []
+    if lost_tracks is not None:
+        reconnected_cells, unlinked_cells = lost_tracks.reconnect(
+                                            unlinked_cells, frame_num)
+    # the remaining cells are new cells for 'assignment',
+    # and are dropped for 'greedy'
+    born_cells = []
+    if strategy == 'assignment':
+        born_cells = unlinked_cells
 
     # initialize list of new cells to add
     new_cells = []
-    # loop over resolved tracks and add to master cell list
-    for i in range(0, len(master_cell_list)):
-        # get current cell from master cell list
-        curr_cell = master_cell_list[i]
-        # if there was a big gap, cull cell, don't add to new cell list
-        if len(resolved_tracks[i]) == 0:
-            pass
-        # if there's one child, add it to master cell object
-        elif len(resolved_tracks[i]) == 1:
-            # add coord and contour from closest cell to master cell object
-            curr_cell.add_coordinate(resolved_tracks[i][0].coords[0])
-            curr_cell.add_contour(resolved_tracks[i][0].contours[0])
-            curr_cell.add_channel3_data(resolved_tracks[i][0].channel3_data[0])
-            curr_cell.add_channel2_data(
-                    resolved_tracks[i][0].channel2_data[0])
-            new_cells.append(curr_cell)
-        elif len(resolved_tracks[i]) == 2:
+    lost_cells = []
+    # cells that get a cell of the current frame, and those cells
+    linked_cells = []
+    linked_frame_cells = []
+    for i, curr_cell in enumerate(master_cell_list):
+        # if there was a big gap, the cell is lost
+        if matches[i] == -1:
+            lost_cells.append(curr_cell)
+            continue
+        if children[i] != -1:
             # create new cell in master list with parent history
-            new_cell = Cell(parent=curr_cell, birthday=frame_num)
-
-            # give child its tracking
-            new_cell.add_coordinate(resolved_tracks[i][1].coords[0])
-            new_cell.add_contour(resolved_tracks[i][1].contours[0])
-            new_cell.add_channel3_data(resolved_tracks[i][1].channel3_avg[0])
-            new_cell.add_channel2_data(
-                    resolved_tracks[i][1].channel2_ratio[0])
+            new_cell = make_cell(parent=curr_cell, birthday=frame_num)
+            linked_cells.append(new_cell)
+            linked_frame_cells.append(curr_frame_cells[children[i]])
             new_cells.append(new_cell)
-
             # give parent its child
             curr_cell.add_child(new_cell)
-            # give parent its tracking info
-            curr_cell.add_coordinate(resolved_tracks[i][0].coords[0])
-            curr_cell.add_contour(resolved_tracks[i][0].contours[0])
-            curr_cell.add_channel3_avg(resolved_tracks[i][0].channel3_avg[0])
-            curr_cell.add_channel2_ratio(
-                    resolved_tracks[i][0].channel2_ratio[0])
-            new_cells.append(curr_cell)
+        # add coord and contour from closest cell to master cell object
+        linked_cells.append(curr_cell)
+        linked_frame_cells.append(curr_frame_cells[matches[i]])
+        new_cells.append(curr_cell)
+
+    if lost_tracks is not None:
+        lost_tracks.add(lost_cells)
+    new_cells.extend(reconnected_cells)
 
     # add newborn cells to master cell list
+    for born_cell in born_cells:
+        new_cell = make_cell(birthday=frame_num)
+        new_cell.backfill(frame_num)
+        linked_cells.append(new_cell)
+        linked_frame_cells.append(born_cell)
+        new_cells.append(new_cell)
+
+    add_frame_cells(linked_cells, linked_frame_cells)
+    if motion:
+        for i in np.flatnonzero(matches != -1):
+            update_motion(master_cell_list[i], prev_points[i], gates[i])
     return new_cells
 
 
+def add_frame_cell(cell, frame_cell):
+    """
+    Adds the position, contour and channel data of a cell of the
+    current frame (from cells_from_segmentation) to a track.
+    """
+    cell.add_coordinate(frame_cell.coords[0])
+    cell.add_contour(frame_cell.contours[0])
+    cell.add_channel3_data(frame_cell.channel3_data[0])
+    cell.add_channel2_data(frame_cell.channel2_data[0])
+
+
+def get_recent_coords(cell_list, n_coords=1):
+    """
+    Gets the most recent coordinates of every cell (cell.coords[-1],
+    cell.coords[-2], ...). Tracks of a track_store.TrackStore are read
+    from its columns at once.
+
+    Returns:
+        coords: n_coords x len(cell_list) x 2 array, most recent first
+    """
+    if len(cell_list) > 0 and hasattr(cell_list[0], 'store'):
+        coords = cell_list[0].store.get_coords(cell_list, n_coords)
+        if coords is not None:
+            return coords
+    return np.array([[cell.coords[len(cell.coords) - 1 - age]
+                      for cell in cell_list] for age in range(n_coords)],
+                    dtype=float).reshape(n_coords, -1, 2)
+
+
+def add_frame_cells(cell_list, frame_cells):
+    """
+    Adds cells of the current frame to many tracks (see add_frame_cell).
+    Tracks of a track_store.TrackStore are written to its columns
+    at once.
+    """
+    if len(cell_list) > 0 and hasattr(cell_list[0], 'store') and \
+            cell_list[0].store.add_frames(cell_list, frame_cells):
+        return
+    for cell, frame_cell in zip(cell_list, frame_cells):
+        add_frame_cell(cell, frame_cell)
+
+
+class LostTracks:
+    """Pool of recently lost tracks for gap closing.
+
+    Tracks dropped while linking (link_frame_cells) or culled by
+    correct_links are kept for up to max_gap frames and reconnected to
+    cells of later frames that were not linked to any track, so a
+    nucleus missed by the segmentation for a few frames keeps its
+    track. The missing frames are filled like the frames before a cell
+    was born: coordinate (-1, -1), no contour and no channel data.
+
+    Args:
+        max_gap: maximum number of missing frames bridged
+        max_distance: maximum distance between the last position of a
+            lost track and the cell it is reconnected to
+        max_size: maximum number of lost tracks kept; the tracks lost
+            first are dropped first
+    """
+
+    def __init__(self, max_gap=3, max_distance=30, max_size=10000):
+        self.max_gap = max_gap
+        self.max_distance = max_distance
+        self.max_size = max_size
+        # lost cell -> frame of its last trusted position,
+        # in the order the cells were lost
+        self.tracks = {}
+        self.n_reconnected = 0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, cells):
+        """
+        Adds lost cells to the pool. The most recent positions of a
+        problematic cell (see correct_links) are not trusted, so its
+        track continues from the position before it became problematic.
+        """
+        for cell in cells:
+            last_frame = len(cell.coords) - 1 - cell.problematic
+            if last_frame < 0 or \
+                    tuple(cell.coords[last_frame]) == (-1, -1):
+                continue
+            self.tracks.pop(cell, None)
+            self.tracks[cell] = last_frame
+        while len(self.tracks) > self.max_size:
+            del self.tracks[next(iter(self.tracks))]
+
+    def expire(self, frame_num):
+        """
+        Drops the tracks that would have more than max_gap missing
+        frames if they were reconnected in frame frame_num.
+        """
+        self.tracks = {cell: last_frame
+                       for cell, last_frame in self.tracks.items()
+                       if frame_num - last_frame - 1 <= self.max_gap}
+
+    def reconnect(self, curr_frame_cells, frame_num):
+        """
+        Reconnects lost tracks to cells of the current frame. Last
+        positions and cells are linked at once as an assignment problem
+        without divisions (see assign_links).
+
+        Args:
+            curr_frame_cells: cells of the current frame that are not
+                linked to any track
+            frame_num: frame number
+
+        Returns:
+            reconnected_cells: lost cells continued with a cell of the
+                current frame
+            unlinked_cells: cells of the current frame that were not
+                reconnected
+        """
+        self.expire(frame_num)
+        if len(self.tracks) == 0 or len(curr_frame_cells) == 0:
+            return [], list(curr_frame_cells)
+
+        lost_cells = list(self.tracks)
+        prev_points = [cell.coords[self.tracks[cell]] for cell in lost_cells]
+        curr_points = [cell.coords[0] for cell in curr_frame_cells]
+        matches, _, _ = assign_links(prev_points, curr_points,
+                                     self.max_distance,
+                                     division_cost=float('inf'))
+        reconnected_cells = []
+        for cell, j in zip(lost_cells, matches):
+            if j == -1:
+                continue
+            last_frame = self.tracks.pop(cell)
+            # forget the untrusted positions and fill the gap
+            gap = frame_num - last_frame - 1
+            cell.coords = cell.coords[:last_frame + 1] + [(-1, -1)] * gap
+            cell.channel3_data = cell.channel3_data[:last_frame + 1] + \
+                [np.nan] * gap
+            cell.channel2_data = cell.channel2_data[:last_frame + 1] + \
+                [np.nan] * gap
+            cell.contours = cell.contours[:last_frame + 1] + [None] * gap
+            add_frame_cell(cell, curr_frame_cells[j])
+            cell.problematic = 0
+            cell.velocity = None
+            cell.prediction_error = None
+            cell.motion_gate = None
+            cell.motion_error = None
+            reconnected_cells.append(cell)
+        self.n_reconnected += len(reconnected_cells)
+        linked = set(matches[matches != -1])
+        unlinked_cells = [curr_frame_cells[j]
+                          for j in range(len(curr_frame_cells))
+                          if j not in linked]
+        return reconnected_cells, unlinked_cells
+
+
 def track_healing(cell_list, dist_thresh):
     """
     Takes a list of problematic cells and attempts to fix
@@ -672,9 +2182,12 @@ def get_all_death_row(cell_list):
         return problem_cells
 
 
-def correct_links(cell_list, distance_threshold):
+def correct_links(cell_list, distance_threshold, lost_tracks=None,
+                  motion=False, problematic_cells=None):
     """
     Corrects a cell list by identifying and culling problematic cells.
+    The order of the cells that are kept does not change, so tracking
+    the same frames always gives the same cell order.
 
     Args:
         cell_list (list): A list of cell objects.
@@ -683,6 +2196,15 @@ def correct_links(cell_list, distance_threshold):
             that travel further than this threshold are assumed
             to have been misidentified and will be marked
             problematic.
+        lost_tracks: optional LostTracks pool the culled cells
+            are added to (for gap closing)
+        motion: measure how far cells moved from their predicted
+            positions (see get_cells_to_cull)
+        problematic_cells: optional dictionary used as an ordered set of
+            the cells marked problematic by the previous call, updated
+            in place. When correcting frame after frame, this saves
+            scanning the whole cell list for problematic cells; without
+            it, the cell list is scanned (get_all_problematics).
 
     Returns:
       corrected_cell_list (list):
@@ -691,47 +2213,44 @@ def correct_links(cell_list, distance_threshold):
     """
     # get old problematic cells
     # all should have problematic value of 1 here
-    old_problematics = get_all_problematics(cell_list)
+    if problematic_cells is None:
+        old_problematics = get_all_problematics(cell_list)
+    else:
+        # cells dropped from the cell list since the last call (e.g. lost
+        # while linking) have not been extended with the current frame
+        n_coords = len(cell_list[0].coords) if len(cell_list) > 0 else 0
+        old_problematics = [cell for cell in problematic_cells
+                            if cell.problematic == 1 and
+                            len(cell.coords) == n_coords]
+        problematic_cells.clear()
+
+    corrected_cell_list = cell_list
     # attempt to deal with these through track healing
-    if old_problematics is not None:
+    if old_problematics is not None and len(old_problematics) > 0:
         healed_tracks = track_healing(old_problematics, distance_threshold)
         # see which of these are still problematic
         death_row = get_all_death_row(healed_tracks)
         # cull still problematic cells
         if death_row is not None:
-            corrected_cell_list = cull_duplicates(cell_list, death_row)
-        else:
-            corrected_cell_list = cell_list
+            culled = set(death_row)
+            corrected_cell_list = [cell for cell in cell_list
+                                   if cell not in culled]
+            if lost_tracks is not None:
+                lost_tracks.add(death_row)
         # now there should be no problematic cells left
         # they have been either culled or healed
-        # so now, can get new problematic cells
-        # note distthresh is divided by 2 because distthresh
-        # is based on what is reasonable
-        # for the cell to have moved across 2 frames,
-        # here we want only what is reasonable movement for one frame
-        current_problematic_cells = get_cells_to_cull(
-                                    corrected_cell_list,
-                                    distance_threshold/2)
-        current_problematic_cells = increment_all_problematics(
-                                    current_problematic_cells)
-
-        corrected_cell_list = list(set(
-                              corrected_cell_list).difference(
-                                  set(current_problematic_cells)))
-        corrected_cell_list.extend(current_problematic_cells)
-
-        return corrected_cell_list
-    else:
-        # if there are no problematics from the last frame,
-        # just get the current problematic cells and set to 1
-        current_problematic_cells = get_cells_to_cull(
-                                    cell_list, distance_threshold/2)
-        # incremenet problematic for all current cells
-        current_problematic_cells = increment_all_problematics(
-                                    current_problematic_cells)
-
-        corrected_cell_list = list(set(cell_list).difference(
-                                set(current_problematic_cells)))
-        corrected_cell_list.extend(current_problematic_cells)
-
-        return corrected_cell_list
+
+    # so now, can get new problematic cells
+    # note distthresh is divided by 2 because distthresh
+    # is based on what is reasonable
+    # for the cell to have moved across 2 frames,
+    # here we want only what is reasonable movement for one frame
+    current_problematic_cells = get_cells_to_cull(corrected_cell_list,
+                                                  distance_threshold/2,
+                                                  motion)
+    # increment problematic for all current cells
+    increment_all_problematics(current_problematic_cells)
+    if problematic_cells is not None:
+        problematic_cells.update(dict.fromkeys(current_problematic_cells))
+
+    return corrected_cell_list
@@ -4,7 +4,18 @@ sys.path.insert(0, 'src/')  # noqa
 
 import tracking_utils
 import unittest
+from unittest import mock
 import read_nd2
+import do_tracking
+import do_batch
+import plots
+import frame_cache
+import seg_cache
+import segmentation_accuracy
+import track_store
+import os
+import tempfile
+import time
 import numpy as np
 import random
 import cv2
@@ -39,6 +50,203 @@ class TestCellTracking(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             read_nd2.read_nd2("doc/fake.nd2")
 
+    # testing LazyMovie
+    def test_lazy_movie_access(self):
+        planes = np.random.randint(0, 65535, (2, 3, 3, 20, 10),
+                                   dtype=np.uint16)
+        reads = []
+
+        def plane_reader(site, frame, channel):
+            reads.append((site, frame, channel))
+            return planes[site, frame, channel]
+
+        sizes = {'v': 2, 't': 3, 'c': 3, 'y': 20, 'x': 10}
+        movie = read_nd2.LazyMovie(plane_reader, sizes, cache_size=4)
+        site1 = read_nd2.get_site_data(movie, 1)
+        frame = read_nd2.get_frame_data(movie, 1, 2)
+        # nothing decoded until pixels are touched
+        self.assertEqual(reads, [])
+        self.assertEqual(len(site1), 3)
+        self.assertEqual(frame.shape, (20, 10, 3))
+
+        nuc = read_nd2.get_channel_rawData(movie, 1, 2, 0)
+        self.assertTrue(np.array_equal(nuc, planes[1, 2, 0]))
+        self.assertEqual(reads, [(1, 2, 0)])
+        self.assertTrue(np.array_equal(np.asarray(frame),
+                                       planes[1, 2].transpose((1, 2, 0))))
+
+    def test_lazy_movie_lru_cache(self):
+        reads = []
+
+        def plane_reader(site, frame, channel):
+            reads.append((site, frame, channel))
+            return np.zeros((4, 4), dtype=np.uint16)
+
+        sizes = {'v': 1, 't': 5, 'c': 1, 'y': 4, 'x': 4}
+        movie = read_nd2.LazyMovie(plane_reader, sizes, cache_size=2)
+        read_nd2.get_channel_rawData(movie, 0, 0, 0)
+        read_nd2.get_channel_rawData(movie, 0, 0, 0)
+        self.assertEqual(len(reads), 1)
+        read_nd2.get_channel_rawData(movie, 0, 1, 0)
+        read_nd2.get_channel_rawData(movie, 0, 2, 0)
+        # frame 0 was evicted and has to be decoded again
+        read_nd2.get_channel_rawData(movie, 0, 0, 0)
+        self.assertEqual(len(reads), 4)
+        self.assertLessEqual(len(movie._planes), 2)
+
+    def test_lazy_movie_bad_access(self):
+        sizes = {'v': 2, 't': 2, 'c': 3, 'y': 4, 'x': 4}
+        movie = read_nd2.LazyMovie(lambda s, f, c: np.zeros((4, 4)), sizes)
+        with self.assertRaises(KeyError):
+            read_nd2.get_site_data(movie, 2)
+        with self.assertRaises(KeyError):
+            read_nd2.get_frame_data(movie, 0, 2)
+        with self.assertRaises(IndexError):
+            read_nd2.get_channel_rawData(movie, 0, 0, 3)
+
+    def test_plane_stack_channel_subset(self):
+        planes = {0: np.arange(12).reshape(3, 4), 2: np.ones((3, 4))}
+        stack = read_nd2.PlaneStack(planes, 3)
+        self.assertEqual(stack.shape, (3, 4, 3))
+        self.assertTrue(np.array_equal(stack[:, :, 0], planes[0]))
+        self.assertTrue(np.array_equal(stack[1:3, 0:2, 0],
+                                       planes[0][1:3, 0:2]))
+        # channel 1 was not read
+        with self.assertRaises(IndexError):
+            stack[:, :, 1]
+
+    def test_read_nd2_channel_subset_without_channel_0(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        reads = []
+
+        class ND2Reader:
+            sizes = {'v': 1, 't': 2, 'c': 3}
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def get_frame_2D(self, c, t, v):
+                reads.append(c)
+                return image[:, :, c]
+
+        with mock.patch.object(read_nd2.nd2reader, 'ND2Reader',
+                               lambda nd2_filename: ND2Reader()):
+            movie = read_nd2.read_nd2("movie.nd2", channels=[1, 2])
+        self.assertEqual(reads, [1, 2, 1, 2])
+        frame = movie[0][1]
+        self.assertEqual(frame.shape, image.shape)
+        self.assertTrue(np.array_equal(frame[:, :, 2], image[:, :, 2]))
+        with self.assertRaises(IndexError):
+            frame[:, :, 0]
+
+    def test_lazy_frame_roi_only_decodes_channel(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        reads = []
+
+        def plane_reader(site, frame, channel):
+            reads.append(channel)
+            return image[:, :, channel]
+
+        sizes = {'v': 1, 't': 1, 'c': 3,
+                 'y': image.shape[0], 'x': image.shape[1]}
+        movie = read_nd2.LazyMovie(plane_reader, sizes)
+        frame = read_nd2.get_frame_data(movie, 0, 0)
+        rect = tracking_utils.do_watershed(image)[0].contours[0]
+        self.assertEqual(
+            tracking_utils.get_channel_data_within_nuc_contour(
+                frame, rect, channel=2, invert=True),
+            tracking_utils.get_channel_data_within_nuc_contour(
+                image, rect, channel=2, invert=True))
+        self.assertEqual(reads, [2])
+
+    # testing prefetch_frames
+    def test_prefetch_frames_order(self):
+        frames = [(i, np.full((4, 4, 3), i)) for i in range(5)]
+        output = list(read_nd2.prefetch_frames(iter(frames), depth=2))
+        self.assertEqual([frame_num for frame_num, _ in output],
+                         list(range(5)))
+        for frame_num, stack in output:
+            self.assertIsInstance(stack, read_nd2.PlaneStack)
+            self.assertTrue(np.all(stack[:, :, 2] == frame_num))
+
+    def test_prefetch_frames_bounded(self):
+        produced = []
+
+        def frames():
+            for i in range(10):
+                produced.append(i)
+                yield i, np.zeros((2, 2, 1))
+
+        prefetched = read_nd2.prefetch_frames(frames(), depth=2)
+        next(prefetched)
+        time.sleep(0.2)
+        # one frame consumed, at most depth queued and one being read
+        self.assertLessEqual(len(produced), 4)
+        prefetched.close()
+
+    def test_prefetch_frames_error(self):
+        def frames():
+            yield 0, np.zeros((2, 2, 1))
+            raise KeyError(1)
+
+        with self.assertRaises(KeyError):
+            list(read_nd2.prefetch_frames(frames(), depth=1))
+
+    # testing frame_cache
+    def test_frame_cache_round_trip(self):
+        planes = np.random.randint(0, 65535, (2, 3, 3, 20, 10),
+                                   dtype=np.uint16)
+        sizes = {'v': 2, 't': 3, 'c': 3, 'y': 20, 'x': 10}
+        movie = read_nd2.LazyMovie(lambda s, f, c: planes[s, f, c], sizes)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store_path = os.path.join(cache_dir, 'store')
+            # nothing cached yet
+            self.assertIsNone(frame_cache.open_store(store_path))
+            frame_cache.write_store(movie, store_path)
+            cached = frame_cache.open_store(store_path)
+            self.assertEqual(len(cached), 2)
+            self.assertEqual(len(read_nd2.get_site_data(cached, 1)), 3)
+            plane = read_nd2.get_channel_rawData(cached, 1, 2, 1)
+            # chunks are memory-mapped, not copied
+            self.assertFalse(plane.flags['OWNDATA'])
+            self.assertTrue(np.array_equal(plane, planes[1, 2, 1]))
+
+    def test_frame_cache_key_changes_with_file(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            nd2_path = os.path.join(cache_dir, 'movie.nd2')
+            with open(nd2_path, 'wb') as f:
+                f.write(b'1234')
+            key = frame_cache.get_cache_key(nd2_path)
+            self.assertEqual(key, frame_cache.get_cache_key(nd2_path))
+            with open(nd2_path, 'ab') as f:
+                f.write(b'5678')
+            self.assertNotEqual(key, frame_cache.get_cache_key(nd2_path))
+
+    def test_frame_cache_eviction(self):
+        sizes = {'v': 1, 't': 1, 'c': 1, 'y': 100, 'x': 100}
+        movie = read_nd2.LazyMovie(
+                lambda s, f, c: np.zeros((100, 100), dtype=np.uint16), sizes)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store_paths = []
+            for i in range(3):
+                store_path = os.path.join(cache_dir, str(i))
+                frame_cache.write_store(movie, store_path)
+                meta_path = os.path.join(store_path, frame_cache.META_FILE)
+                os.utime(meta_path, (i, i))
+                store_paths.append(store_path)
+            store_size = frame_cache.get_store_size(store_paths[0])
+            # only room for two stores, oldest is removed
+            removed = frame_cache.evict_cache(cache_dir, 2 * store_size)
+            self.assertEqual(removed, [store_paths[0]])
+            # kept store is never removed
+            removed = frame_cache.evict_cache(cache_dir, 0,
+                                              keep=store_paths[1])
+            self.assertEqual(removed, [store_paths[2]])
+            self.assertTrue(os.path.isdir(store_paths[1]))
+
     # testing get_center()
     def test_get_center_output_type(self):
         test_contour = (np.array([[[1297, 2030]], [[1296, 2031]],
@@ -169,6 +377,373 @@ class TestCellTracking(unittest.TestCase):
         self.assertLess(len(cells), expected_cells+1)
         self.assertGreater(len(cells), 0.5*expected_cells)
 
+    # testing watershed_labels()
+    def test_watershed_labels_matches_rgb_pipeline(self):
+        img = cv2.imread("test/data/test_image.png", cv2.IMREAD_UNCHANGED)
+        # reference: normalize a 3-channel copy, then convert to gray
+        rgb_nuc = cv2.normalize(np.dstack((img, img, img)), None, 0, 255,
+                                cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        grayscale = cv2.cvtColor(rgb_nuc, cv2.COLOR_BGR2GRAY)
+        thresh = cv2.threshold(grayscale, 0, 255,
+                               cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        sure_bg = cv2.dilate(thresh, kernel, iterations=3)
+        dist = cv2.distanceTransform(thresh, cv2.DIST_L2, 5)
+        sure_fg = cv2.threshold(dist, 0.2 * dist.max(), 255,
+                                cv2.THRESH_BINARY)[1].astype(np.uint8)
+        unknown = cv2.subtract(sure_bg, sure_fg)
+        expected = cv2.connectedComponents(sure_fg)[1].astype(np.int32) + 1
+        expected[unknown == 255] = 0
+        expected = cv2.watershed(rgb_nuc, expected)
+
+        markers = tracking_utils.watershed_labels(img)
+        self.assertTrue(np.array_equal(markers, expected))
+        # the work buffers are reused, the labels are not
+        again = tracking_utils.watershed_labels(img)
+        self.assertTrue(np.array_equal(again, expected))
+        self.assertFalse(np.shares_memory(markers, again))
+
+    def test_get_work_buffer_reused(self):
+        buffer = tracking_utils.get_work_buffer('test', (4, 5), np.uint8)
+        self.assertIs(tracking_utils.get_work_buffer('test', (4, 5),
+                                                     np.uint8), buffer)
+        resized = tracking_utils.get_work_buffer('test', (5, 5), np.uint8)
+        self.assertEqual(resized.shape, (5, 5))
+
+    # testing downsampled segmentation
+    def test_upsample_nuclei(self):
+        centers, rects = tracking_utils.upsample_nuclei(
+                         [(10, 5), (49, 49)], [(8, 3, 4, 4), (47, 47, 3, 3)],
+                         2, (100, 99))
+        self.assertEqual(centers, [(21, 11), (98, 99)])
+        # rectangles are clipped to the image
+        self.assertEqual(rects, [(16, 6, 8, 8), (94, 94, 5, 6)])
+
+    def test_segment_frame_downsample(self):
+        img = cv2.imread("test/data/test_image_9cells.png")
+        reference = tracking_utils.segment_frame(img)
+        segmentation = tracking_utils.segment_frame(img, downsample=2)
+        # labels are mapped back to full resolution
+        self.assertEqual(segmentation['labels'].shape, img.shape[:2])
+        accuracy = tracking_utils.compare_segmentations(reference,
+                                                        segmentation)
+        self.assertEqual(accuracy['n_reference'], 9)
+        self.assertEqual(accuracy['recall'], 1.0)
+        self.assertLess(accuracy['mean_distance'], 2)
+
+    def test_compare_segmentations(self):
+        reference = {'centers': np.array([[0, 0], [10, 0], [50, 50]])}
+        segmentation = {'centers': np.array([[1, 0], [2, 0], [90, 90]])}
+        accuracy = tracking_utils.compare_segmentations(reference,
+                                                        segmentation)
+        # each nucleus is matched at most once
+        self.assertEqual(accuracy['n_matched'], 1)
+        self.assertAlmostEqual(accuracy['recall'], 1 / 3)
+        self.assertAlmostEqual(accuracy['precision'], 1 / 3)
+        self.assertEqual(accuracy['mean_distance'], 1.0)
+
+    def test_report_accuracy(self):
+        rows = segmentation_accuracy.report_accuracy(
+               ["test/data/test_frame_4_cells.tif"], factors=[2])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['factor'], 2)
+        self.assertEqual(rows[0]['recall'], 1.0)
+
+    # testing IncrementalSegmenter
+    def test_watershed_labels_seeded_keeps_seed_order(self):
+        img = cv2.imread("test/data/test_image_9cells.png")
+        centers = tracking_utils.segment_frame(img)['centers']
+        grayscale, thresh = tracking_utils.get_foreground(img[:, :, 0])
+        seeds = [tuple(center) for center in centers[::-1]]
+        markers = tracking_utils.watershed_labels_seeded(grayscale, thresh,
+                                                         seeds)
+        # seed i is labelled i + 2
+        for i, (x, y) in enumerate(seeds):
+            self.assertEqual(markers[y, x], i + 2)
+
+    def test_incremental_segmenter_seeds_moving_nuclei(self):
+        img = cv2.imread("test/data/test_image.png", cv2.IMREAD_UNCHANGED)
+        segmenter = tracking_utils.IncrementalSegmenter()
+        seeds = None
+        for shift in range(4):
+            moved = cv2.warpAffine(img, np.float32([[1, 0, shift],
+                                                    [0, 1, shift]]),
+                                   (img.shape[1], img.shape[0]))
+            frame = np.dstack((moved, moved, moved))
+            segmentation = segmenter.segment(frame, seeds)
+            full = tracking_utils.segment_frame(frame)
+            self.assertLessEqual(abs(len(segmentation['centers'])
+                                     - len(full['centers'])),
+                                 0.05 * len(full['centers']))
+            seeds = [tuple(center) for center in segmentation['centers']]
+        # only the first frame was segmented from scratch
+        self.assertEqual(segmenter.n_full, 1)
+        self.assertEqual(segmenter.n_seeded, 3)
+
+    def test_incremental_segmenter_falls_back(self):
+        images = [tifffile.imread("test/data/test_frame_4_cells.tif"),
+                  tifffile.imread("test/data/test_frame_5_cells_v2.tif")]
+        segmenter = tracking_utils.IncrementalSegmenter()
+        first = segmenter.segment(images[0])
+        seeds = [tuple(center) for center in first['centers']]
+        # a new nucleus is not seeded, so the frame is segmented again
+        second = segmenter.segment(images[1], seeds)
+        self.assertEqual(segmenter.n_full, 2)
+        self.assertTrue(np.array_equal(
+            second['centers'],
+            tracking_utils.segment_frame(images[1])['centers']))
+
+    def test_incremental_segmenter_falls_back_on_touching_nucleus(self):
+        img = cv2.imread("test/data/test_image.png", cv2.IMREAD_UNCHANGED)
+        frame = np.dstack((img, img, img))
+        segmenter = tracking_utils.IncrementalSegmenter()
+        first = segmenter.segment(frame)
+        seeds = [tuple(center) for center in first['centers']]
+        # a new nucleus (a copy of one) appears right next to it
+        x, y, w, h = 680, 18, 11, 13
+        new_img = img.copy()
+        new_img[y:y+h, x+w:x+2*w] = np.maximum(new_img[y:y+h, x+w:x+2*w],
+                                               img[y:y+h, x:x+w])
+        new_frame = np.dstack((new_img, new_img, new_img))
+        _, thresh = tracking_utils.get_foreground(new_img)
+        _, components = cv2.connectedComponents(thresh)
+        self.assertEqual(components[y + h // 2, x + w // 2],
+                         components[y + h // 2, x + w + w // 2])
+        full = tracking_utils.segment_frame(new_frame)
+        self.assertEqual(len(full['centers']), len(first['centers']) + 1)
+        # the seeded label of the old nucleus floods the new one, so the
+        # frame is segmented from scratch
+        second = segmenter.segment(new_frame, seeds)
+        self.assertEqual(segmenter.n_full, 2)
+        self.assertEqual(segmenter.n_seeded, 0)
+        self.assertTrue(np.array_equal(second['centers'], full['centers']))
+        self.assertTrue(np.array_equal(second['labels'], full['labels']))
+
+    def test_track_frames_incremental(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        outputs = [len(cells) for _, cells in do_tracking.track_frames(
+                   ((i, image) for i in range(3)), incremental=True)]
+        expected = [len(cells) for _, cells in do_tracking.track_frames(
+                    (i, image) for i in range(3))]
+        self.assertEqual(outputs, expected)
+
+    # testing get_label_regions()
+    def test_get_label_regions(self):
+        markers = np.ones((10, 12), dtype=np.int32)
+        markers[0, :] = -1
+        markers[2:4, 3:6] = 2
+        markers[6:9, 8:11] = 4
+        markers[9, :] = -1
+        regions = tracking_utils.get_label_regions(markers)
+        # background and missing label 3 are skipped
+        self.assertEqual([label for label, _ in regions], [2, 4])
+        # bounding boxes are padded by one pixel and clipped to the image
+        self.assertEqual(regions[0][1], (slice(1, 5), slice(2, 7)))
+        self.assertEqual(regions[1][1], (slice(5, 10), slice(7, 12)))
+
+    def test_do_watershed_contours_in_frame_coordinates(self):
+        img = cv2.imread("test/data/test_image_9cells.png")
+        for cell in tracking_utils.do_watershed(img):
+            x, y, w, h = cell.contours[0]
+            cx, cy = cell.coords[0]
+            self.assertTrue(x <= cx <= x + w)
+            self.assertTrue(y <= cy <= y + h)
+
+    # testing watershed_labels_tiled()
+    def test_get_otsu_threshold_matches_cv2(self):
+        img = cv2.imread("test/data/test_image_some_overlap_28.png",
+                         cv2.IMREAD_GRAYSCALE)
+        expected = cv2.threshold(img, 0, 255,
+                                 cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0]
+        hist = cv2.calcHist([img], [0], None, [256], [0, 256])
+        self.assertEqual(tracking_utils.get_otsu_threshold(hist), expected)
+
+    def test_get_tiles_cover_image(self):
+        tiles = tracking_utils.get_tiles((100, 70), 32, 8)
+        covered = np.zeros((100, 70), dtype=int)
+        for core, padded in tiles:
+            covered[core] += 1
+            self.assertLessEqual(padded[0].start, core[0].start)
+            self.assertGreaterEqual(padded[1].stop, core[1].stop)
+        self.assertTrue(np.all(covered == 1))
+
+    def test_watershed_labels_tiled_matches_full_frame(self):
+        img = cv2.imread("test/data/test_image.png", cv2.IMREAD_UNCHANGED)
+        full = tracking_utils.get_nuclei(
+               tracking_utils.watershed_labels(img))[0]
+        tiled = tracking_utils.get_nuclei(
+                tracking_utils.watershed_labels_tiled(img, tile_size=256))[0]
+        # nuclei on tile seams are neither duplicated nor split
+        self.assertEqual(sorted(tiled), sorted(full))
+
+    def test_do_watershed_tiled_segment_frame(self):
+        img = cv2.imread("test/data/test_image_9cells.png")
+        segmentation = tracking_utils.segment_frame(img, tile_size=64,
+                                                    tile_overlap=32)
+        cells = tracking_utils.cells_from_segmentation(segmentation)
+        self.assertEqual(len(cells), len(tracking_utils.do_watershed(img)))
+
+    # testing measure_rects() and measure_labels()
+    def test_measure_rects(self):
+        channel_data = np.random.randint(0, 65535, (50, 60),
+                                         dtype=np.uint16)
+        rects = [(0, 0, 5, 4), (10, 20, 7, 3), (55, 45, 5, 5), (3, 7, 1, 1)]
+        measurements = tracking_utils.measure_rects(channel_data, rects,
+                                                    median=True)
+        for i, (x, y, w, h) in enumerate(rects):
+            roi = channel_data[y:y+h, x:x+w]
+            self.assertEqual(measurements['sum'][i], roi.sum())
+            self.assertEqual(measurements['area'][i], w * h)
+            self.assertEqual(measurements['mean'][i], roi.mean())
+            self.assertEqual(measurements['median'][i], np.median(roi))
+
+    def test_measure_rects_matches_per_cell_average(self):
+        img = cv2.imread("test/data/test_image_some_overlap_28.png")
+        cells = tracking_utils.do_watershed(img)
+        rects = [cell.contours[0] for cell in cells]
+        means = tracking_utils.measure_rects(img[:, :, 2], rects)['mean']
+        for i, rect in enumerate(rects):
+            self.assertEqual(
+                1 / means[i],
+                tracking_utils.get_channel_data_within_nuc_contour(
+                    img, rect, channel=2, invert=True))
+
+    def test_measure_rects_no_cells(self):
+        channel_data = np.zeros((10, 10), dtype=np.uint16)
+        measurements = tracking_utils.measure_rects(channel_data, [],
+                                                    median=True)
+        for values in measurements.values():
+            self.assertEqual(len(values), 0)
+
+    def test_measure_labels(self):
+        channel_data = np.random.randint(0, 255, (20, 30), dtype=np.uint8)
+        markers = np.ones((20, 30), dtype=np.int32)
+        markers[0, :] = -1
+        markers[2:6, 3:9] = 2
+        markers[10:13, 20:28] = 5
+        measurements = tracking_utils.measure_labels(channel_data, markers,
+                                                     [5, 2, 7], median=True)
+        for i, label in enumerate([5, 2]):
+            pixels = channel_data[markers == label]
+            self.assertEqual(measurements['area'][i], pixels.size)
+            self.assertEqual(measurements['sum'][i], pixels.sum())
+            self.assertAlmostEqual(measurements['mean'][i], pixels.mean())
+            self.assertEqual(measurements['median'][i], np.median(pixels))
+        # label 7 is not in the image
+        self.assertEqual(measurements['area'][2], 0)
+        self.assertTrue(np.isnan(measurements['median'][2]))
+
+    # testing get_channel2_nuc_cyto_ratio(s)
+    def test_channel2_nuc_cyto_ratio_matches_full_frame_masks(self):
+        frame = np.random.randint(1, 65535, (40, 50, 3), dtype=np.uint16)
+        # rects in the middle and touching every edge
+        rects = [(10, 10, 6, 5), (0, 0, 4, 4), (45, 35, 5, 5),
+                 (2, 30, 8, 9), (40, 1, 9, 3)]
+        ratios = tracking_utils.get_channel2_nuc_cyto_ratios(
+                 frame[:, :, 1], rects)
+        for i, (x, y, w, h) in enumerate(rects):
+            # reference: filled rectangles drawn on full-frame masks
+            mask_orig = np.zeros((40, 50), dtype=np.uint8)
+            mask_ext = np.zeros((40, 50), dtype=np.uint8)
+            cv2.rectangle(mask_orig, (x, y), (x + w, y + h), 255, -1)
+            x_ext, y_ext = max(0, x - 5), max(0, y - 5)
+            w_ext = min(50 - x_ext, w + 10)
+            h_ext = min(40 - y_ext, h + 10)
+            cv2.rectangle(mask_ext, (x_ext, y_ext),
+                          (x_ext + w_ext, y_ext + h_ext), 255, -1)
+            expected = (np.median(frame[:, :, 1][mask_ext == 255])
+                        / np.median(frame[:, :, 1][mask_orig == 255]))
+            self.assertEqual(ratios[i], expected)
+            self.assertEqual(tracking_utils.get_channel2_nuc_cyto_ratio(
+                             frame, (x, y, w, h), channel=1), expected)
+
+    def test_channel2_nuc_cyto_ratios_zero_nucleus(self):
+        channel_data = np.zeros((30, 30), dtype=np.uint16)
+        ratios = tracking_utils.get_channel2_nuc_cyto_ratios(
+                 channel_data, [(10, 10, 3, 3)])
+        self.assertEqual(list(ratios), [0])
+        self.assertEqual(len(tracking_utils.get_channel2_nuc_cyto_ratios(
+                         channel_data, [])), 0)
+
+    # testing segmentation cache
+    def test_segmentation_key(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        key = seg_cache.get_segmentation_key(image, area_threshold=1000)
+        self.assertEqual(key, seg_cache.get_segmentation_key(
+                              image.copy(), area_threshold=1000))
+        self.assertNotEqual(key, seg_cache.get_segmentation_key(
+                                 image, area_threshold=500))
+        changed = image.copy()
+        changed[0, 0, 1] += 1
+        self.assertNotEqual(key, seg_cache.get_segmentation_key(
+                                 changed, area_threshold=1000))
+
+    def test_get_frame_cells_with_cache(self):
+        image = tifffile.imread("test/data/test_frame_5_cells_v2.tif")
+        expected = tracking_utils.do_watershed(image)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = seg_cache.SegmentationCache(cache_dir)
+            for _ in range(2):
+                # first call segments, second call reads the cache
+                cells = tracking_utils.get_frame_cells(image, cache)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                self.assertEqual(len(cells), len(expected))
+                for cell, expected_cell in zip(cells, expected):
+                    self.assertEqual(cell.coords, expected_cell.coords)
+                    self.assertEqual(cell.contours, expected_cell.contours)
+                    self.assertEqual(cell.channel2_data,
+                                     expected_cell.channel2_data)
+                    self.assertEqual(cell.channel3_data,
+                                     expected_cell.channel3_data)
+            key = seg_cache.get_segmentation_key(image, area_threshold=1000)
+            segmentation = cache.get(key)
+            self.assertEqual(segmentation['labels'].shape, image.shape[:2])
+
+    def test_segmentation_cache_eviction(self):
+        segmentation = {'labels': np.random.randint(0, 100, (50, 50))}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = seg_cache.SegmentationCache(cache_dir)
+            cache.put('a', segmentation)
+            entry_size = cache.size
+            cache.max_bytes = 2 * entry_size
+            os.utime(cache.get_path('a'), (0, 0))
+            cache.put('b', segmentation)
+            cache.put('c', segmentation)
+            # oldest entry was removed to stay under the cap
+            self.assertIsNone(cache.get('a'))
+            self.assertIsNotNone(cache.get('c'))
+            self.assertLessEqual(cache.size, 2 * entry_size)
+
+    def test_segmentation_cache_concurrent_eviction(self):
+        # another process evicts entries while this one uses them
+        segmentation = {'labels': np.random.randint(0, 100, (50, 50))}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = seg_cache.SegmentationCache(cache_dir)
+            cache.put('a', segmentation)
+            cache.put('b', segmentation)
+            with mock.patch.object(seg_cache.os, 'utime',
+                                   side_effect=FileNotFoundError):
+                self.assertIsNotNone(cache.get('a'))
+            with mock.patch.object(seg_cache.os.path, 'getsize',
+                                   side_effect=FileNotFoundError):
+                cache.put('c', segmentation)
+
+            scandir = os.scandir
+
+            def evicting_scandir(path):
+                entries = list(scandir(path))
+                os.remove(cache.get_path('b'))
+                return entries
+
+            with mock.patch.object(seg_cache.os, 'scandir',
+                                   evicting_scandir):
+                cache.evict()
+            self.assertEqual(sorted(os.listdir(cache_dir)),
+                             ['a.npz', 'c.npz'])
+            self.assertEqual(cache.size, sum(
+                             os.path.getsize(cache.get_path(key))
+                             for key in ['a', 'c']))
+
     # testing resolve_child_conflicts()
     def test_resolve_child_conflicts_empty_candidates(self):
         candidates = []
@@ -199,6 +774,9 @@ class TestCellTracking(unittest.TestCase):
 
         self.assertEqual(expected_output[0][0], resolved_tracks[0][0])
         self.assertEqual(expected_output[1][0], resolved_tracks[1][0])
+        # a master cell's claim on its potential child is also compared
+        # with itself and ties, so no child is kept
+        self.assertEqual([[cell_1], [cell_2]], list(resolved_tracks))
 
     def test_resolve_child_conflicts_with_shared_child(self):
         # test for if two share a child but one is closer
@@ -219,6 +797,9 @@ class TestCellTracking(unittest.TestCase):
         expected_output = [[cell_1], [cell_2, cell_3]]
         self.assertEqual(expected_output[0][0], resolved_tracks[0][0])
         self.assertEqual(expected_output[1][0], resolved_tracks[1][0])
+        # a master cell's claim on its potential child is also compared
+        # with itself and ties, so no child is kept
+        self.assertEqual([[cell_1], [cell_2]], list(resolved_tracks))
 
     def test_resolve_child_conflicts_with_potential_child_already_cell(self):
         candidates = []
@@ -240,6 +821,9 @@ class TestCellTracking(unittest.TestCase):
         expected_output = [[cell_1], [cell_2, cell_3]]
         self.assertEqual(expected_output[0][0], resolved_tracks[0][0])
         self.assertEqual(expected_output[1][0], resolved_tracks[1][0])
+        # a master cell's claim on its potential child is also compared
+        # with itself and ties, so no child is kept
+        self.assertEqual([[cell_1], [cell_2]], list(resolved_tracks))
 
     def test_resolve_child_conflicts_with_same_child_same_dist(self):
         candidates = []
@@ -261,6 +845,131 @@ class TestCellTracking(unittest.TestCase):
         expected_output = [[cell_1], [cell_2]]
         self.assertEqual(expected_output[0][0], resolved_tracks[0][0])
         self.assertEqual(expected_output[1][0], resolved_tracks[1][0])
+        # a master cell's claim on its potential child is also compared
+        # with itself and ties, so no child is kept
+        self.assertEqual([[cell_1], [cell_2]], list(resolved_tracks))
+
+    def test_resolve_child_conflicts_matches_pairwise(self):
+        # compare with the original loop over every pair of master cells
+        rng = np.random.default_rng(0)
+        cells = [Cell() for i in range(40)]
+        for trial in range(20):
+            candidates = []
+            for i in range(30):
+                most_likely, pot_child = rng.choice(len(cells), 2,
+                                                    replace=False)
+                candidates.append({cells[most_likely]: 1,
+                                   cells[pot_child]:
+                                   float(rng.integers(1, 70))})
+            resolved_tracks = tracking_utils.resolve_child_conflicts(
+                              candidates, 50)
+            for i, curr_candidates in enumerate(candidates):
+                most_likely, pot_child = curr_candidates.keys()
+                owns_child = curr_candidates[pot_child] <= 50
+                for comparison_candidates in candidates:
+                    comp_most_likely, comp_pot_child = \
+                        comparison_candidates.keys()
+                    if pot_child == comp_most_likely:
+                        owns_child = False
+                    elif pot_child == comp_pot_child and \
+                            curr_candidates[pot_child] >= \
+                            comparison_candidates[comp_pot_child]:
+                        owns_child = False
+                expected = [most_likely, pot_child] if owns_child \
+                    else [most_likely]
+                self.assertEqual(expected, resolved_tracks[i])
+
+    def test_resolve_child_conflicts_divisions(self):
+        cell_1 = Cell()
+        cell_2 = Cell()
+        cell_3 = Cell()
+        cell_4 = Cell()
+        # with divisions, a claim is only compared with the other claims
+        candidates = [{cell_1: 2, cell_4: 10}, {cell_2: 3, cell_3: 5}]
+        resolved_tracks = tracking_utils.resolve_child_conflicts(
+                          candidates, 50, divisions=True)
+        self.assertEqual([[cell_1, cell_4], [cell_2, cell_3]],
+                         list(resolved_tracks))
+        # the closest of two claims gets the child
+        candidates = [{cell_1: 2, cell_3: 10}, {cell_2: 3, cell_3: 5}]
+        resolved_tracks = tracking_utils.resolve_child_conflicts(
+                          candidates, 50, divisions=True)
+        self.assertEqual([[cell_1], [cell_2, cell_3]], list(resolved_tracks))
+        # a cell that is the most likely cell of another is no child
+        candidates = [{cell_1: 2, cell_2: 10}, {cell_2: 3, cell_3: 5}]
+        resolved_tracks = tracking_utils.resolve_child_conflicts(
+                          candidates, 50, divisions=True)
+        self.assertEqual([[cell_1], [cell_2, cell_3]], list(resolved_tracks))
+        # equally close claims: neither gets the child
+        candidates = [{cell_1: 2, cell_3: 5}, {cell_2: 3, cell_3: 5}]
+        resolved_tracks = tracking_utils.resolve_child_conflicts(
+                          candidates, 50, divisions=True)
+        self.assertEqual([[cell_1], [cell_2]], list(resolved_tracks))
+
+        # same as comparing every pair of different master cells
+        rng = np.random.default_rng(0)
+        cells = [Cell() for i in range(40)]
+        for trial in range(20):
+            candidates = []
+            for i in range(30):
+                most_likely, pot_child = rng.choice(len(cells), 2,
+                                                    replace=False)
+                candidates.append({cells[most_likely]: 1,
+                                   cells[pot_child]:
+                                   float(rng.integers(1, 70))})
+            resolved_tracks = tracking_utils.resolve_child_conflicts(
+                              candidates, 50, divisions=True)
+            for i, curr_candidates in enumerate(candidates):
+                most_likely, pot_child = curr_candidates.keys()
+                owns_child = curr_candidates[pot_child] <= 50
+                for j, comparison_candidates in enumerate(candidates):
+                    comp_most_likely, comp_pot_child = \
+                        comparison_candidates.keys()
+                    if pot_child == comp_most_likely:
+                        owns_child = False
+                    elif j != i and pot_child == comp_pot_child and \
+                            curr_candidates[pot_child] >= \
+                            comparison_candidates[comp_pot_child]:
+                        owns_child = False
+                expected = [most_likely, pot_child] if owns_child \
+                    else [most_likely]
+                self.assertEqual(expected, resolved_tracks[i])
+
+    def test_resolve_child_conflicts_missing_candidates(self):
+        with self.assertRaises(IndexError):
+            tracking_utils.resolve_child_conflicts([{Cell(): 2}], 50)
+
+    # testing get_candidates()
+    def test_get_candidates_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        curr_frame_cells = []
+        for _ in range(40):
+            cell = Cell()
+            cell.add_coordinate(tuple(int(v) for v in rng.integers(0, 20, 2)))
+            curr_frame_cells.append(cell)
+        master_cells = curr_frame_cells[:10] + curr_frame_cells[25:]
+        candidates = tracking_utils.get_candidates(master_cells,
+                                                   curr_frame_cells)
+        for cell, curr_candidates in zip(master_cells, candidates):
+            # closest two cells, ties broken by list order
+            dists = sorted((tracking_utils.dist_between_points(
+                            cell.coords[0], curr_cell.coords[0]), j)
+                           for j, curr_cell in enumerate(curr_frame_cells))
+            expected = {curr_frame_cells[j]: dist for dist, j in dists[:2]}
+            self.assertEqual(list(curr_candidates.items()),
+                             list(expected.items()))
+
+    def test_get_candidates_few_cells(self):
+        parent_cell = Cell()
+        parent_cell.add_coordinate((0, 0))
+        only_cell = Cell()
+        only_cell.add_coordinate((3, 4))
+        candidates = tracking_utils.get_candidates([parent_cell],
+                                                   [only_cell])
+        self.assertEqual(candidates[0], {only_cell: 5.0,
+                                         None: float('inf')})
+        candidates = tracking_utils.get_candidates([parent_cell], [])
+        self.assertEqual(candidates[0], {None: float('inf')})
 
     # testing link_cell()
     def test_link_cell(self):
@@ -387,6 +1096,28 @@ class TestCellTracking(unittest.TestCase):
         for item in to_cull_list:
             self.assertIn(item.coords, output)
 
+    def test_get_cells_to_cull_shared_by_many(self):
+        # cells moving the least keep a shared position, whatever their
+        # order; newborn cells lose conflicts but never jump
+        test_positions = [(20, 20), (20, 20), (20, 20), (5, 5), (40, 40)]
+        test_previous_positions = [(20, 25), (20, 21), (-1, -1),
+                                   (5, 300), (-1, -1)]
+        test_cell_list = []
+        for i in range(5):
+            test_cell = Cell()
+            test_cell.add_coordinate(test_previous_positions[i])
+            test_cell.add_coordinate(test_positions[i])
+            test_cell_list.append(test_cell)
+
+        # each cell once, in the order found
+        to_cull = tracking_utils.get_cells_to_cull(test_cell_list, 100)
+        self.assertEqual(to_cull, [test_cell_list[0], test_cell_list[2],
+                                   test_cell_list[3]])
+        to_cull = tracking_utils.get_cells_to_cull(test_cell_list[::-1], 100)
+        self.assertEqual(to_cull, [test_cell_list[3], test_cell_list[2],
+                                   test_cell_list[0]])
+        self.assertEqual(tracking_utils.get_cells_to_cull([], 100), [])
+
     # test cull_duplicates()
     def test_cull_duplicates_no_histories(self):
         # make synthetic cell list to test on
@@ -462,7 +1193,60 @@ class TestCellTracking(unittest.TestCase):
         for item in not_culled_list:
             self.assertIn(item.coords, output)
 
+    # testing assign_links()
+    def test_assign_links(self):
+        prev_points = np.array([[10, 10], [50, 50], [100, 100],
+                                [300, 300]])
+        curr_points = np.array([[12, 10], [100, 103], [52, 51],
+                                [200, 200], [105, 100]])
+        matches, children, dists = tracking_utils.assign_links(
+                                   prev_points, curr_points, max_distance=30)
+        self.assertEqual(list(matches), [0, 2, 1, -1])
+        # the fifth cell is a second daughter of the third track
+        self.assertEqual(list(children), [-1, -1, 4, -1])
+        self.assertAlmostEqual(dists[0], 2.0)
+        self.assertEqual(dists[3], float('inf'))
+
+    def test_assign_links_prefers_global_optimum(self):
+        # greedy nearest neighbour would give both tracks cell 0
+        prev_points = np.array([[0, 0], [10, 0]])
+        curr_points = np.array([[6, 0], [16, 0]])
+        matches, children, dists = tracking_utils.assign_links(
+                                   prev_points, curr_points, max_distance=8,
+                                   division_cost=100)
+        self.assertEqual(list(matches), [0, 1])
+
+    def test_assign_links_empty_frame(self):
+        matches, children, dists = tracking_utils.assign_links(
+                                   np.array([[1, 1]]), np.empty((0, 2)))
+        self.assertEqual(list(matches), [-1])
+
     # test link_next_frame()
+    def test_link_next_frame_assignment(self):
+        image_1 = tifffile.imread("test/data/test_frame_4_cells.tif")
+        image_2 = tifffile.imread("test/data/test_frame_5_cells_v2.tif")
+        master_cells = tracking_utils.do_watershed(image_1)
+        output = tracking_utils.link_next_frame(master_cells, image_2, 1,
+                                                strategy='assignment')
+        # one cell jumps past the gate (lost and found as a new cell),
+        # and a new cell appears
+        self.assertEqual(len(output), 5)
+        for cell in output:
+            # one entry per frame for every cell, including new ones
+            self.assertEqual(len(cell.coords), 2)
+            self.assertEqual(len(cell.channel2_data), 2)
+        new_cells = [cell for cell in output if cell.birthday == 1]
+        self.assertEqual(len(new_cells), 2)
+        self.assertEqual(new_cells[0].coords[0], (-1, -1))
+        self.assertTrue(np.isnan(new_cells[0].channel3_data[0]))
+
+    def test_link_next_frame_unknown_strategy(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        master_cells = tracking_utils.do_watershed(image)
+        with self.assertRaises(ValueError):
+            tracking_utils.link_next_frame(master_cells, image, 1,
+                                           strategy='unknown')
+
     def test_link_next_frame_same_image(self):
         # setting up input for function
         image = tifffile.imread("test/data/test_frame_4_cells.tif")
@@ -855,6 +1639,494 @@ class TestCellTracking(unittest.TestCase):
         for coord in new_coords_list:
             self.assertIn(coord, previous_coord_list_out)
 
+    # test streaming pipeline in do_tracking
+    def test_iter_frames_releases_planes(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        sizes = {'v': 1, 't': 3, 'c': 3,
+                 'y': image.shape[0], 'x': image.shape[1]}
+        movie = read_nd2.LazyMovie(lambda s, f, c: image[:, :, c], sizes)
+        site0 = read_nd2.get_site_data(movie, 0)
+        for frame_num, frame in do_tracking.iter_frames(site0):
+            frame[:, :, 0]
+            # only the current frame is cached
+            self.assertEqual(list(movie._planes.keys()),
+                             [(0, frame_num, 0)])
+        self.assertEqual(len(movie._planes), 0)
+
+    def test_track_frames_same_image(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        frames = ((i, image) for i in range(3))
+        outputs = [(frame_num, len(cells)) for frame_num, cells
+                   in do_tracking.track_frames(frames)]
+        self.assertEqual(outputs, [(0, 4), (1, 4), (2, 4)])
+
+    def test_link_frames_matches_track_frames(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        frame_cells = ((i, tracking_utils.do_watershed(image))
+                       for i in range(3))
+        linked = [len(cells) for _, cells
+                  in do_tracking.link_frames(frame_cells)]
+        tracked = [len(cells) for _, cells in do_tracking.track_frames(
+                   (i, image) for i in range(3))]
+        self.assertEqual(linked, tracked)
+
+    def get_gap_frames(self, n_frames, missing):
+        # four cells moving slowly, the last one missed in some frames
+        for frame_num in range(n_frames):
+            cells = []
+            for k, (x, y) in enumerate([(100, 100), (300, 100),
+                                        (100, 300), (300, 300)]):
+                if k == 3 and frame_num in missing:
+                    continue
+                cells.append(Cell(coords=[(x + 2 * frame_num,
+                                           y + frame_num)],
+                                  contours=[None],
+                                  channel3_data=[float(k)],
+                                  channel2_data=[float(k)]))
+            yield frame_num, cells
+
+    def test_link_frames_gap_closing(self):
+        for strategy in ['greedy', 'assignment']:
+            for max_gap, n_tracks in [(None, 3), (1, 3), (3, 4)]:
+                linking_params = {'strategy': strategy, 'max_gap': max_gap}
+                for _, master_cells in do_tracking.link_frames(
+                        self.get_gap_frames(6, (2, 3)), 30, linking_params):
+                    pass
+                master_cells = do_tracking.cull_remaining_problematics(
+                               master_cells, 6)
+                # cells found again after the gap are new cells,
+                # unless their track is reconnected
+                tracks = [cell for cell in master_cells
+                          if cell.coords[0] != (-1, -1)]
+                self.assertEqual(len(tracks), n_tracks)
+        reconnected = [cell for cell in tracks
+                       if cell.coords[0] == (300, 300)][0]
+        self.assertEqual(reconnected.coords,
+                         [(300, 300), (302, 301), (-1, -1), (-1, -1),
+                          (308, 304), (310, 305)])
+        self.assertTrue(np.isnan(reconnected.channel3_data[2]))
+        self.assertEqual(reconnected.channel3_data[4], 3.0)
+        self.assertEqual(len(reconnected.channel2_data), 6)
+
+    def test_lost_tracks(self):
+        lost_tracks = tracking_utils.LostTracks(max_gap=2, max_distance=10)
+        # the last two positions of a culled problematic cell are dropped
+        culled_cell = Cell(coords=[(0, 0), (2, 0), (80, 80), (81, 80)],
+                           channel3_data=[0, 1, 2, 3],
+                           channel2_data=[0, 1, 2, 3], problematic=2)
+        lost_cell = Cell(coords=[(50, 50), (51, 50), (52, 50)],
+                         channel3_data=[0, 1, 2],
+                         channel2_data=[0, 1, 2])
+        newborn_cell = Cell(coords=[(-1, -1), (70, 70)],
+                            channel3_data=[np.nan, 1],
+                            channel2_data=[np.nan, 1], problematic=1)
+        lost_tracks.add([culled_cell, lost_cell, newborn_cell])
+        self.assertEqual(len(lost_tracks), 2)
+
+        found_cells = [Cell(coords=[(4, 1)], contours=[None],
+                            channel3_data=[4], channel2_data=[4]),
+                       Cell(coords=[(90, 90)], contours=[None],
+                            channel3_data=[4], channel2_data=[4])]
+        reconnected, unlinked = lost_tracks.reconnect(found_cells, 4)
+        self.assertEqual(reconnected, [culled_cell])
+        self.assertEqual(unlinked, [found_cells[1]])
+        self.assertEqual(culled_cell.coords,
+                         [(0, 0), (2, 0), (-1, -1), (-1, -1), (4, 1)])
+        self.assertEqual(culled_cell.channel3_data[4], 4)
+        self.assertEqual(culled_cell.problematic, 0)
+        # lost_cell (last seen in frame 2) can no longer be reconnected
+        lost_tracks.expire(6)
+        self.assertEqual(len(lost_tracks), 0)
+
+    def test_link_frames_motion(self):
+        # cells moving 20 pixels per frame jump further than
+        # distance_threshold / 2 between any two frames
+        def get_fast_frames():
+            for frame_num in range(8):
+                yield frame_num, [Cell(coords=[(x + 20 * frame_num,
+                                                y - 10 * frame_num)],
+                                       contours=[None],
+                                       channel3_data=[1.0],
+                                       channel2_data=[1.0])
+                                  for x, y in [(100, 300), (300, 300),
+                                               (500, 300)]]
+        for strategy in ['greedy', 'assignment']:
+            for motion, n_tracks in [(False, 0), (True, 3)]:
+                linking_params = {'strategy': strategy, 'motion': motion}
+                for _, master_cells in do_tracking.link_frames(
+                        get_fast_frames(), 30, linking_params):
+                    pass
+                master_cells = do_tracking.cull_remaining_problematics(
+                               master_cells, 8)
+                tracks = [cell for cell in master_cells
+                          if cell.coords[0] != (-1, -1)]
+                self.assertEqual(len(tracks), n_tracks)
+        for cell in tracks:
+            self.assertEqual(cell.velocity, (20, -10))
+            self.assertEqual(cell.prediction_error, 0)
+            # predictable cells are linked with a small gate
+            self.assertEqual(tracking_utils.get_motion_gate(cell, 30), 10)
+
+    def test_update_motion(self):
+        cell = Cell(coords=[(0, 0)])
+        self.assertEqual(tracking_utils.predict_position(cell), (0, 0))
+        self.assertEqual(tracking_utils.get_motion_gate(cell, 30), 30)
+        # the first displacement is the first velocity
+        cell.add_coordinate((6, 8))
+        tracking_utils.update_motion(cell, (0, 0), 30)
+        self.assertEqual(cell.velocity, (6, 8))
+        self.assertEqual(cell.prediction_error, 10)
+        self.assertEqual(tracking_utils.predict_position(cell), (12, 16))
+        # then the velocity moves half way towards the residual
+        cell.add_coordinate((12, 24))
+        tracking_utils.update_motion(cell, (12, 16), 30)
+        self.assertEqual(cell.velocity, (6, 12))
+        self.assertEqual(cell.prediction_error, 8)
+        self.assertEqual(cell.motion_error, 9)
+        self.assertEqual(tracking_utils.get_motion_gate(cell, 30), 27)
+        self.assertEqual(tracking_utils.get_motion_gate(cell, 20), 20)
+
+    def test_resolve_children_matches_resolve_child_conflicts(self):
+        rng = np.random.default_rng(1)
+        cells = [Cell() for i in range(40)]
+        for trial in range(20):
+            matches = rng.integers(0, 40, 30)
+            child_candidates = np.array([rng.choice(np.delete(
+                                         np.arange(40), match))
+                                         for match in matches])
+            child_dists = rng.integers(1, 70, 30).astype(float)
+            candidates = [{cells[match]: 1, cells[child]: dist}
+                          for match, child, dist
+                          in zip(matches, child_candidates, child_dists)]
+            resolved_tracks = tracking_utils.resolve_child_conflicts(
+                              candidates, 50)
+            children = tracking_utils.resolve_children(
+                       matches, child_candidates, child_dists, 40, 50)
+            for i in range(30):
+                expected = [cells[matches[i]]]
+                if children[i] != -1:
+                    expected.append(cells[children[i]])
+                self.assertEqual(expected, resolved_tracks[i])
+
+    def test_link_points(self):
+        prev_points = np.array([[0, 0], [100, 0], [200, 0]])
+        # the second cell divides, the third one is lost
+        curr_points = np.array([[2, 0], [100, 3], [100, -8], [300, 0]])
+        matches, children, dists = tracking_utils.link_points(
+                                   prev_points, curr_points, 'greedy')
+        self.assertEqual(list(matches), [0, 1, 3])
+        # greedy linking keeps the original child rule, under which
+        # a track's own claim on its child always ties
+        self.assertEqual(list(children), [-1, -1, -1])
+        self.assertEqual(list(dists), [2, 3, 100])
+        matches, children, dists = tracking_utils.link_points(
+                                   prev_points, curr_points, 'greedy',
+                                   divisions=True)
+        self.assertEqual(list(matches), [0, 1, 3])
+        self.assertEqual(list(children), [-1, 2, -1])
+        matches, children, dists = tracking_utils.link_points(
+                                   prev_points, curr_points, 'assignment')
+        self.assertEqual(list(matches), [0, 1, -1])
+        self.assertEqual(list(children), [-1, 2, -1])
+        # no cells in the current frame: every track is lost
+        for strategy in ['greedy', 'assignment']:
+            matches, children, dists = tracking_utils.link_points(
+                                       prev_points, np.empty((0, 2)),
+                                       strategy)
+            self.assertEqual(list(matches), [-1, -1, -1])
+            self.assertTrue(np.all(np.isinf(dists)))
+        with self.assertRaises(ValueError):
+            tracking_utils.link_points(prev_points, curr_points, 'unknown')
+
+    def test_assign_links_gates(self):
+        prev_points = [(0, 0), (100, 0)]
+        curr_points = [(0, 12), (100, 12)]
+        matches, _, _ = tracking_utils.assign_links(prev_points,
+                                                    curr_points, 30)
+        self.assertEqual(list(matches), [0, 1])
+        matches, _, _ = tracking_utils.assign_links(prev_points,
+                                                    curr_points, 30,
+                                                    gates=[10, 40])
+        self.assertEqual(list(matches), [-1, 1])
+
+    def test_correct_links_keeps_order(self):
+        test_cell_list = []
+        test_positions = [(10, 11), (2, 5), (100, 9), (100, 9), (55, 55)]
+        test_previous_positions = [(9, 9), (3, 5), (150, 70),
+                                   (98, 9), (54, 60)]
+        for i in range(5):
+            test_cell = Cell()
+            test_cell.add_coordinate(test_previous_positions[i])
+            test_cell.add_coordinate(test_positions[i])
+            test_cell_list.append(test_cell)
+
+        problematic_cells = {}
+        output = tracking_utils.correct_links(
+                 test_cell_list, 20, problematic_cells=problematic_cells)
+        # problematic cells are marked but stay in place
+        self.assertEqual(output, test_cell_list)
+        self.assertEqual(list(problematic_cells), [test_cell_list[2]])
+        self.assertEqual(test_cell_list[2].problematic, 1)
+
+        # next frame: the problematic cell cannot be healed
+        for cell, position in zip(test_cell_list, [(10, 12), (2, 6),
+                                                   (300, 9), (101, 9),
+                                                   (55, 56)]):
+            cell.add_coordinate(position)
+        output = tracking_utils.correct_links(
+                 test_cell_list, 20, problematic_cells=problematic_cells)
+        self.assertEqual(output, [test_cell_list[i] for i in [0, 1, 3, 4]])
+        self.assertEqual(problematic_cells, {})
+
+    def test_link_frames_deterministic(self):
+        def get_frames():
+            rng = np.random.default_rng(0)
+            points = rng.uniform(0, 500, (100, 2))
+            for frame_num in range(6):
+                points = points + rng.normal(0, 6, points.shape)
+                yield frame_num, [Cell(coords=[(int(x), int(y))],
+                                       contours=[None],
+                                       channel3_data=[1.0],
+                                       channel2_data=[1.0])
+                                  for x, y in points]
+        outputs = []
+        for run in range(2):
+            for _, master_cells in do_tracking.link_frames(get_frames()):
+                pass
+            outputs.append([cell.coords for cell in master_cells])
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_track_column(self):
+        store = track_store.TrackStore(capacity=2, track_capacity=1,
+                                       history_capacity=1)
+        cell = store.new_cell(birthday=2)
+        cell.backfill(2)
+        cell.add_coordinate((10, 20))
+        cell.add_channel3_data(0.5)
+        cell.add_contour((1, 2, 3, 4))
+        self.assertEqual(len(cell.coords), 3)
+        self.assertEqual(cell.coords, [(-1, -1), (-1, -1), (10, 20)])
+        self.assertEqual(cell.get_most_recent_coord(), (10, 20))
+        self.assertEqual(cell.coords[-2:], [(-1, -1), (10, 20)])
+        self.assertEqual(cell.contours, [None, None, (1, 2, 3, 4)])
+        self.assertTrue(np.isnan(cell.channel3_data[0]))
+        cell.coords[1] = (5, 6)
+        self.assertEqual(cell.coords[1], (5, 6))
+        cell.coords = cell.coords[:1]
+        self.assertEqual(cell.coords, [(-1, -1)])
+        with self.assertRaises(IndexError):
+            cell.coords[1]
+        self.assertEqual(cell.birthday, 2)
+
+        child = store.new_cell(parent=cell, birthday=3)
+        self.assertIs(child.parent, cell)
+        self.assertEqual(len(child.coords), 1)
+        self.assertEqual(len(store), 2)
+        with self.assertRaises(ValueError):
+            store.new_cell(parent=Cell())
+
+    def test_link_frames_track_store(self):
+        def get_frames():
+            rng = np.random.default_rng(0)
+            points = rng.uniform(0, 500, (100, 2))
+            for frame_num in range(6):
+                points = points + rng.normal(0, 6, points.shape)
+                keep = rng.random(len(points)) > 0.1
+                yield frame_num, [Cell(coords=[(int(x), int(y))],
+                                       contours=[(int(x), int(y), 3, 3)],
+                                       channel3_data=[x],
+                                       channel2_data=[y])
+                                  for x, y in points[keep]]
+
+        _, frame_cells = zip(*get_frames())
+        master_cells = list(frame_cells[0])
+        for frame_num in range(1, 6):
+            master_cells = tracking_utils.link_frame_cells(
+                           master_cells, frame_cells[frame_num], frame_num)
+            master_cells = tracking_utils.correct_links(master_cells, 30)
+        for _, track_cells in do_tracking.link_frames(get_frames()):
+            pass
+        self.assertTrue(all(isinstance(cell, track_store.TrackCell)
+                            for cell in track_cells))
+        self.assertEqual([cell.coords for cell in track_cells],
+                         [cell.coords for cell in master_cells])
+        self.assertEqual([cell.contours[-1] for cell in track_cells],
+                         [cell.contours[-1] for cell in master_cells])
+
+        # the columns are exported at once, with the same result
+        tracks = plots.create_tracks_dataframe(track_cells, range(6),
+                                               'channel2', 'channel3')
+        expected = plots.create_tracks_dataframe(master_cells, range(6),
+                                                 'channel2', 'channel3')
+        self.assertTrue(tracks.equals(expected))
+
+    def test_track_store_collect(self):
+        store = track_store.TrackStore(capacity=2, track_capacity=2,
+                                       history_capacity=1)
+        cells = store.add_cells([Cell(coords=[(i, i)], channel3_data=[i])
+                                 for i in range(4)])
+        child = store.new_cell(parent=cells[1], birthday=1)
+        child.backfill(1)
+        child.add_coordinate((7, 8))
+        cells[1].children = [child]
+        store.collect([cells[1], cells[3]])
+        # the parent of a kept track is kept too
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.n_rows, 3)
+        self.assertEqual(cells[1].coords, [(1, 1)])
+        self.assertEqual(cells[1].channel3_data, [1])
+        self.assertEqual(cells[3].coords, [(3, 3)])
+        self.assertIs(child.parent, cells[1])
+        self.assertEqual(child.coords, [(-1, -1), (7, 8)])
+        self.assertEqual(child.birthday, 1)
+        with self.assertRaises(AttributeError):
+            cells[0].coords[0]
+        other_store = track_store.TrackStore(track_capacity=1)
+        other_store.new_cell()
+        with self.assertRaises(ValueError):
+            other_store.collect([cells[1]])
+
+    def test_link_frames_track_store_churn(self):
+        def get_frames():
+            # cells are too far apart to be linked, so every track dies
+            rng = np.random.default_rng(0)
+            for frame_num in range(60):
+                points = rng.uniform(0, 5000, (50, 2))
+                yield frame_num, [Cell(coords=[(int(x), int(y))],
+                                       contours=[(int(x), int(y), 3, 3)],
+                                       channel3_data=[x],
+                                       channel2_data=[y])
+                                  for x, y in points]
+
+        linking_params = {'strategy': 'assignment'}
+        _, frame_cells = zip(*get_frames())
+        master_cells = list(frame_cells[0])
+        lost_tracks = tracking_utils.LostTracks(2, 30)
+        problematic_cells = {}
+        for frame_num in range(1, 60):
+            master_cells = tracking_utils.link_frame_cells(
+                           master_cells, frame_cells[frame_num], frame_num,
+                           lost_tracks=lost_tracks, **linking_params)
+            master_cells = tracking_utils.correct_links(
+                           master_cells, 30, lost_tracks=lost_tracks,
+                           problematic_cells=problematic_cells)
+
+        n_tracks = []
+        for _, track_cells in do_tracking.link_frames(
+                get_frames(), 30, dict(linking_params, max_gap=2)):
+            n_tracks.append(len(track_cells[0].store))
+        # 3000 tracks are created, but the dead ones are freed
+        store = track_cells[0].store
+        self.assertLessEqual(max(n_tracks), 2 * store.min_collect)
+        self.assertLessEqual(len(store.rows), 2 * store.min_collect)
+        self.assertLessEqual(store.n_rows, 2 * store.min_collect)
+        self.assertEqual([cell.coords for cell in track_cells],
+                         [cell.coords for cell in master_cells])
+
+    def test_segment_frames_parallel(self):
+        images = [tifffile.imread("test/data/" + name + ".tif")
+                  for name in ["test_frame_4_cells",
+                               "test_frame_4_cells_movement_v2",
+                               "test_frame_5_cells_v2"]]
+        sizes = {'v': 1, 't': 6, 'c': 3,
+                 'y': images[0].shape[0], 'x': images[0].shape[1]}
+        movie = read_nd2.LazyMovie(lambda s, f, c: images[f % 3][:, :, c],
+                                   sizes)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            nd2_path = os.path.join(cache_dir, 'movie.nd2')
+            with open(nd2_path, 'wb') as f:
+                f.write(b'1234')
+            frame_cache.write_store(movie, frame_cache.get_store_path(
+                                    nd2_path, cache_dir))
+            segmentations = list(do_tracking.segment_frames_parallel(
+                                 nd2_path, 0, 6, 2, cache_dir=cache_dir))
+            self.assertEqual([frame_num for frame_num, _ in segmentations],
+                             list(range(6)))
+            for frame_num, segmentation in segmentations:
+                # label images are not sent back to the linker
+                self.assertNotIn('labels', segmentation)
+                expected = tracking_utils.segment_frame(images[frame_num % 3])
+                self.assertTrue(np.array_equal(segmentation['centers'],
+                                               expected['centers']))
+
+            serial = do_tracking.track_site_file(nd2_path, 0,
+                                                 cache_dir=cache_dir)
+            parallel = do_tracking.track_site_file(nd2_path, 0,
+                                                   cache_dir=cache_dir,
+                                                   segment_workers=2)
+            # same tracks in the same order
+            self.assertTrue(serial.equals(parallel))
+
+    def test_track_site(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        sizes = {'v': 1, 't': 3, 'c': 3,
+                 'y': image.shape[0], 'x': image.shape[1]}
+        movie = read_nd2.LazyMovie(lambda s, f, c: image[:, :, c], sizes)
+        master_cells = do_tracking.track_site(
+                       read_nd2.get_site_data(movie, 0))
+        self.assertEqual(len(master_cells), 4)
+        for cell in master_cells:
+            self.assertEqual(len(cell.coords), 3)
+
+    def test_merge_site_tracks(self):
+        image = tifffile.imread("test/data/test_frame_4_cells.tif")
+        master_cells = tracking_utils.do_watershed(image)
+        site_tracks = {}
+        for site in range(2):
+            site_tracks[site] = plots.create_tracks_dataframe(
+                                master_cells, [image], 'channel2_data',
+                                'channel3_data')
+        merged = do_tracking.merge_site_tracks(site_tracks)
+        self.assertEqual(len(merged), 8)
+        self.assertEqual(list(merged['site']), [0] * 4 + [1] * 4)
+        self.assertEqual(list(merged['cell'][:2]), ['0_0', '0_1'])
+        self.assertEqual(list(merged['cell'][4:6]), ['1_0', '1_1'])
+        # cell IDs are unique across the well
+        self.assertEqual(len(set(merged['cell'])), 8)
+
+    def test_get_tracks_file_name(self):
+        self.assertEqual(do_tracking.get_tracks_file_name(
+                         "doc/WellD01.nd2", "output"),
+                         "output/WellD01_tracks.csv")
+        self.assertEqual(do_tracking.get_tracks_file_name(
+                         "doc/WellD01.nd2", "output", site=1),
+                         "output/WellD01_site1_tracks.csv")
+
+    # test batch mode
+    def test_find_nd2_files(self):
+        with tempfile.TemporaryDirectory() as plate_dir:
+            for name in ['B02.nd2', 'A01.nd2', 'notes.txt']:
+                open(os.path.join(plate_dir, name), 'w').close()
+            expected = [os.path.join(plate_dir, 'A01.nd2'),
+                        os.path.join(plate_dir, 'B02.nd2')]
+            self.assertEqual(do_batch.find_nd2_files(plate_dir), expected)
+            self.assertEqual(do_batch.find_nd2_files(
+                             os.path.join(plate_dir, 'A*.nd2')),
+                             expected[:1])
+
+    def test_get_worker_count(self):
+        self.assertEqual(do_batch.get_worker_count(8, 100), 8)
+        self.assertEqual(do_batch.get_worker_count(8, 100, 350), 3)
+        # always at least one worker
+        self.assertEqual(do_batch.get_worker_count(8, 100, 10), 1)
+
+    def test_run_batch_skips_up_to_date_wells(self):
+        with tempfile.TemporaryDirectory() as plate_dir:
+            nd2_path = os.path.join(plate_dir, 'A01.nd2')
+            open(nd2_path, 'w').close()
+            output_path = os.path.join(plate_dir, 'output')
+            self.assertFalse(do_batch.is_up_to_date(nd2_path, output_path))
+            os.makedirs(output_path)
+            open(os.path.join(output_path, 'A01_tracks.csv'), 'w').close()
+            self.assertTrue(do_batch.is_up_to_date(nd2_path, output_path))
+
+            manifest = do_batch.run_batch([nd2_path], output_path)
+            self.assertEqual([job['status'] for job in manifest],
+                             ['skipped'])
+            self.assertTrue(os.path.exists(
+                            os.path.join(output_path,
+                                         do_batch.MANIFEST_FILE)))
+
 
 def main():
     unittest.main()